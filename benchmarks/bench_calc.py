@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark for the offline difficulty/pp calculator.
+
+Parses every .osu file in a folder and calculates star rating and pp for a
+set of common mod combinations, reporting parse and calculation times. If no
+folder is given, a set of synthetic beatmaps is generated instead.
+
+Usage:
+    python benchmarks/bench_calc.py [--synthetic N] [folder]
+"""
+import argparse
+import glob
+import os.path
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from gumiyabot import calc  # noqa: E402
+
+
+MODS = {
+    'NM': 0,
+    'HD': 8,
+    'HR': 16,
+    'DT': 64,
+    'HDDT': 72,
+    'HDHR': 24,
+}
+
+
+def synthetic_map(n_objects, bpm, seed):
+    """Return .osu file contents with a mix of streams, jumps and sliders"""
+    rng = random.Random(seed)
+    beat = 60000.0 / bpm
+    lines = [
+        'osu file format v14', '',
+        '[General]', 'Mode: 0', '',
+        '[Difficulty]', 'HPDrainRate:5', 'CircleSize:4', 'OverallDifficulty:8', 'ApproachRate:9',
+        'SliderMultiplier:1.8', 'SliderTickRate:1', '',
+        '[TimingPoints]', '0,{:f},4,2,0,50,1,0'.format(beat), '30000,-75,4,2,0,50,0,0', '',
+        '[HitObjects]',
+    ]
+    t = 1000.0
+    (x, y) = (256, 192)
+    for _ in range(n_objects):
+        r = rng.random()
+        if r < .6:
+            t += beat / 4
+            x = min(512, max(0, x + rng.randint(-30, 30)))
+            y = min(384, max(0, y + rng.randint(-30, 30)))
+            lines.append('{},{},{:.0f},1,0,0:0:0:0:'.format(x, y, t))
+        elif r < .9:
+            t += beat / 2
+            (x, y) = (rng.randint(0, 512), rng.randint(0, 384))
+            lines.append('{},{},{:.0f},1,0,0:0:0:0:'.format(x, y, t))
+        else:
+            t += beat
+            (x, y) = (rng.randint(0, 400), rng.randint(0, 384))
+            lines.append('{},{},{:.0f},2,0,B|{}:{},2,100'.format(x, y, t, x + 100, y))
+            t += beat
+    return '\n'.join(lines).encode('utf-8')
+
+
+def load_maps(args):
+    if args.folder:
+        maps = []
+        for path in sorted(glob.glob(os.path.join(args.folder, '*.osu'))):
+            with open(path, 'rb') as f:
+                maps.append((os.path.basename(path), f.read()))
+        return maps
+    rng = random.Random(0)
+    return [
+        ('synthetic-{}'.format(i), synthetic_map(rng.randint(200, 3000), rng.choice([150, 180, 220, 260]), i))
+        for i in range(args.synthetic)
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline difficulty/pp calculator benchmark')
+    parser.add_argument('folder', nargs='?', help='Folder containing .osu files')
+    parser.add_argument('--synthetic', type=int, default=20,
+                        help='Number of synthetic maps to generate when no folder is given')
+    args = parser.parse_args()
+    if not calc.available():
+        sys.exit('NumPy is required (pip install gumiyabot[calc])')
+
+    maps = load_maps(args)
+    if not maps:
+        sys.exit('No .osu files found')
+
+    parse_time = 0.0
+    calc_time = 0.0
+    calculations = 0
+    objects = 0
+    for (name, data) in maps:
+        start = time.perf_counter()
+        try:
+            osu = calc.parse_osu_file(data)
+        except calc.CalculationError as e:
+            print('{}: skipped ({})'.format(name, e))
+            continue
+        parse_time += time.perf_counter() - start
+        objects += osu.n_objects
+        results = []
+        for (mod_name, mods) in MODS.items():
+            start = time.perf_counter()
+            info = calc.beatmap_info(osu, mods)
+            calc_time += time.perf_counter() - start
+            calculations += 1
+            results.append('{} {:.2f}* {:.0f}pp'.format(mod_name, info['starDiff'], info['ppForAcc'][1.0]))
+        print('{} ({} objects, x{}): {}'.format(name, osu.n_objects, osu.max_combo, ', '.join(results)))
+
+    print()
+    print('{} maps, {:,} hit objects'.format(len(maps), objects))
+    print('parse: {:8.2f} ms total, {:6.2f} ms/map'.format(parse_time * 1000, parse_time * 1000 / len(maps)))
+    if calculations:
+        print('calc:  {:8.2f} ms total, {:6.2f} ms/calculation, {:,.0f} hit objects/s'.format(
+            calc_time * 1000, calc_time * 1000 / calculations, objects * len(MODS) / calc_time))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+"""
+Micro-benchmark for Bancho line framing.
+
+Replays a sample of Bancho traffic (bare \\n line endings) split into
+randomly sized chunks, and compares the old split/join approach used by
+BanchoConnection against gumiyabot.bancho.LineFramer.
+
+Usage:
+    python benchmarks/bench_framer.py [--repeat N] [--chunk-size N] [sample_file]
+"""
+import argparse
+import os.path
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from gumiyabot.bancho import LineFramer  # noqa: E402
+
+
+DEFAULT_SAMPLE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'bancho_sample.txt')
+
+
+def split_chunks(data, max_chunk_size, seed=0):
+    rng = random.Random(seed)
+    chunks = []
+    pos = 0
+    while pos < len(data):
+        size = rng.randint(1, max_chunk_size)
+        chunks.append(data[pos:pos + size])
+        pos += size
+    return chunks
+
+
+def old_framing(chunks):
+    """Previous BanchoConnection + irc3.IrcConnection behaviour"""
+    lines = []
+    queue = []
+    for data in chunks:
+        if not data.endswith(b'\r\n'):
+            data = b'\r\n'.join(line for line in data.split(b'\n'))
+        data = data.decode('utf8', 'ignore')
+        if queue:
+            data = queue.pop() + data
+        split = data.split('\r\n')
+        queue.append(split.pop(-1))
+        lines.extend(split)
+    return lines
+
+
+def new_framing(chunks):
+    framer = LineFramer()
+    lines = []
+    for data in chunks:
+        lines.extend(framer.feed(data))
+    return lines
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Bancho line framer micro-benchmark')
+    parser.add_argument('sample_file', nargs='?', default=DEFAULT_SAMPLE)
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--chunk-size', type=int, default=4096, dest='chunk_size',
+                        help='Maximum size of a single read')
+    args = parser.parse_args()
+
+    with open(args.sample_file, 'rb') as f:
+        data = f.read()
+    chunks = split_chunks(data, args.chunk_size)
+    expected = [line for line in data.decode('utf8').split('\n') if line]
+    print('sample: {} bytes, {} lines, {} reads'.format(len(data), len(expected), len(chunks)))
+
+    new_lines = new_framing(chunks)
+    if new_lines != expected:
+        sys.exit('LineFramer output does not match sample')
+    old_lines = [line for line in old_framing(chunks) if line]
+    if old_lines != expected:
+        print('note: split/join framing corrupted {} lines'.format(
+            sum(1 for (a, b) in zip(old_lines, expected) if a != b) + abs(len(old_lines) - len(expected))))
+
+    for name, func in (('split/join', old_framing), ('LineFramer', new_framing)):
+        best = min(timeit.repeat(lambda: func(chunks), number=1, repeat=args.repeat))
+        print('{:>10}: {:8.3f} ms/pass, {:10,.0f} lines/s, {:8.1f} MB/s'.format(
+            name, best * 1000, len(expected) / best, len(data) / best / 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark for the Twitch PRIVMSG link matching hot path.
+
+Runs a synthetic chat corpus (mostly regular chat, with a small share of
+beatmap links) through BaseTwitchPlugin.request_beatmap and reports messages
+per second. The osu! API callbacks are stubbed out, so only message matching
+and mod parsing are measured. The previous three-regex implementation is
+measured as well for comparison.
+
+Usage:
+    python benchmarks/bench_matcher.py [--messages N] [--link-ratio R]
+"""
+import argparse
+import asyncio
+import logging
+import os.path
+import random
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from irc3.utils import IrcString  # noqa: E402
+from osuapi.enums import OsuMod  # noqa: E402
+
+from gumiyabot.twitch import BaseTwitchPlugin  # noqa: E402
+
+
+WORDS = (
+    'PogChamp Kappa LUL KEKW monkaS OMEGALUL 727 gg wp nice fc choke when you see it is this ranked '
+    'what skin what tablet farm map jump aim stream tech hd dt hr ez play that again pp rank'
+).split()
+
+LINKS = [
+    'https://osu.ppy.sh/b/{beatmap_id}',
+    'https://osu.ppy.sh/b/{beatmap_id} +HDDT',
+    'https://osu.ppy.sh/s/{mapset_id}',
+    'http://osu.ppy.sh/s/{mapset_id} HR',
+    'https://osu.ppy.sh/beatmapsets/{mapset_id}#osu/{beatmap_id}',
+    'https://osu.ppy.sh/beatmapsets/{mapset_id}#osu/{beatmap_id} +hdhr',
+    'https://osu.ppy.sh/beatmapsets/{mapset_id}',
+]
+
+
+class FakeBot(object):
+
+    def __init__(self):
+        self.config = {
+            'twitch_channel': 'gumiyabot',
+            'bancho_nick': 'GumiyaBot',
+            'osu_api_key': '',
+            'bancho_queue': asyncio.Queue(),
+        }
+        self.log = logging.getLogger('bench')
+
+    def privmsg(self, target, msg):
+        pass
+
+
+class BenchTwitchPlugin(BaseTwitchPlugin):
+
+    def __init__(self, bot):
+        super(BenchTwitchPlugin, self).__init__(bot)
+        self.requests = 0
+
+    async def _request_beatmap(self, match, mask, target, mods=OsuMod.NoMod, **kwargs):
+        self.requests += 1
+        return (None, None)
+
+    async def _request_mapset(self, match, mask, target, mods=OsuMod.NoMod, **kwargs):
+        self.requests += 1
+        return (None, None)
+
+    async def legacy_request_beatmap(self, tags=None, mask=None, target=None, data=None, **kwargs):
+        """Previous request_beatmap matching logic"""
+        if not target.is_channel or not data:
+            return
+        patterns = [
+            (r'https?://osu\.ppy\.sh/b/(?P<beatmap_id>\d+)',
+             self._request_beatmap),
+            (r'https?://osu\.ppy\.sh/s/(?P<mapset_id>\d+)',
+             self._request_mapset),
+            (r'https?://osu\.ppy\.sh/beatmapsets/(?P<mapset_id>\d+)(#(?P<mode>[a-z]+))?(/(?P<beatmap_id>\d+))?',
+             self._request_beatmapsets),
+        ]
+        for pattern, callback in patterns:
+            mod_pattern = r'(/?\s*\+?(?P<mods>[A-Za-z]+))?'
+            m = re.search(''.join([pattern, mod_pattern]), data)
+            if m:
+                if m.group('mods'):
+                    mods = m.group('mods')
+                    mod_dict = {
+                        'NF': OsuMod.NoFail, 'EZ': OsuMod.Easy, 'HD': OsuMod.Hidden, 'HR': OsuMod.HardRock,
+                        'SD': OsuMod.SuddenDeath, 'DT': OsuMod.DoubleTime, 'RX': OsuMod.Relax,
+                        'HT': OsuMod.HalfTime, 'NC': OsuMod.Nightcore, 'FL': OsuMod.Flashlight,
+                        'SO': OsuMod.SpunOut, 'AP': OsuMod.Autopilot, 'PF': OsuMod.Perfect,
+                    }
+                    if (len(mods) % 2) != 0:
+                        mods = mods[:-1]
+                    mod_flags = OsuMod.NoMod
+                    for mod in [mods.upper()[i:i + 2] for i in range(0, len(mods), 2)]:
+                        mod_flags |= mod_dict.get(mod, OsuMod.NoMod)
+                else:
+                    mod_flags = OsuMod.NoMod
+                await callback(m, mask, target, mods=mod_flags, **kwargs)
+                break
+
+
+def make_corpus(count, link_ratio, seed=0):
+    rng = random.Random(seed)
+    corpus = []
+    for _ in range(count):
+        words = [rng.choice(WORDS) for _ in range(rng.randint(1, 16))]
+        if rng.random() < link_ratio:
+            link = rng.choice(LINKS).format(
+                beatmap_id=rng.randint(1, 4000000),
+                mapset_id=rng.randint(1, 2000000))
+            words.insert(rng.randint(0, len(words)), link)
+        corpus.append(' '.join(words))
+    return corpus
+
+
+async def run_corpus(handler, corpus, target, mask):
+    start = time.perf_counter()
+    for data in corpus:
+        await handler(tags=None, mask=mask, target=target, data=data)
+    return time.perf_counter() - start
+
+
+async def bench(args):
+    plugin = BenchTwitchPlugin(FakeBot())
+    corpus = make_corpus(args.messages, args.link_ratio)
+    target = IrcString('#gumiyabot')
+    mask = IrcString('viewer!viewer@viewer.tmi.twitch.tv')
+    print('corpus: {:,} messages, {:.1%} with links'.format(len(corpus), args.link_ratio))
+
+    results = {}
+    for name, handler in (('legacy', plugin.legacy_request_beatmap), ('current', plugin.request_beatmap)):
+        plugin.requests = 0
+        best = min([await run_corpus(handler, corpus, target, mask) for _ in range(args.repeat)])
+        results[name] = plugin.requests // args.repeat
+        print('{:>8}: {:8.1f} ms, {:12,.0f} msg/s, {} link requests'.format(
+            name, best * 1000, len(corpus) / best, results[name]))
+    if results['legacy'] != results['current']:
+        print('warning: legacy and current matchers found a different number of links')
+    for task in asyncio.all_tasks():
+        if task is not asyncio.current_task():
+            task.cancel()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Twitch PRIVMSG link matching benchmark')
+    parser.add_argument('--messages', type=int, default=100000)
+    parser.add_argument('--link-ratio', type=float, default=.01, dest='link_ratio')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+    asyncio.get_event_loop().run_until_complete(bench(args))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,83 +1,69 @@
 # -*- coding: utf-8 -*-
 import argparse
-import asyncio
-import configparser
 import os.path
 import sys
-
-import irc3
-
-from .bancho import BanchoConnection
-
-
-def run(config_file='config.ini', debug=False):
-    config = configparser.ConfigParser()
-    config.read(config_file)
-    if 'gumiya' not in config:
-        sys.exit('Error: Invalid config, missing [gumiya] section')
-    gumiya_config = config['gumiya']
-
-    loop = asyncio.get_event_loop()
-    bancho_queue = asyncio.Queue()
-
-    config_common = {
-        'irc3.plugins.command': {
-            'hash': '#',
-            'cmd': '!',
-            'guard': 'irc3.plugins.command.mask_based_policy',
-        },
-        'irc3.plugins.command.masks': {
-            'hash': '#',
-            '*': 'view',
-        },
-    }
-    if debug:
-        config_common['debug'] = True
-
-    twitch_config = dict(
-        host='irc.chat.twitch.tv',
-        port=6667,
-        includes=[
-            'irc3.plugins.core',
-            'irc3.plugins.autocommand',
-            'irc3.plugins.command',
-            'irc3.plugins.log',
-            'gumiyabot.twitch',
-        ],
-        autocommands=[
-            'CAP REQ :twitch.tv/membership',
-            'CAP REQ :twitch.tv/commands',
-            'CAP REQ :twitch.tv/tags',
-        ],
-        nick=gumiya_config['twitch_username'],
-        password=gumiya_config['twitch_password'],
-        osu_api_key=gumiya_config['osu_api_key'],
-        tillerino_api_key=gumiya_config.get('tillerino_api_key', fallback=''),
-        bancho_nick=gumiya_config['bancho_username'],
-        twitch_channel=gumiya_config['twitch_channel'],
-    )
-    twitch_config.update(config_common)
-
-    bancho_config = dict(
-        host='irc.ppy.sh',
-        port=6667,
-        includes=[
-            'irc3.plugins.core',
-            'irc3.plugins.command',
-            'irc3.plugins.log',
-            'gumiyabot.bancho',
-        ],
-        nick=gumiya_config['bancho_username'],
-        password=gumiya_config['bancho_password'],
-    )
-    bancho_config.update(config_common)
-    twitch_bot = irc3.IrcBot(loop=loop, bancho_queue=bancho_queue, **twitch_config)
+import time
+
+# startup profiling measures from here
+_started = time.monotonic()
+
+
+def run(config_file='config.ini', debug=False, profile_startup=False):
+    # irc3, aiohttp and the bot plugins are only imported once they are needed
+    import irc3
+
+    from .bancho import BanchoConnection
+    from .config import (
+        load_config, make_bancho_config, make_bancho_queue, make_caches, make_http_client, make_twitch_config,
+        open_metrics, open_store, setup_logging)
+    from .startup import StartupProfiler, new_event_loop
+
+    profiler = StartupProfiler(started=_started) if profile_startup else None
+    (gumiya_config, twitch_channels) = load_config(config_file)
+    shards = gumiya_config.getint('shards', fallback=1)
+    if shards > 1:
+        from .shard import run_sharded
+        return run_sharded(config_file, shards, debug=debug, profiler=profiler)
+
+    loop = new_event_loop(gumiya_config.get('event_loop', fallback='asyncio'))
+    if profiler is not None:
+        profiler.mark('config loaded')
+    bancho_queue = make_bancho_queue(gumiya_config)
+    http_client = make_http_client(gumiya_config)
+    caches = make_caches(gumiya_config)
+    store = open_store(loop, gumiya_config, caches)
+    (registry, metrics_server) = open_metrics(loop, gumiya_config)
+
+    twitch_config = make_twitch_config(gumiya_config, twitch_channels, debug=debug)
+    twitch_bot = irc3.IrcBot(loop=loop, bancho_queue=bancho_queue, http_client=http_client, store=store,
+                             metrics=registry, **caches, **twitch_config)
+    bancho_config = make_bancho_config(gumiya_config, debug=debug)
+    bancho_bot = irc3.IrcBot(loop=loop, bancho_queue=bancho_queue, connection=BanchoConnection, metrics=registry,
+                             **bancho_config)
+    if profiler is not None:
+        profiler.mark('bots created')
+        profiler.attach(twitch_bot, 'twitch', joins=True)
+        profiler.attach(bancho_bot, 'bancho')
+        if store is not None:
+            store.warmup.add_done_callback(lambda fut: profiler.mark('cache warmed'))
+    # both connections (and the cache warmup) proceed concurrently once the loop runs
     twitch_bot.run(forever=False)
-
-    bancho_bot = irc3.IrcBot(loop=loop, bancho_queue=bancho_queue, connection=BanchoConnection, **bancho_config)
     bancho_bot.run(forever=False)
-
-    loop.run_forever()
+    log_queue = setup_logging(gumiya_config, debug=debug)
+
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if metrics_server is not None:
+            loop.run_until_complete(metrics_server.close())
+        if store is not None:
+            loop.run_until_complete(store.close())
+        loop.run_until_complete(bancho_queue.close())
+        loop.run_until_complete(http_client.close())
+        if log_queue is not None:
+            log_queue.stop()
 
 
 def generate_config(filename='config.ini'):
@@ -129,8 +115,12 @@ osu_api_key =
 
 
 def main():
+    if sys.argv[1:2] == ['bench']:
+        from .bench import main as bench_main
+        return bench_main(sys.argv[2:])
     parser = argparse.ArgumentParser(description='Twitch+Bancho IRC bot for handling osu! map requests',
-                                     prog='gumiyabot')
+                                     prog='gumiyabot',
+                                     epilog='Run "gumiyabot bench --help" to load test the bot against fake servers')
     parser.add_argument('--new-config', action='store_true', dest='new_config',
                         help='Generate a new default config.ini')
     parser.add_argument('config_file', nargs='?', default='config.ini',
@@ -138,13 +128,15 @@ def main():
                               ' in the current working directory'))
     parser.add_argument('-d', '--debug', '--verbose', action='store_true', dest='debug',
                         help='Verbose debugging output')
+    parser.add_argument('--profile-startup', action='store_true', dest='profile_startup',
+                        help='Report how long startup took, up to the first joined Twitch channel')
     args = parser.parse_args()
     if args.new_config:
         generate_config()
     else:
         if not os.path.exists(args.config_file):
             parser.error('could not find configuration file')
-        run(config_file=args.config_file, debug=args.debug)
+        run(config_file=args.config_file, debug=args.debug, profile_startup=args.profile_startup)
 
 
 if __name__ == '__main__':
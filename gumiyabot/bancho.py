@@ -6,21 +6,66 @@ import asyncio
 
 import irc3
 
+from . import metrics
+
+
+class LineFramer(object):
+    """Incremental IRC line framer.
+
+    Accepts both ``\r\n`` and bare ``\n`` line endings. Partial lines are
+    kept in a buffer and completed by later reads. Complete lines are decoded
+    in a single pass straight from the received data, without rebuilding the
+    chunk. Partial lines longer than max_line_length are discarded.
+    """
+
+    def __init__(self, max_line_length=64 * 1024):
+        self.max_line_length = max_line_length
+        self.buffer = bytearray()
+
+    def feed(self, data, encoding='utf8'):
+        """Return a list of complete decoded lines after appending data"""
+        if self.buffer:
+            self.buffer += data
+            data = self.buffer
+        end = data.rfind(b'\n')
+        if end < 0:
+            if data is not self.buffer:
+                self.buffer += data
+            if len(self.buffer) > self.max_line_length:
+                self.buffer.clear()
+            return []
+        # decode every complete line in one pass, straight from the buffer
+        with memoryview(data) as view:
+            text = str(view[:end], encoding, 'ignore')
+        if data is self.buffer:
+            del self.buffer[:end + 1]
+        else:
+            self.buffer += data[end + 1:]
+        if len(self.buffer) > self.max_line_length:
+            self.buffer.clear()
+        if '\r' in text:
+            return [line.rstrip('\r') for line in text.split('\n') if line.rstrip('\r')]
+        return [line for line in text.split('\n') if line]
+
 
 # Bancho does not comply with the IRC spec (thanks peppy) so we need to account
 # for that or else the irc3 module will not read any data
 class BanchoConnection(irc3.IrcConnection):
     """asyncio protocol to handle Bancho connections"""
 
+    def connection_made(self, transport):
+        super().connection_made(transport)
+        self.framer = LineFramer()
+
     def data_received(self, data):
         """Handle data received from Bancho.
 
         Bancho does not send trailing carriage returns at the end of IRC
-        commands (i.e. it ends a command with \n instead of \r\n).
+        commands (i.e. it ends a command with \n instead of \r\n), so lines
+        are framed here and dispatched to irc3 directly.
         """
-        if not data.endswith(b'\r\n'):
-            data = b"\r\n".join(line for line in data.split(b"\n"))
-        return super().data_received(data)
+        for line in self.framer.feed(data, getattr(self, 'encoding', 'ascii')):
+            self.factory.dispatch(line)
 
 
 @irc3.plugin
@@ -29,13 +74,64 @@ class BaseBanchoPlugin:
     def __init__(self, bot):
         self.bot = bot
         self.bancho_queue = self.bot.config.get('bancho_queue')
+        # set while the Bancho connection is up, delivery pauses otherwise
+        self.online = asyncio.Event()
         asyncio.ensure_future(self.get_bancho_msg())
+        stats_interval = int(self.bot.config.get('bancho_stats_interval', 0))
+        if stats_interval and hasattr(self.bancho_queue, 'stats'):
+            asyncio.ensure_future(self.log_queue_stats(stats_interval))
+        registry = self.bot.config.get('metrics')
+        if registry is not None and hasattr(self.bancho_queue, 'stats'):
+            self.wait_histogram = registry.histogram(
+                'bancho_queue_wait_seconds', 'Time Bancho messages spent in the outbound queue')
+            self.e2e_histogram = registry.histogram(
+                'request_end_to_end_seconds', 'Time from a map link in chat until the Bancho message was sent')
+            self.bancho_queue.on_sent = self.observe_sent
+            registry.add_collector(lambda: metrics.bancho_queue_metrics(self.bancho_queue.stats()))
+
+    def observe_sent(self, wait, latency):
+        self.wait_histogram.observe(wait)
+        self.e2e_histogram.observe(latency)
 
     @irc3.event(irc3.rfc.CONNECTED)
     def connected(self, **kw):
-        self.bot.log.info('[bancho] Connected to bancho as {}'.format(self.bot.nick))
+        self.bot.log.info('[bancho] Connected to bancho as %s', self.bot.nick)
+        self.online.set()
+
+    def connection_lost(self):
+        if self.online.is_set():
+            self.bot.log.info('[bancho] Disconnected from bancho, pausing map requests')
+        self.online.clear()
+
+    def _requeue(self, target, msg):
+        if hasattr(self.bancho_queue, 'requeue'):
+            self.bancho_queue.requeue()
+        else:
+            self.bancho_queue.put_nowait((target, msg))
 
     async def get_bancho_msg(self):
         while True:
+            await self.online.wait()
             (target, msg) = await self.bancho_queue.get()
-            self.bot.privmsg(target, msg)
+            if not self.online.is_set():
+                # disconnected while waiting for the rate limit, send it after reconnecting
+                self._requeue(target, msg)
+                continue
+            written = self.bot.privmsg(target, msg)
+            if written is not None:
+                # resolved once irc3 writes the line to the connection
+                await written
+            if not self.online.is_set():
+                # the line may have been written to a dead connection
+                self._requeue(target, msg)
+            elif hasattr(self.bancho_queue, 'ack'):
+                self.bancho_queue.ack()
+
+    async def log_queue_stats(self, interval):
+        while True:
+            await asyncio.sleep(interval)
+            stats = self.bancho_queue.stats()
+            self.bot.log.info(
+                '[bancho] queue depth %(depth)s (max %(max_depth)s), sent %(sent)s, deduplicated %(deduplicated)s, '
+                'expired %(expired)s, dropped %(dropped)s, requeued %(requeued)s, wait p50 %(wait_p50).2fs '
+                'p95 %(wait_p95).2fs max %(wait_max).2fs, rate limit stalls %(rate_limit_stalls)s', stats)
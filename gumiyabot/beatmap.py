@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+"""
+Compact immutable beatmap records.
+"""
+import datetime
+import enum
+
+from osuapi.enums import OsuMod
+from osuapi.model import Beatmap
+
+
+_DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+# mod adjusted records kept per beatmap, one per mod combination
+MAX_MODDED = 16
+
+_SPEED_MODS = (OsuMod.DoubleTime | OsuMod.Nightcore).value
+
+
+def value_to_json(value):
+    """Convert an osuapi model attribute value back into its osu! API JSON form"""
+    if isinstance(value, enum.Enum):
+        return value.value
+    elif isinstance(value, bool):
+        return int(value)
+    elif isinstance(value, datetime.datetime):
+        return value.strftime(_DATE_FORMAT)
+    elif hasattr(value, '__flags_members__'):
+        # osuapi Flags (i.e. OsuMod)
+        return value.value
+    return value
+
+
+def _scale_length(length, speed_mul):
+    if length is None:
+        return None
+    return int(round(length / speed_mul))
+
+
+def _speed_multiplier(mods):
+    speed = bool(mods & _SPEED_MODS)
+    half_time = bool(mods & OsuMod.HalfTime.value)
+    if speed and not half_time:
+        return 1.5
+    elif half_time and not speed:
+        return .75
+    return 1.0
+
+
+def mod_difficulty(cs, od, ar, hp, mods):
+    """Return mod adjusted (cs, od, ar, hp, speed multiplier)
+
+    Conflicting mods cancel out: DT (or NC) with HT does not change the
+    speed, HR with EZ does not change cs, od, ar or hp.
+    """
+    speed_mul = _speed_multiplier(mods)
+    hard_rock = bool(mods & OsuMod.HardRock.value)
+    easy = bool(mods & OsuMod.Easy.value)
+    if hard_rock and not easy:
+        od_ar_hp_mul = 1.4
+        cs_mul = 1.3
+    elif easy and not hard_rock:
+        od_ar_hp_mul = .5
+        cs_mul = .5
+    else:
+        od_ar_hp_mul = 1.0
+        cs_mul = 1.0
+    cs = min(10.0, cs * cs_mul)
+    hp = min(10.0, hp * od_ar_hp_mul)
+
+    ar = min(10.0, ar * od_ar_hp_mul)
+    ar_ms = 1800 - 120 * ar if ar < 5 else 1200 - 150 * (ar - 5)
+    ar_ms /= speed_mul
+    ar = (1800 - ar_ms) / 120 if ar_ms > 1200 else 5 + (1200 - ar_ms) / 150
+
+    od = min(10.0, od * od_ar_hp_mul)
+    od_ms = (80 - 6 * od) / speed_mul
+    od = (80 - od_ms) / 6
+    return (cs, od, ar, hp, speed_mul)
+
+
+class BeatmapRecord(object):
+    """Immutable beatmap holding the osu! API fields used by the bot
+
+    Records are created from osuapi Beatmap models with from_model() (or
+    from osu! API JSON with from_dict()) and are never changed afterwards,
+    so cached records can be shared by concurrent requests.
+
+    with_mods() returns a record with mod adjusted AR, OD, HP, CS, BPM and
+    length, computed once per mod combination and memoized on the unmodded
+    record. with_pp() returns a record with pp (a dict of accuracy -> pp,
+    or None) and optionally the mod adjusted star rating set. The pp
+    attribute is only set on records returned by with_pp().
+    """
+
+    FIELDS = (
+        'beatmap_id', 'beatmapset_id', 'approved', 'approved_date', 'last_update', 'mode', 'artist', 'title',
+        'version', 'creator', 'creator_id', 'bpm', 'difficultyrating', 'diff_size', 'diff_overall',
+        'diff_approach', 'diff_drain', 'hit_length', 'total_length', 'max_combo', 'playcount', 'passcount',
+        'favourite_count', 'file_md5',
+    )
+
+    __slots__ = FIELDS + ('mods', 'pp', '_base', '_modded')
+
+    def __init__(self, **fields):
+        for name in self.FIELDS:
+            object.__setattr__(self, name, fields.get(name))
+        object.__setattr__(self, 'mods', OsuMod.NoMod)
+        object.__setattr__(self, '_base', self)
+        object.__setattr__(self, '_modded', {})
+
+    @classmethod
+    def from_model(cls, beatmap):
+        """Return a record for an osuapi Beatmap (records are returned as is)"""
+        if isinstance(beatmap, cls):
+            return beatmap
+        # unset osuapi model attributes fall back to class level defaults,
+        # so only read values which were actually set
+        values = vars(beatmap)
+        attributes = type(beatmap).__attributemodel__
+        return cls(**{
+            name: values.get(attributes[name].field_name)
+            for name in cls.FIELDS if name in attributes
+        })
+
+    @classmethod
+    def from_dict(cls, data):
+        """Return a record for osu! API get_beatmaps JSON"""
+        return cls.from_model(Beatmap(data))
+
+    def to_dict(self):
+        """Return the osu! API JSON for the unmodded beatmap"""
+        return {name: value_to_json(getattr(self._base, name)) for name in self.FIELDS}
+
+    def __setattr__(self, name, value):
+        raise AttributeError('{} is immutable'.format(type(self).__name__))
+
+    def __delattr__(self, name):
+        raise AttributeError('{} is immutable'.format(type(self).__name__))
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def __repr__(self):
+        return '<{} beatmap_id={} mods={}>'.format(type(self).__name__, self.beatmap_id, self.mods.value)
+
+    @property
+    def base(self):
+        """The unmodded record this record was derived from (or this record)"""
+        return self._base
+
+    def _replace(self, **changes):
+        record = object.__new__(type(self))
+        for name in self.__slots__:
+            if name in changes:
+                object.__setattr__(record, name, changes[name])
+            elif hasattr(self, name):
+                object.__setattr__(record, name, getattr(self, name))
+        return record
+
+    def with_mods(self, mods=OsuMod.NoMod):
+        """Return the (memoized) record with difficulty modifiers applied
+
+        Mods are always applied to the unmodded beatmap.
+        """
+        base = self._base
+        if mods == OsuMod.NoMod:
+            return base
+        modded = base._modded.get(mods.value)
+        if modded is None:
+            (cs, od, ar, hp, speed_mul) = mod_difficulty(
+                base.diff_size, base.diff_overall, base.diff_approach, base.diff_drain, mods.value)
+            modded = base._replace(
+                mods=mods,
+                bpm=base.bpm * speed_mul,
+                diff_size=cs,
+                diff_overall=od,
+                diff_approach=ar,
+                diff_drain=hp,
+                hit_length=_scale_length(base.hit_length, speed_mul),
+                total_length=_scale_length(base.total_length, speed_mul),
+                _modded=None,
+            )
+            if len(base._modded) >= MAX_MODDED:
+                base._modded.pop(next(iter(base._modded)))
+            base._modded[mods.value] = modded
+        return modded
+
+    def with_pp(self, pp, stars=None):
+        """Return a copy of this record with pp (and the mod adjusted star rating) set"""
+        if stars is None:
+            return self._replace(pp=pp)
+        return self._replace(pp=pp, difficultyrating=stars)
@@ -0,0 +1,594 @@
+# -*- coding: utf-8 -*-
+"""
+Offline load test harness.
+
+``gumiyabot bench`` runs the bot against local stand-ins for Twitch IRC,
+Bancho IRC (which uses bare \\n line endings, like the real Bancho), the
+osu! API and the Tillerino API, replays a synthetic or recorded chat log
+at a target rate and reports throughput, request latency and memory use.
+
+The fake servers run in the same process and event loop as the bot, so
+results are only comparable between runs on the same machine.
+"""
+import argparse
+import asyncio
+import collections
+import configparser
+import itertools
+import json
+import logging
+import random
+import re
+import sys
+import time
+
+try:
+    import resource
+except ImportError:  # pragma: no cover
+    resource = None
+
+import irc3
+from aiohttp import web
+
+from .bancho import BanchoConnection
+from .config import make_bancho_config, make_bancho_queue, make_caches, make_http_client, make_twitch_config
+from .twitch import LINK_PATTERN, BaseTwitchPlugin
+from .utils import percentile
+
+
+log = logging.getLogger(__name__)
+
+BENCH_CHANNEL = '#bench'
+BENCH_TWITCH_NICK = 'gumiyabench'
+BENCH_BANCHO_NICK = 'GumiyaBench'
+
+# beatmap ids handed out by the fake osu! API, every mapset has
+# DIFFS_PER_MAPSET difficulties
+FIRST_BEATMAP_ID = 1000000
+DIFFS_PER_MAPSET = 4
+
+IRC_PRIVMSG = re.compile(r'^(?:@\S+ )?:(?P<nick>[^!\s]+)\S* PRIVMSG \S+ :(?P<text>.*)$')
+LOG_LINE = re.compile(r'^(?:\[[^\]]*\]\s*)?<?(?P<nick>[^\s>:]+)>?:?\s+(?P<text>.*)$')
+
+
+class FakeIrcServer(object):
+    """Minimal IRC server which accepts any login
+
+    Every line sent to clients ends with line_ending. on_privmsg(target, text)
+    is called for every PRIVMSG sent by a client.
+    """
+
+    def __init__(self, name, line_ending=b'\r\n', on_privmsg=None):
+        self.name = name
+        self.line_ending = line_ending
+        self.on_privmsg = on_privmsg
+        self.server = None
+        self.writers = set()
+        self.registered = set()
+        self.joined = set()
+        self.received = 0
+
+    async def start(self, host='127.0.0.1', port=0):
+        """Start listening and return the port the server is bound to"""
+        self.server = await asyncio.start_server(self._client, host, port)
+        return self.server.sockets[0].getsockname()[1]
+
+    async def close(self):
+        for writer in list(self.writers):
+            writer.close()
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+
+    def _send(self, writer, line):
+        writer.write(line.encode('utf-8') + self.line_ending)
+
+    def broadcast(self, line):
+        for writer in self.writers:
+            self._send(writer, line)
+
+    async def _client(self, reader, writer):
+        self.writers.add(writer)
+        nick = '*'
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                self.received += 1
+                (command, _, params) = line.decode('utf-8', 'ignore').rstrip('\r\n').partition(' ')
+                command = command.upper()
+                if command == 'NICK':
+                    nick = params.lstrip(':')
+                    self.registered.add(nick)
+                    self._send(writer, ':{0} 001 {1} :Welcome to {0}'.format(self.name, nick))
+                    self._send(writer, ':{} 376 {} :End of /MOTD command.'.format(self.name, nick))
+                elif command == 'PING':
+                    self._send(writer, ':{} PONG {}'.format(self.name, params))
+                elif command == 'JOIN':
+                    for channel in params.lstrip(':').split(','):
+                        self.joined.add(channel.lower())
+                        self._send(writer, ':{0}!{0}@{1} JOIN {2}'.format(nick, self.name, channel))
+                elif command == 'PRIVMSG':
+                    (target, _, text) = params.partition(' ')
+                    if self.on_privmsg is not None:
+                        self.on_privmsg(target, text[1:] if text.startswith(':') else text)
+                elif command == 'QUIT':
+                    break
+                await writer.drain()
+        except ConnectionError as e:
+            log.debug('[bench] %s: %s', self.name, e)
+        except asyncio.CancelledError:
+            # asyncio logs an error for cancelled client handlers
+            pass
+        finally:
+            self.writers.discard(writer)
+            writer.close()
+
+
+def fake_beatmap(beatmap_id):
+    """Return osu! API get_beatmaps JSON for a fake beatmap"""
+    rng = random.Random(beatmap_id)
+    diff = beatmap_id % DIFFS_PER_MAPSET
+    length = rng.randint(60, 300)
+    return {
+        'approved': '1',
+        'approved_date': '2018-01-01 00:00:00',
+        'submit_date': '2017-12-01 00:00:00',
+        'last_update': '2017-12-24 00:00:00',
+        'artist': 'Artist {}'.format(beatmap_id // DIFFS_PER_MAPSET),
+        'artist_unicode': None,
+        'beatmap_id': str(beatmap_id),
+        'beatmapset_id': str(beatmap_id // DIFFS_PER_MAPSET),
+        'bpm': str(rng.choice([120, 150, 180, 200, 222])),
+        'creator': 'Mapper',
+        'creator_id': '1',
+        'difficultyrating': '{:.4f}'.format(2 + diff + rng.random()),
+        'diff_aim': '2.5',
+        'diff_speed': '2.5',
+        'diff_size': '4',
+        'diff_overall': str(6 + diff),
+        'diff_approach': str(6 + diff),
+        'diff_drain': '5',
+        'hit_length': str(length - 5),
+        'source': '',
+        'genre_id': '1',
+        'language_id': '1',
+        'title': 'Title {}'.format(beatmap_id // DIFFS_PER_MAPSET),
+        'title_unicode': None,
+        'total_length': str(length),
+        'version': 'Diff {}'.format(diff),
+        'file_md5': '{:032x}'.format(beatmap_id),
+        'mode': '0',
+        'tags': 'bench',
+        'favourite_count': '10',
+        'rating': '9.5',
+        'playcount': '1000',
+        'passcount': '100',
+        'count_normal': '500',
+        'count_slider': '200',
+        'count_spinner': '2',
+        'max_combo': '900',
+        'storyboard': '0',
+        'video': '0',
+        'download_unavailable': '0',
+        'audio_unavailable': '0',
+        'packs': None,
+    }
+
+
+def fake_user(username):
+    """Return osu! API get_user JSON for a fake user"""
+    user_id = sum(map(ord, username))
+    return {
+        'user_id': str(user_id),
+        'username': username,
+        'join_date': '2015-01-01 00:00:00',
+        'count300': '1000000',
+        'count100': '100000',
+        'count50': '10000',
+        'playcount': '10000',
+        'ranked_score': '1000000000',
+        'total_score': '5000000000',
+        'pp_rank': str(user_id),
+        'level': '100.5',
+        'pp_raw': '5000',
+        'accuracy': '98.5',
+        'count_rank_ss': '10',
+        'count_rank_ssh': '1',
+        'count_rank_s': '100',
+        'count_rank_sh': '10',
+        'count_rank_a': '1000',
+        'country': 'JP',
+        'total_seconds_played': '1000000',
+        'pp_country_rank': '100',
+        'events': [],
+    }
+
+
+class FakeApiServer(object):
+    """Fake osu! API (under /api) and Tillerino API (under /tillerino)
+
+    Responses are delayed by latency seconds plus up to jitter seconds, and
+    a fraction error_rate of requests fails with HTTP 500.
+    """
+
+    def __init__(self, latency=.1, jitter=.05, error_rate=0, seed=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.rng = random.Random(seed)
+        self.runner = None
+        self.requests = collections.Counter()
+
+    async def start(self, host='127.0.0.1', port=0):
+        """Start listening and return the port the server is bound to"""
+        app = web.Application()
+        app.router.add_get('/api/get_beatmaps', self.get_beatmaps)
+        app.router.add_get('/api/get_user', self.get_user)
+        app.router.add_get('/tillerino/beatmapinfo', self.beatmapinfo)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, host, port)
+        await site.start()
+        return self.runner.addresses[0][1]
+
+    async def close(self):
+        if self.runner is not None:
+            await self.runner.cleanup()
+            self.runner = None
+
+    async def _respond(self, endpoint, data):
+        self.requests[endpoint] += 1
+        await asyncio.sleep(self.latency + self.rng.random() * self.jitter)
+        if self.error_rate and self.rng.random() < self.error_rate:
+            return web.Response(status=500, text='fake error')
+        return web.json_response(data)
+
+    async def get_beatmaps(self, request):
+        if 'b' in request.query:
+            beatmaps = [fake_beatmap(int(request.query['b']))]
+        elif 's' in request.query:
+            first = int(request.query['s']) * DIFFS_PER_MAPSET
+            beatmaps = [fake_beatmap(beatmap_id) for beatmap_id in range(first, first + DIFFS_PER_MAPSET)]
+        else:
+            beatmaps = []
+        return await self._respond('get_beatmaps', beatmaps)
+
+    async def get_user(self, request):
+        return await self._respond('get_user', [fake_user(request.query.get('u', 'bench'))])
+
+    async def beatmapinfo(self, request):
+        beatmap_id = int(request.query['beatmapid'])
+        stars = 2 + beatmap_id % DIFFS_PER_MAPSET
+        return await self._respond('beatmapinfo', {
+            'beatmapid': beatmap_id,
+            'mods': int(request.query.get('mods', 0)),
+            'starDiff': stars,
+            'ppForAcc': {'0.95': stars * 40, '0.98': stars * 45, '1.0': stars * 55},
+        })
+
+
+def synthetic_chat(count, maps=500, users=1000, link_ratio=.3, mod_ratio=.3, seed=0):
+    """Yield count (nick, text) chat messages
+
+    A fraction link_ratio of the messages are map requests. Map popularity
+    follows a Zipf distribution, so some maps are requested far more often
+    than others (like in a real stream). A fraction mod_ratio of the
+    requests include mods.
+    """
+    rng = random.Random(seed)
+    cum_weights = list(itertools.accumulate(1 / rank for rank in range(1, maps + 1)))
+    map_ids = list(range(FIRST_BEATMAP_ID, FIRST_BEATMAP_ID + maps * DIFFS_PER_MAPSET, DIFFS_PER_MAPSET))
+    rng.shuffle(map_ids)
+    mod_choices = ['HD', 'HR', 'DT', 'HDDT', 'HDHR', 'EZ', 'HT']
+    for _ in range(count):
+        nick = 'user{}'.format(rng.randrange(users))
+        if rng.random() >= link_ratio:
+            yield (nick, 'chat message number {} Kappa'.format(rng.randrange(100000)))
+            continue
+        beatmap_id = rng.choices(map_ids, cum_weights=cum_weights)[0] + rng.randrange(DIFFS_PER_MAPSET)
+        kind = rng.random()
+        if kind < .6:
+            text = 'https://osu.ppy.sh/b/{}'.format(beatmap_id)
+        elif kind < .9:
+            text = 'https://osu.ppy.sh/beatmapsets/{}#osu/{}'.format(beatmap_id // DIFFS_PER_MAPSET, beatmap_id)
+        else:
+            text = 'https://osu.ppy.sh/s/{}'.format(beatmap_id // DIFFS_PER_MAPSET)
+        if rng.random() < mod_ratio:
+            text = '{} +{}'.format(text, rng.choice(mod_choices))
+        yield (nick, 'pls play {}'.format(text))
+
+
+def recorded_chat(path):
+    """Yield (nick, text) chat messages from a chat log
+
+    Lines can be raw Twitch IRC PRIVMSG lines, or plain chat log lines in
+    the "<nick> text", "nick: text" or "[time] nick: text" formats.
+    """
+    with open(path, encoding='utf-8', errors='ignore') as f:
+        for line in f:
+            line = line.rstrip('\r\n')
+            if not line.strip():
+                continue
+            m = IRC_PRIVMSG.match(line) or LOG_LINE.match(line)
+            if m:
+                yield (m.group('nick').lower(), m.group('text'))
+
+
+def _twitch_privmsg(nick, text, user_id):
+    return (
+        '@badges=;color=;display-name={0};emotes=;mod=0;subscriber=0;user-id={1};user-type= '
+        ':{0}!{0}@{0}.tmi.twitch.tv PRIVMSG {2} :{3}'.format(nick, user_id, BENCH_CHANNEL, text))
+
+
+def _memory():
+    """Return (current, peak) resident set size in bytes, None if unknown"""
+    current = peak = None
+    try:
+        with open('/proc/self/statm') as f:
+            current = int(f.read().split()[1]) * resource.getpagesize()
+    except (OSError, ValueError, AttributeError):
+        pass
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # ru_maxrss is in bytes on macOS and kilobytes everywhere else
+        if sys.platform != 'darwin':
+            peak *= 1024
+    return (current, peak)
+
+
+class LoadTest(object):
+    """Replays chat messages to the bot and matches Bancho messages to requests
+
+    Requests are matched to Bancho messages in order per requesting user,
+    since the bot starts every Bancho message with the user's nick.
+    """
+
+    def __init__(self, twitch_server, rate):
+        self.twitch_server = twitch_server
+        self.rate = rate
+        self.pending = collections.defaultdict(collections.deque)
+        self.latencies = []
+        self.sent = 0
+        self.requests = 0
+        self.unmatched = 0
+        self.first_sent = None
+        self.last_sent = None
+        self.last_answer = None
+
+    def on_bancho_privmsg(self, target, text):
+        now = time.monotonic()
+        nick = text.split(' > ', 1)[0].lower()
+        pending = self.pending.get(nick)
+        if not pending:
+            self.unmatched += 1
+            return
+        self.latencies.append(now - pending.popleft())
+        self.last_answer = now
+
+    def outstanding(self):
+        return sum(len(pending) for pending in self.pending.values())
+
+    async def replay(self, messages):
+        user_ids = {}
+        start = time.monotonic()
+        self.first_sent = start
+        for (i, (nick, text)) in enumerate(messages):
+            delay = start + i / self.rate - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            user_id = user_ids.setdefault(nick, len(user_ids) + 1)
+            if LINK_PATTERN.search(text):
+                self.requests += 1
+                self.pending[nick].append(time.monotonic())
+            self.twitch_server.broadcast(_twitch_privmsg(nick, text, user_id))
+            self.sent += 1
+        self.last_sent = time.monotonic()
+
+    async def drain(self, timeout):
+        """Wait until every request was answered, or no answer came for timeout seconds"""
+        last_progress = (time.monotonic(), self.outstanding())
+        while self.outstanding():
+            await asyncio.sleep(.05)
+            outstanding = self.outstanding()
+            if outstanding != last_progress[1]:
+                last_progress = (time.monotonic(), outstanding)
+            elif time.monotonic() - last_progress[0] > timeout:
+                break
+
+    def results(self):
+        answered = len(self.latencies)
+        end = self.last_answer or self.last_sent
+        duration = max(end - self.first_sent, 1e-9)
+        latencies = sorted(self.latencies)
+        return {
+            'messages': self.sent,
+            'message_rate': self.sent / max(self.last_sent - self.first_sent, 1e-9),
+            'requests': self.requests,
+            'answered': answered,
+            'unanswered': self.outstanding(),
+            'throughput': answered / duration,
+            'latency_p50': percentile(latencies, .5),
+            'latency_p95': percentile(latencies, .95),
+            'latency_p99': percentile(latencies, .99),
+            'latency_max': latencies[-1] if latencies else 0.0,
+        }
+
+
+def make_bench_config(args, twitch_port, bancho_port, api_port):
+    """Return the [gumiya] config used by the benchmarked bot
+
+    Settings are read from args.config (if set), with connection settings
+    replaced by the fake servers. The persistent store, metrics endpoint and
+    sharding are always disabled.
+    """
+    config = configparser.ConfigParser()
+    config['gumiya'] = {}
+    if args.config:
+        config.read(args.config)
+    gumiya_config = config['gumiya']
+    api_base = 'http://127.0.0.1:{}'.format(api_port)
+    gumiya_config.update({
+        'twitch_host': '127.0.0.1',
+        'twitch_port': str(twitch_port),
+        'twitch_username': BENCH_TWITCH_NICK,
+        'twitch_password': 'oauth:bench',
+        'twitch_channel': BENCH_CHANNEL.lstrip('#'),
+        'bancho_host': '127.0.0.1',
+        'bancho_port': str(bancho_port),
+        'bancho_username': BENCH_BANCHO_NICK,
+        'bancho_password': 'bench',
+        'osu_api_key': 'bench',
+        'osu_api_base': '{}/api'.format(api_base),
+        'tillerino_api_key': '' if args.no_tillerino else 'bench',
+        'tillerino_api_base': '{}/tillerino'.format(api_base),
+        'store_path': '',
+        'bancho_outbox_path': '',
+        'metrics_port': '0',
+    })
+    if not args.keep_rate_limits:
+        # measure the bot, not the Bancho and Twitch rate limits
+        gumiya_config.update({
+            'bancho_rate_limit': '1000000',
+            'bancho_queue_size': '1000000',
+            'twitch_rate_limit': '1000000',
+            'twitch_mod_rate_limit': '1000000',
+        })
+    return gumiya_config
+
+
+async def _wait_for(condition, timeout, what):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise RuntimeError('Timed out waiting for {}'.format(what))
+        await asyncio.sleep(.05)
+
+
+async def bench(args, loop):
+    if args.log:
+        messages = recorded_chat(args.log)
+    else:
+        messages = synthetic_chat(args.count, maps=args.maps, users=args.users, link_ratio=args.link_ratio,
+                                  mod_ratio=args.mod_ratio, seed=args.seed)
+    twitch_server = FakeIrcServer('tmi.twitch.tv')
+    load_test = LoadTest(twitch_server, args.rate)
+    bancho_server = FakeIrcServer('cho.ppy.sh', line_ending=b'\n', on_privmsg=load_test.on_bancho_privmsg)
+    api_server = FakeApiServer(latency=args.api_latency / 1000, jitter=args.api_jitter / 1000,
+                               error_rate=args.api_error_rate, seed=args.seed)
+    gumiya_config = make_bench_config(
+        args, await twitch_server.start(), await bancho_server.start(), await api_server.start())
+
+    (memory_start, _) = _memory()
+    bancho_queue = make_bancho_queue(gumiya_config)
+    http_client = make_http_client(gumiya_config)
+    caches = make_caches(gumiya_config)
+    twitch_bot = irc3.IrcBot(loop=loop, bancho_queue=bancho_queue, http_client=http_client, **caches,
+                             **make_twitch_config(gumiya_config, {}, debug=args.debug))
+    twitch_bot.run(forever=False)
+    bancho_bot = irc3.IrcBot(loop=loop, bancho_queue=bancho_queue, connection=BanchoConnection,
+                             **make_bancho_config(gumiya_config, debug=args.debug))
+    bancho_bot.run(forever=False)
+    if not args.debug:
+        # the bots (re)configure irc3 logging when they are created
+        logging.getLogger('irc3').setLevel(logging.WARNING)
+    try:
+        await _wait_for(lambda: BENCH_CHANNEL in twitch_server.joined, 10, 'the bot to join Twitch chat')
+        await _wait_for(lambda: BENCH_BANCHO_NICK in bancho_server.registered, 10, 'the bot to log in to Bancho')
+        await load_test.replay(messages)
+        await load_test.drain(args.drain_timeout)
+    finally:
+        if not args.debug:
+            # closing the connections is logged as critical
+            logging.getLogger('irc3').setLevel(logging.CRITICAL + 1)
+        for bot in (twitch_bot, bancho_bot):
+            if bot.protocol is not None:
+                bot.protocol.transport.close()
+        # stop the bots' background tasks (senders, prefetching, ...)
+        for task in asyncio.all_tasks():
+            if task is not asyncio.current_task():
+                task.cancel()
+        await http_client.close()
+        await api_server.close()
+        await twitch_server.close()
+        await bancho_server.close()
+    (memory_end, memory_peak) = _memory()
+
+    plugin = twitch_bot.get_plugin(BaseTwitchPlugin)
+    results = load_test.results()
+    results.update({
+        'shed': plugin.admission.stats()['shed'],
+        'on_cooldown': plugin.cooldown_suppressed,
+        'api_requests': dict(api_server.requests),
+        'memory_start': memory_start,
+        'memory_end': memory_end,
+        'memory_peak': memory_peak,
+    })
+    return results
+
+
+def _mib(value):
+    return 'n/a' if value is None else '{:.1f} MiB'.format(value / (1024 * 1024))
+
+
+def print_results(results):
+    print('chat messages  {messages} sent at {message_rate:.1f}/s'.format(**results))
+    print('map requests   {requests} sent, {answered} answered, {unanswered} unanswered '
+          '({shed} shed, {on_cooldown} on cooldown)'.format(**results))
+    print('throughput     {throughput:.1f} answered requests/s'.format(**results))
+    print('latency        p50 {:.1f}ms, p95 {:.1f}ms, p99 {:.1f}ms, max {:.1f}ms'.format(
+        results['latency_p50'] * 1000, results['latency_p95'] * 1000, results['latency_p99'] * 1000,
+        results['latency_max'] * 1000))
+    print('API requests   {}'.format(', '.join(
+        '{} {}'.format(endpoint, count) for (endpoint, count) in sorted(results['api_requests'].items())) or 'none'))
+    print('memory (RSS)   start {}, end {}, peak {}'.format(
+        _mib(results['memory_start']), _mib(results['memory_end']), _mib(results['memory_peak'])))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Benchmark the bot against local fake Twitch, Bancho, osu! API and Tillerino servers',
+        prog='gumiyabot bench')
+    parser.add_argument('config', nargs='?',
+                        help='Optional config file to read bot settings (cache sizes, concurrency, ...) from')
+    parser.add_argument('--log', help='Replay a recorded chat log instead of a synthetic one')
+    parser.add_argument('--rate', type=float, default=50, help='Chat messages per second (default: 50)')
+    parser.add_argument('--count', type=int, default=2000, help='Synthetic chat messages to send (default: 2000)')
+    parser.add_argument('--maps', type=int, default=500, help='Distinct mapsets in the synthetic log (default: 500)')
+    parser.add_argument('--users', type=int, default=1000, help='Distinct users in the synthetic log (default: 1000)')
+    parser.add_argument('--link-ratio', type=float, default=.3, dest='link_ratio',
+                        help='Fraction of synthetic messages which are map requests (default: 0.3)')
+    parser.add_argument('--mod-ratio', type=float, default=.3, dest='mod_ratio',
+                        help='Fraction of synthetic map requests with mods (default: 0.3)')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed (default: 0)')
+    parser.add_argument('--api-latency', type=float, default=100, dest='api_latency',
+                        help='Fake osu! API and Tillerino latency in ms (default: 100)')
+    parser.add_argument('--api-jitter', type=float, default=50, dest='api_jitter',
+                        help='Random extra fake API latency in ms, up to this value (default: 50)')
+    parser.add_argument('--api-error-rate', type=float, default=0, dest='api_error_rate',
+                        help='Fraction of fake API requests which fail (default: 0)')
+    parser.add_argument('--no-tillerino', action='store_true', dest='no_tillerino',
+                        help='Run the bot without a Tillerino API key')
+    parser.add_argument('--keep-rate-limits', action='store_true', dest='keep_rate_limits',
+                        help='Keep the configured Bancho and Twitch rate limits')
+    parser.add_argument('--drain-timeout', type=float, default=10, dest='drain_timeout',
+                        help='Seconds to wait for outstanding requests without progress (default: 10)')
+    parser.add_argument('--json', action='store_true', help='Print results as JSON')
+    parser.add_argument('-d', '--debug', '--verbose', action='store_true', dest='debug',
+                        help='Verbose debugging output')
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.DEBUG if args.debug else logging.WARNING)
+    if not args.debug:
+        logging.getLogger('irc3').setLevel(logging.WARNING)
+
+    loop = asyncio.get_event_loop()
+    try:
+        results = loop.run_until_complete(bench(args, loop))
+    except RuntimeError as e:
+        sys.exit('Error: {}'.format(e))
+    if args.json:
+        print(json.dumps(results, indent=2, sort_keys=True))
+    else:
+        print_results(results)
@@ -0,0 +1,261 @@
+# -*- coding: utf-8 -*-
+"""
+In-memory caches for osu! API data.
+"""
+import asyncio
+import time
+from collections import OrderedDict
+
+from osuapi.enums import BeatmapStatus
+
+
+_missing = object()
+
+
+class TTLCache(object):
+    """Bounded LRU mapping where every entry expires after a TTL.
+
+    Lookups through ``get`` update the hit/miss counters, ``peek`` does not.
+    When the cache is full the least recently used entry is evicted.
+
+    Expired entries are kept for another ``stale_ttl`` seconds, during which
+    they can still be read with ``peek(key, stale=True)`` (i.e. to answer with
+    stale data while an upstream API is unavailable).
+    """
+
+    def __init__(self, maxsize=1024, ttl=300, stale_ttl=0, clock=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.clock = clock
+        self._data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return self.peek(key, _missing) is not _missing
+
+    def peek(self, key, default=None, stale=False):
+        """Return the cached value for key without touching stats or LRU order
+
+        If stale is set, expired entries within stale_ttl are returned as well.
+        """
+        try:
+            (expires, value) = self._data[key]
+        except KeyError:
+            return default
+        now = self.clock()
+        if expires <= now:
+            if expires + self.stale_ttl <= now:
+                del self._data[key]
+                return default
+            elif not stale:
+                return default
+        return value
+
+    def get(self, key, default=None):
+        value = self.peek(key, _missing)
+        if value is _missing:
+            self.misses += 1
+            return default
+        self.hits += 1
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key, value, ttl=None):
+        if ttl is None:
+            ttl = self.ttl
+        self._data[key] = (self.clock() + ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def values(self):
+        """Return all unexpired values without touching stats or LRU order"""
+        now = self.clock()
+        return [value for (expires, value) in self._data.values() if expires > now]
+
+    def pop(self, key, default=None):
+        try:
+            return self._data.pop(key)[1]
+        except KeyError:
+            return default
+
+    def clear(self):
+        self._data.clear()
+
+    def stats(self):
+        return {
+            'size': len(self._data),
+            'maxsize': self.maxsize,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+
+class BeatmapCache(object):
+    """Beatmap metadata cache keyed by beatmap_id and by beatmapset_id.
+
+    Every difficulty is stored individually, so a ``/b/`` lookup can be served
+    from an earlier ``/s/`` fetch of the same mapset. The mapset index maps a
+    beatmapset_id to the ids of its difficulties and is only used to answer
+    mapset lookups when the full mapset has been fetched at least once.
+
+    Ranked, approved and loved maps rarely change and are cached for
+    ``ranked_ttl`` seconds, everything else (qualified, pending, WIP and
+    graveyard) only for ``unranked_ttl`` seconds.
+    """
+
+    STABLE_STATUSES = frozenset([
+        BeatmapStatus.ranked,
+        BeatmapStatus.approved,
+        BeatmapStatus.loved,
+    ])
+
+    def __init__(self, maxsize=2048, ranked_ttl=24 * 60 * 60, unranked_ttl=10 * 60, stale_ttl=0,
+                 clock=time.monotonic):
+        self.ranked_ttl = ranked_ttl
+        self.unranked_ttl = unranked_ttl
+        self.beatmaps = TTLCache(maxsize=maxsize, ttl=unranked_ttl, stale_ttl=stale_ttl, clock=clock)
+        self.mapsets = TTLCache(maxsize=maxsize, ttl=unranked_ttl, stale_ttl=stale_ttl, clock=clock)
+
+    def ttl_for(self, beatmap):
+        if beatmap.approved in self.STABLE_STATUSES:
+            return self.ranked_ttl
+        return self.unranked_ttl
+
+    def get_beatmap(self, beatmap_id, stale=False):
+        """Return the cached beatmap for beatmap_id or None
+
+        If stale is set, expired beatmaps within stale_ttl are returned as well.
+        """
+        if stale:
+            return self.beatmaps.peek(int(beatmap_id), stale=True)
+        return self.beatmaps.get(int(beatmap_id))
+
+    def get_mapset(self, beatmapset_id, stale=False):
+        """Return all cached difficulties for beatmapset_id or None
+
+        None is returned unless every difficulty in the mapset is still cached.
+        If stale is set, expired entries within stale_ttl are returned as well.
+        """
+        beatmap_ids = self.mapsets.peek(int(beatmapset_id), stale=stale)
+        mapset = []
+        if beatmap_ids is not None:
+            for beatmap_id in beatmap_ids:
+                beatmap = self.beatmaps.peek(beatmap_id, stale=stale)
+                if beatmap is None:
+                    # a difficulty was evicted, the index entry is no longer usable
+                    self.mapsets.pop(int(beatmapset_id))
+                    break
+                mapset.append(beatmap)
+            else:
+                if stale:
+                    return mapset
+                # count the hit and refresh LRU order of the index entry
+                self.mapsets.get(int(beatmapset_id))
+                return mapset
+        self.mapsets.misses += 1
+        return None
+
+    def peek_mapset(self, beatmapset_id):
+        """Return all cached difficulties for beatmapset_id or None, without touching stats or LRU order"""
+        beatmap_ids = self.mapsets.peek(int(beatmapset_id))
+        if beatmap_ids is None:
+            return None
+        mapset = [self.beatmaps.peek(beatmap_id) for beatmap_id in beatmap_ids]
+        if None in mapset:
+            return None
+        return mapset
+
+    def put_beatmaps(self, beatmaps, complete_mapset=False, age=0):
+        """Add beatmaps returned by the osu! API to the cache
+
+        If complete_mapset is set, beatmaps must contain every difficulty of
+        a single mapset and the mapset index is updated as well. age is the
+        number of seconds since the beatmaps were fetched, beatmaps older
+        than their TTL are not added. Returns the number of cached beatmaps.
+        """
+        cached = 0
+        for beatmap in beatmaps:
+            ttl = self.ttl_for(beatmap) - age
+            if ttl > 0:
+                self.beatmaps.set(beatmap.beatmap_id, beatmap, ttl=ttl)
+                cached += 1
+        if complete_mapset and beatmaps and cached == len(beatmaps):
+            ttl = min(self.ttl_for(beatmap) for beatmap in beatmaps) - age
+            self.mapsets.set(
+                beatmaps[0].beatmapset_id,
+                tuple(beatmap.beatmap_id for beatmap in beatmaps),
+                ttl=ttl)
+        return cached
+
+    def clear(self):
+        self.beatmaps.clear()
+        self.mapsets.clear()
+
+    def stats(self):
+        return {
+            'beatmaps': self.beatmaps.stats(),
+            'mapsets': self.mapsets.stats(),
+        }
+
+
+class SingleFlight(object):
+    """Merge concurrent calls for the same key into a single call.
+
+    The first caller for a key starts the call, any caller that arrives while
+    it is still in flight waits for (and gets) the same result or exception.
+    Cancelling one waiter does not cancel the shared call.
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self.calls = 0
+        self.coalesced = 0
+
+    def __len__(self):
+        return len(self._calls)
+
+    def __contains__(self, key):
+        return key in self._calls
+
+    def _start(self, key, func, args, kwargs):
+        self.calls += 1
+        fut = asyncio.ensure_future(func(*args, **kwargs))
+        self._calls[key] = fut
+        fut.add_done_callback(lambda f: self._done(key, f))
+        return fut
+
+    async def do(self, key, func, *args, **kwargs):
+        fut = self._calls.get(key)
+        if fut is None:
+            fut = self._start(key, func, args, kwargs)
+        else:
+            self.coalesced += 1
+        return await asyncio.shield(fut)
+
+    def start(self, key, func, *args, **kwargs):
+        """Start a call in the background unless one for key is already in flight"""
+        if key not in self._calls:
+            self._start(key, func, args, kwargs)
+
+    def _done(self, key, fut):
+        if self._calls.get(key) is fut:
+            del self._calls[key]
+        if not fut.cancelled():
+            # mark the exception as retrieved in case every waiter went away
+            fut.exception()
+
+    def stats(self):
+        return {
+            'in_flight': len(self._calls),
+            'calls': self.calls,
+            'coalesced': self.coalesced,
+        }
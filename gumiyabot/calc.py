@@ -0,0 +1,532 @@
+# -*- coding: utf-8 -*-
+"""
+Offline osu!standard difficulty and pp calculator.
+
+This is a NumPy implementation of the osu! ppv2 star rating and pp
+algorithm, in the form used by oppai-ng (no slider travel distance). The
+results are close to the values shown on the osu! website, but are not
+guaranteed to match them exactly.
+
+NumPy is an optional dependency (``pip install gumiyabot[calc]``), use
+``available()`` to check whether the calculator can be used.
+"""
+import asyncio
+import bisect
+import hashlib
+import importlib.util
+import math
+import os
+import tempfile
+
+import aiohttp
+
+from osuapi.enums import OsuMod
+
+from .beatmap import mod_difficulty
+from .cache import TTLCache
+
+# NumPy is only imported once it is used (see _numpy), so the bot does not
+# pay for importing it unless local pp calculation is enabled
+np = None
+
+
+def _numpy():
+    """Import NumPy on first use, returns None if it is not installed"""
+    global np
+    if np is None:
+        try:
+            import numpy
+        except ImportError:  # pragma: no cover
+            return None
+        np = numpy
+    return np
+
+
+def available():
+    """Return True if the calculator dependencies are installed"""
+    return np is not None or importlib.util.find_spec('numpy') is not None
+
+
+class CalculationError(Exception):
+    pass
+
+
+PLAYFIELD_WIDTH = 512.0
+CIRCLESIZE_BUFF_THRESHOLD = 30.0
+
+STRAIN_STEP = 400.0
+DECAY_WEIGHT = 0.9
+STAR_SCALING_FACTOR = 0.0675
+EXTREME_SCALING_FACTOR = 0.5
+
+# (speed, aim)
+DECAY_BASE = (0.3, 0.15)
+WEIGHT_SCALING = (1400.0, 26.25)
+
+SINGLE_SPACING = 125.0
+MIN_SPEED_BONUS = 75.0
+MAX_SPEED_BONUS = 45.0
+ANGLE_BONUS_SCALE = 90.0
+AIM_TIMING_THRESHOLD = 107.0
+SPEED_ANGLE_BONUS_BEGIN = 5 * math.pi / 6
+AIM_ANGLE_BONUS_BEGIN = math.pi / 3
+
+# strain values are accumulated in chunks of at most this many seconds, so
+# that decay factors (0.15 ** seconds) stay inside the float64 range
+_SEGMENT_SECONDS = 200.0
+
+OBJECT_CIRCLE = 1
+OBJECT_SLIDER = 2
+OBJECT_SPINNER = 8
+
+
+class OsuFile(object):
+    """Parsed osu!standard .osu beatmap file"""
+
+    def __init__(self):
+        self.mode = 0
+        self.cs = 5.0
+        self.od = 5.0
+        self.ar = None
+        self.hp = 5.0
+        self.slider_multiplier = 1.4
+        self.slider_tick_rate = 1.0
+        self.timing_points = []
+        self.times = []
+        self.xs = []
+        self.ys = []
+        self.types = []
+        self.slider_info = []
+        self.max_combo = 0
+
+    @property
+    def n_circles(self):
+        return self.types.count(OBJECT_CIRCLE)
+
+    @property
+    def n_sliders(self):
+        return self.types.count(OBJECT_SLIDER)
+
+    @property
+    def n_spinners(self):
+        return self.types.count(OBJECT_SPINNER)
+
+    @property
+    def n_objects(self):
+        return len(self.types)
+
+
+def parse_osu_file(data):
+    """Parse the contents (bytes or str) of an .osu file
+
+    Raises:
+        CalculationError if the file is not a valid osu!standard beatmap
+    """
+    if isinstance(data, bytes):
+        data = data.decode('utf-8', 'ignore')
+    osu = OsuFile()
+    section = None
+    for line in data.splitlines():
+        line = line.strip()
+        if not line or line.startswith('//'):
+            continue
+        if line.startswith('[') and line.endswith(']'):
+            section = line[1:-1]
+            continue
+        try:
+            if section in ('General', 'Difficulty'):
+                (key, _, value) = line.partition(':')
+                key = key.strip()
+                value = value.strip()
+                if key == 'Mode':
+                    osu.mode = int(value)
+                elif key == 'CircleSize':
+                    osu.cs = float(value)
+                elif key == 'OverallDifficulty':
+                    osu.od = float(value)
+                elif key == 'ApproachRate':
+                    osu.ar = float(value)
+                elif key == 'HPDrainRate':
+                    osu.hp = float(value)
+                elif key == 'SliderMultiplier':
+                    osu.slider_multiplier = float(value)
+                elif key == 'SliderTickRate':
+                    osu.slider_tick_rate = float(value)
+            elif section == 'TimingPoints':
+                fields = line.split(',')
+                time = float(fields[0])
+                beat_length = float(fields[1])
+                uninherited = beat_length > 0
+                if len(fields) > 6:
+                    uninherited = fields[6].strip() != '0'
+                osu.timing_points.append((time, beat_length, uninherited))
+            elif section == 'HitObjects':
+                _parse_hit_object(osu, line.split(','))
+        except (ValueError, IndexError):
+            raise CalculationError('Invalid .osu line in [{}]: {}'.format(section, line))
+    if osu.mode != 0:
+        raise CalculationError('Only osu!standard beatmaps are supported')
+    if osu.ar is None:
+        # old beatmaps use OD as AR
+        osu.ar = osu.od
+    osu.max_combo = _max_combo(osu)
+    return osu
+
+
+def _parse_hit_object(osu, fields):
+    type_ = int(fields[3])
+    if type_ & OBJECT_CIRCLE:
+        kind = OBJECT_CIRCLE
+    elif type_ & OBJECT_SLIDER:
+        kind = OBJECT_SLIDER
+        osu.slider_info.append((float(fields[2]), int(fields[6]), float(fields[7])))
+    elif type_ & OBJECT_SPINNER:
+        kind = OBJECT_SPINNER
+    else:
+        # osu!mania hold notes and unknown objects
+        return
+    osu.xs.append(float(fields[0]))
+    osu.ys.append(float(fields[1]))
+    osu.times.append(float(fields[2]))
+    osu.types.append(kind)
+
+
+def _max_combo(osu):
+    combo = osu.n_circles + osu.n_spinners
+    # effective slider velocity multiplier from each timing point onwards
+    times = []
+    velocities = []
+    sv = 1.0
+    for (time, beat_length, uninherited) in sorted(osu.timing_points, key=lambda tp: tp[0]):
+        if uninherited:
+            sv = 1.0
+        elif beat_length < 0:
+            sv = min(10.0, max(0.1, -100.0 / beat_length))
+        times.append(time)
+        velocities.append(sv)
+    for (time, repeats, pixel_length) in osu.slider_info:
+        i = bisect.bisect_right(times, time)
+        sv = velocities[i - 1] if i else 1.0
+        px_per_beat = osu.slider_multiplier * 100.0 * sv
+        num_beats = pixel_length * repeats / px_per_beat
+        ticks = int(math.ceil((num_beats - 0.1) / repeats * osu.slider_tick_rate)) - 1
+        ticks = ticks * repeats + repeats + 1
+        combo += max(0, ticks)
+    return combo
+
+
+def _strains(times, values, decay_base, weight_scaling):
+    """Compute strain[i] = strain[i - 1] * decay_base ** (dt / 1000) + values[i] * weight_scaling
+
+    The recurrence is evaluated in closed form (cumulative sums of values
+    scaled by the inverse decay), chunked so the exponents never overflow.
+    """
+    strains = np.empty(len(times))
+    strains[0] = 1.0
+    seconds = times / 1000.0
+    log_base = math.log(decay_base)
+    start = 1
+    carry = (strains[0], seconds[0])
+    while start < len(times):
+        end = int(np.searchsorted(seconds, seconds[start] + _SEGMENT_SECONDS, side='left'))
+        end = max(end, start + 1)
+        t = seconds[start:end] - seconds[start]
+        scaled = values[start:end] * weight_scaling * np.exp(-log_base * t)
+        (prev_strain, prev_time) = carry
+        initial = prev_strain * math.exp(log_base * (seconds[start] - prev_time))
+        strains[start:end] = np.exp(log_base * t) * (initial + np.cumsum(scaled))
+        carry = (strains[end - 1], seconds[end - 1])
+        start = end
+    return strains
+
+
+def _difficulty_value(times, strains, decay_base):
+    """Weighted sum of the highest strains in STRAIN_STEP ms sections"""
+    sections = np.ceil(times / STRAIN_STEP).astype(np.int64)
+    first = sections[0]
+    sections -= first
+    n_sections = int(sections[-1]) + 1
+    highest = np.zeros(n_sections)
+    np.maximum.at(highest, sections, strains)
+    if n_sections > 1:
+        # each section starts with the decayed strain of the last object
+        # before it
+        section_ids = np.arange(1, n_sections)
+        prev = np.searchsorted(sections, section_ids, side='left') - 1
+        section_start = (first + section_ids - 1) * STRAIN_STEP
+        decayed = strains[prev] * np.power(decay_base, (section_start - times[prev]) / 1000.0)
+        highest[1:] = np.maximum(highest[1:], decayed)
+    highest = np.sort(highest)[::-1]
+    return float(np.sum(highest * np.power(DECAY_WEIGHT, np.arange(len(highest)))))
+
+
+def calculate_stars(osu, mods=0):
+    """Return (stars, aim_stars, speed_stars) for a parsed beatmap with mods applied"""
+    if _numpy() is None:
+        raise CalculationError('NumPy is required for difficulty calculation')
+    if osu.n_objects < 2:
+        return (0.0, 0.0, 0.0)
+    (cs, od, ar, hp, speed_mul) = mod_difficulty(osu.cs, osu.od, osu.ar, osu.hp, mods)
+
+    radius = (PLAYFIELD_WIDTH / 16.0) * (1.0 - 0.7 * (cs - 5.0) / 5.0)
+    scaling = 52.0 / radius
+    if radius < CIRCLESIZE_BUFF_THRESHOLD:
+        scaling *= 1.0 + min(CIRCLESIZE_BUFF_THRESHOLD - radius, 5.0) / 50.0
+
+    times = np.asarray(osu.times, dtype=np.float64) / speed_mul
+    pos = np.column_stack([osu.xs, osu.ys]).astype(np.float64) * scaling
+    is_spinner = np.asarray(osu.types) == OBJECT_SPINNER
+
+    n = len(times)
+    delta = np.zeros(n)
+    delta[1:] = times[1:] - times[:-1]
+    distance = np.zeros(n)
+    distance[1:] = np.hypot(*(pos[1:] - pos[:-1]).T)
+    prev_delta = np.zeros(n)
+    prev_delta[1:] = delta[:-1]
+    prev_distance = np.zeros(n)
+    prev_distance[1:] = distance[:-1]
+    angle = np.full(n, np.nan)
+    if n > 2:
+        v1 = pos[:-2] - pos[1:-1]
+        v2 = pos[2:] - pos[1:-1]
+        dot = np.einsum('ij,ij->i', v1, v2)
+        det = v1[:, 0] * v2[:, 1] - v1[:, 1] * v2[:, 0]
+        angle[2:] = np.abs(np.arctan2(det, dot))
+    has_angle = ~np.isnan(angle)
+    safe_angle = np.where(has_angle, angle, 0.0)
+
+    strain_time = np.maximum(delta, 50.0)
+
+    # aim
+    prev_strain_time = np.maximum(prev_delta, 50.0)
+    angle_bonus = np.sqrt(
+        np.maximum(prev_distance - ANGLE_BONUS_SCALE, 0.0)
+        * np.sin(safe_angle - AIM_ANGLE_BONUS_BEGIN) ** 2
+        * np.maximum(distance - ANGLE_BONUS_SCALE, 0.0))
+    aim_angle = np.where(
+        has_angle & (safe_angle > AIM_ANGLE_BONUS_BEGIN),
+        1.5 * np.power(angle_bonus, 0.99) / np.maximum(AIM_TIMING_THRESHOLD, prev_strain_time),
+        0.0)
+    aim_distance = np.power(distance, 0.99)
+    aim = np.maximum(
+        aim_angle + aim_distance / np.maximum(AIM_TIMING_THRESHOLD, strain_time),
+        aim_distance / strain_time)
+
+    # speed
+    speed_distance = np.minimum(distance, SINGLE_SPACING)
+    speed_delta = np.maximum(delta, MAX_SPEED_BONUS)
+    speed_bonus = 1.0 + np.where(
+        speed_delta < MIN_SPEED_BONUS,
+        ((MIN_SPEED_BONUS - speed_delta) / 40.0) ** 2,
+        0.0)
+    speed_angle = np.ones(n)
+    wide = has_angle & (safe_angle < SPEED_ANGLE_BONUS_BEGIN)
+    speed_angle = np.where(wide, 1.0 + np.sin(1.5 * (SPEED_ANGLE_BONUS_BEGIN - safe_angle)) ** 2 / 3.57, speed_angle)
+    sharp = wide & (safe_angle < math.pi / 2)
+    close = np.minimum((ANGLE_BONUS_SCALE - speed_distance) / 10.0, 1.0)
+    sharp_bonus = np.where(
+        speed_distance < ANGLE_BONUS_SCALE,
+        1.28 + (1 - 1.28) * close * np.where(
+            safe_angle < math.pi / 4, 1.0, np.sin((math.pi / 2 - safe_angle) * 4 / math.pi)),
+        1.28)
+    speed_angle = np.where(sharp, sharp_bonus, speed_angle)
+    speed = (
+        (1 + (speed_bonus - 1) * 0.75) * speed_angle
+        * (0.95 + speed_bonus * np.power(speed_distance / SINGLE_SPACING, 3.5))
+    ) / strain_time
+
+    aim[is_spinner] = 0.0
+    speed[is_spinner] = 0.0
+
+    speed_diff = _difficulty_value(times, _strains(times, speed, DECAY_BASE[0], WEIGHT_SCALING[0]), DECAY_BASE[0])
+    aim_diff = _difficulty_value(times, _strains(times, aim, DECAY_BASE[1], WEIGHT_SCALING[1]), DECAY_BASE[1])
+    aim_stars = math.sqrt(aim_diff) * STAR_SCALING_FACTOR
+    speed_stars = math.sqrt(speed_diff) * STAR_SCALING_FACTOR
+    stars = aim_stars + speed_stars + abs(speed_stars - aim_stars) * EXTREME_SCALING_FACTOR
+    return (stars, aim_stars, speed_stars)
+
+
+def _hit_counts(n_objects, accuracy, misses=0):
+    """Return (n300, n100, n50) closest to accuracy (0-1)"""
+    max300 = n_objects - misses
+    n50 = 0
+    n100 = int(round(-3.0 * ((accuracy - 1.0) * n_objects + misses) * 0.5))
+    if n100 > max300:
+        n100 = 0
+        n50 = min(max300, int(round(-6.0 * ((accuracy - 1.0) * n_objects + misses) * 0.2)))
+    else:
+        n100 = min(max300, max(0, n100))
+    n300 = n_objects - n100 - n50 - misses
+    return (n300, n100, n50)
+
+
+def _base_pp(stars):
+    return (5.0 * max(1.0, stars / STAR_SCALING_FACTOR) - 4.0) ** 3 / 100000.0
+
+
+def calculate_pp(osu, aim_stars, speed_stars, mods=0, accuracy=1.0, misses=0, combo=None):
+    """Return ppv2 for a play with the given accuracy (0-1) on a parsed beatmap"""
+    (cs, od, ar, hp, speed_mul) = mod_difficulty(osu.cs, osu.od, osu.ar, osu.hp, mods)
+    n_objects = osu.n_objects
+    n_circles = osu.n_circles
+    max_combo = osu.max_combo or 1
+    if combo is None:
+        combo = max_combo
+    (n300, n100, n50) = _hit_counts(n_objects, accuracy, misses)
+    accuracy = (n300 * 300.0 + n100 * 100.0 + n50 * 50.0) / (300.0 * max(1, n_objects))
+
+    over_2k = n_objects / 2000.0
+    length_bonus = 0.95 + 0.4 * min(1.0, over_2k)
+    if n_objects > 2000:
+        length_bonus += math.log10(over_2k) * 0.5
+    miss_penalty = 0.97 ** misses
+    combo_break = min(1.0, combo ** 0.8 / max_combo ** 0.8)
+
+    ar_bonus = 1.0
+    if ar > 10.33:
+        ar_bonus += 0.3 * (ar - 10.33)
+    elif ar < 8.0:
+        ar_bonus += 0.01 * (8.0 - ar)
+    hd_bonus = 1.0 + 0.04 * (12.0 - ar) if mods & OsuMod.Hidden.value else 1.0
+    od_squared = od * od
+
+    aim = _base_pp(aim_stars) * length_bonus * miss_penalty * combo_break * ar_bonus * hd_bonus
+    if mods & OsuMod.Flashlight.value:
+        fl_bonus = 1.0 + 0.35 * min(1.0, n_objects / 200.0)
+        if n_objects > 200:
+            fl_bonus += 0.3 * min(1.0, (n_objects - 200) / 300.0)
+        if n_objects > 500:
+            fl_bonus += (n_objects - 500) / 1200.0
+        aim *= fl_bonus
+    aim *= (0.5 + accuracy / 2.0) * (0.98 + od_squared / 2500.0)
+
+    speed = _base_pp(speed_stars) * length_bonus * miss_penalty * combo_break * hd_bonus
+    if ar > 10.33:
+        speed *= ar_bonus
+    speed *= (0.95 + od_squared / 750.0) * accuracy ** ((14.5 - max(od, 8.0)) / 2.0)
+    speed *= 0.98 ** max(0.0, n50 - n_objects / 500.0)
+
+    real_acc = 0.0
+    if n_circles:
+        real_acc = max(0.0, ((n300 - (n_objects - n_circles)) * 6.0 + n100 * 2.0 + n50) / (n_circles * 6.0))
+    acc = 1.52163 ** od * real_acc ** 24 * 2.83
+    acc *= min(1.15, (n_circles / 1000.0) ** 0.3)
+    if mods & OsuMod.Hidden.value:
+        acc *= 1.08
+    if mods & OsuMod.Flashlight.value:
+        acc *= 1.02
+
+    multiplier = 1.12
+    if mods & OsuMod.NoFail.value:
+        multiplier *= 0.9
+    if mods & OsuMod.SpunOut.value:
+        multiplier *= 0.95
+    return (aim ** 1.1 + speed ** 1.1 + acc ** 1.1) ** (1.0 / 1.1) * multiplier
+
+
+def beatmap_info(osu, mods=0, accuracies=(.95, .98, 1.0)):
+    """Return Tillerino beatmapinfo style results for a parsed beatmap
+
+    The returned dict contains 'starDiff' and 'ppForAcc' ({accuracy: pp}).
+    """
+    (stars, aim_stars, speed_stars) = calculate_stars(osu, mods)
+    return {
+        'starDiff': stars,
+        'ppForAcc': {
+            acc: calculate_pp(osu, aim_stars, speed_stars, mods=mods, accuracy=acc)
+            for acc in accuracies
+        },
+    }
+
+
+class BeatmapFileCache(object):
+    """Content addressed on-disk cache of .osu files
+
+    Files are stored as <directory>/<md5[:2]>/<md5>.osu, so a beatmap that
+    was updated on the osu! website (and therefore has a new file_md5) is
+    never served from a stale file.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def path(self, md5):
+        return os.path.join(self.directory, md5[:2], '{}.osu'.format(md5))
+
+    def get(self, md5):
+        try:
+            with open(self.path(md5), 'rb') as f:
+                return f.read()
+        except (IOError, OSError):
+            return None
+
+    def put(self, data):
+        """Store data and return its md5"""
+        md5 = hashlib.md5(data).hexdigest()
+        path = self.path(md5)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            (fd, tmp_path) = tempfile.mkstemp(dir=os.path.dirname(path))
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(data)
+                os.replace(tmp_path, path)
+            except BaseException:
+                os.unlink(tmp_path)
+                raise
+        return md5
+
+
+class LocalCalculator(object):
+    """Calculates star rating and pp for osu! API beatmaps without Tillerino
+
+    .osu files are downloaded from the osu! website through the shared
+    HttpClient and kept in a BeatmapFileCache. Calculations run in the loop's
+    default executor so they do not block the event loop.
+    """
+
+    OSU_FILE_URL = 'https://osu.ppy.sh/osu/{}'
+
+    def __init__(self, http, cache_dir, parsed_cache_size=64):
+        # import NumPy now rather than in the first calculation
+        _numpy()
+        self.http = http
+        self.files = BeatmapFileCache(cache_dir)
+        self.parsed = TTLCache(maxsize=parsed_cache_size, ttl=60 * 60)
+
+    async def _download(self, beatmap_id):
+        try:
+            async with self.http.get(self.OSU_FILE_URL.format(beatmap_id)) as r:
+                if r.status != 200:
+                    raise CalculationError('Could not download .osu file for beatmap {}'.format(beatmap_id))
+                data = await r.read()
+        except aiohttp.ClientError as e:
+            raise CalculationError('Could not download .osu file for beatmap {}: {}'.format(beatmap_id, e))
+        if not data:
+            raise CalculationError('Empty .osu file for beatmap {}'.format(beatmap_id))
+        return data
+
+    async def get_osu_file(self, beatmap):
+        """Return the parsed .osu file for an osu! API beatmap"""
+        md5 = getattr(beatmap, 'file_md5', None)
+        osu = self.parsed.get(md5) if md5 else None
+        if osu is not None:
+            return osu
+        loop = asyncio.get_event_loop()
+        data = self.files.get(md5) if md5 else None
+        if data is None:
+            data = await self._download(beatmap.beatmap_id)
+            try:
+                md5 = await loop.run_in_executor(None, self.files.put, data)
+            except OSError as e:
+                raise CalculationError('Could not store .osu file for beatmap {}: {}'.format(beatmap.beatmap_id, e))
+        osu = await loop.run_in_executor(None, parse_osu_file, data)
+        self.parsed.set(md5, osu)
+        return osu
+
+    async def beatmapinfo(self, beatmap, mods=0):
+        """Return Tillerino beatmapinfo style results for an osu! API beatmap"""
+        osu = await self.get_osu_file(beatmap)
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(None, beatmap_info, osu, mods)
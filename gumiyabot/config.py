@@ -0,0 +1,260 @@
+# -*- coding: utf-8 -*-
+"""
+Helpers for building bot components from a gumiyabot config file.
+"""
+import configparser
+import logging
+import logging.handlers
+import os
+import sys
+
+from .cache import BeatmapCache, TTLCache
+from .httpclient import HttpClient
+from .logqueue import LogQueue
+from .metrics import MetricsServer, Registry
+from .outbound import OutboundScheduler
+from .outbox import OutboxJournal
+from .store import PersistentStore
+
+
+def load_config(config_file):
+    """Return the [gumiya] config section and per-channel settings from config_file"""
+    config = configparser.ConfigParser()
+    config.read(config_file)
+    if 'gumiya' not in config:
+        sys.exit('Error: Invalid config, missing [gumiya] section')
+    gumiya_config = config['gumiya']
+    twitch_channels = {}
+    for section in config.sections():
+        if section.startswith('channel:'):
+            twitch_channels[section.split(':', 1)[1].strip()] = dict(config[section])
+    if not twitch_channels and not gumiya_config.get('twitch_channel'):
+        sys.exit('Error: Invalid config, set twitch_channel or add a [channel:<name>] section')
+    return (gumiya_config, twitch_channels)
+
+
+def make_bancho_queue(gumiya_config):
+    """Return the Bancho outbound queue, with messages left in the outbox journal (if enabled) queued again"""
+    bancho_rate_limit = gumiya_config.getint('bancho_rate_limit', fallback=10)
+    outbox_path = gumiya_config.get('bancho_outbox_path', fallback='')
+    if outbox_path:
+        journal = OutboxJournal(
+            outbox_path, sync_interval=gumiya_config.getfloat('bancho_outbox_sync_interval', fallback=.5))
+    else:
+        journal = None
+    bancho_queue = OutboundScheduler(
+        maxsize=gumiya_config.getint('bancho_queue_size', fallback=256),
+        rate=bancho_rate_limit / gumiya_config.getfloat('bancho_rate_period', fallback=5),
+        burst=bancho_rate_limit,
+        message_ttl=gumiya_config.getint('bancho_message_ttl', fallback=60),
+        journal=journal,
+    )
+    if journal is not None:
+        bancho_queue.restore(journal.load())
+        journal.start()
+    return bancho_queue
+
+
+def make_http_client(gumiya_config):
+    return HttpClient(
+        limit=gumiya_config.getint('http_limit', fallback=100),
+        limit_per_host=gumiya_config.getint('http_limit_per_host', fallback=10),
+        keepalive_timeout=gumiya_config.getfloat('http_keepalive_timeout', fallback=30),
+        dns_cache_ttl=gumiya_config.getint('http_dns_cache_ttl', fallback=300),
+        connect_timeout=gumiya_config.getfloat('http_connect_timeout', fallback=5),
+        read_timeout=gumiya_config.getfloat('http_read_timeout', fallback=15),
+    )
+
+
+def make_caches(gumiya_config):
+    stale_ttl = gumiya_config.getint('cache_stale_ttl', fallback=60 * 60)
+    return dict(
+        beatmap_cache=BeatmapCache(
+            maxsize=gumiya_config.getint('beatmap_cache_size', fallback=2048),
+            ranked_ttl=gumiya_config.getint('beatmap_cache_ttl_ranked', fallback=24 * 60 * 60),
+            unranked_ttl=gumiya_config.getint('beatmap_cache_ttl_unranked', fallback=10 * 60),
+            stale_ttl=stale_ttl,
+        ),
+        pp_cache=TTLCache(
+            maxsize=gumiya_config.getint('pp_cache_size', fallback=4096),
+            ttl=gumiya_config.getint('pp_cache_ttl', fallback=60 * 60),
+            stale_ttl=stale_ttl,
+        ),
+        user_cache=TTLCache(
+            maxsize=gumiya_config.getint('user_cache_size', fallback=1024),
+            ttl=gumiya_config.getint('user_cache_ttl', fallback=60),
+            stale_ttl=stale_ttl,
+        ),
+    )
+
+
+def shard_store_path(store_path, shard_index):
+    """Return the store path for a shard process, i.e. gumiyabot.shard0.db for gumiyabot.db"""
+    (root, ext) = os.path.splitext(store_path)
+    return '{}.shard{}{}'.format(root, shard_index, ext)
+
+
+def open_store(loop, gumiya_config, caches, shard_index=None):
+    """Open the persistent store if store_path is set, returns the store or None
+
+    The caches are warmed from the store in the background (see
+    PersistentStore.start_warm), so the bots can connect meanwhile. Every
+    shard process (shard_index) gets a database of its own, so shards do
+    not contend for the SQLite write lock.
+    """
+    store_path = gumiya_config.get('store_path', fallback='')
+    if not store_path:
+        return None
+    if shard_index is not None:
+        store_path = shard_store_path(store_path, shard_index)
+    store = PersistentStore(
+        store_path,
+        flush_interval=gumiya_config.getfloat('store_flush_interval', fallback=5),
+        hot_set_size=gumiya_config.getint('store_hot_set_size', fallback=2000),
+        max_pending=gumiya_config.getint('store_max_pending', fallback=10000),
+    )
+    store.start_warm(**caches)
+    store.start()
+    return store
+
+
+def open_metrics(loop, gumiya_config, port_offset=0):
+    """Start the metrics endpoint if metrics_port is set, returns (registry, server) or (None, None)"""
+    metrics_port = gumiya_config.getint('metrics_port', fallback=0)
+    if not metrics_port:
+        return (None, None)
+    registry = Registry()
+    server = MetricsServer(registry)
+    loop.run_until_complete(server.start(
+        host=gumiya_config.get('metrics_host', fallback='127.0.0.1'), port=metrics_port + port_offset))
+    return (registry, server)
+
+
+def raw_log_includes(gumiya_config, debug=False):
+    """Return the irc3 plugins for logging raw IRC traffic, which is only logged in debug mode or to raw_irc_log"""
+    if debug or gumiya_config.get('raw_irc_log', fallback=''):
+        return ['irc3.plugins.log']
+    return []
+
+
+def setup_logging(gumiya_config, debug=False):
+    """Set up the gumiyabot loggers, the raw IRC traffic log file and the log queue (if enabled)
+
+    irc3 resets the logging config whenever a bot is created, so this must
+    be called after the bots were created. Returns the started LogQueue or
+    None.
+    """
+    # the gumiyabot.* module loggers log to the same console as the bots
+    gumiyabot_logger = logging.getLogger('gumiyabot')
+    gumiyabot_logger.handlers = list(logging.getLogger('irc3').handlers)
+    gumiyabot_logger.setLevel(logging.DEBUG if debug else logging.INFO)
+    gumiyabot_logger.propagate = False
+    raw_irc_log = gumiya_config.get('raw_irc_log', fallback='')
+    if raw_irc_log:
+        handler = logging.handlers.WatchedFileHandler(raw_irc_log, encoding='utf8')
+        handler.setFormatter(logging.Formatter('%(asctime)s %(name)s %(message)s'))
+        raw_logger = logging.getLogger('raw')
+        if not debug:
+            # raw traffic is only logged to the console in debug mode
+            raw_logger.handlers = []
+        raw_logger.addHandler(handler)
+    if not gumiya_config.getboolean('log_queue', fallback=False):
+        return None
+    log_queue = LogQueue(
+        maxsize=gumiya_config.getint('log_queue_size', fallback=10000),
+        rate_limit=gumiya_config.getfloat('log_rate_limit', fallback=0))
+    log_queue.start()
+    return log_queue
+
+
+def make_config_common(debug=False):
+    config_common = {
+        'irc3.plugins.command': {
+            'hash': '#',
+            'cmd': '!',
+            'guard': 'irc3.plugins.command.mask_based_policy',
+        },
+        'irc3.plugins.command.masks': {
+            'hash': '#',
+            '*': 'view',
+        },
+    }
+    if debug:
+        config_common['debug'] = True
+    return config_common
+
+
+def make_twitch_config(gumiya_config, twitch_channels, debug=False):
+    twitch_config = dict(
+        host=gumiya_config.get('twitch_host', fallback='irc.chat.twitch.tv'),
+        port=gumiya_config.getint('twitch_port', fallback=6667),
+        includes=[
+            'irc3.plugins.core',
+            'irc3.plugins.autocommand',
+            'irc3.plugins.command',
+        ] + raw_log_includes(gumiya_config, debug) + [
+            'gumiyabot.twitch',
+        ],
+        autocommands=[
+            'CAP REQ :twitch.tv/membership',
+            'CAP REQ :twitch.tv/commands',
+            'CAP REQ :twitch.tv/tags',
+        ],
+        nick=gumiya_config['twitch_username'],
+        password=gumiya_config['twitch_password'],
+        osu_api_key=gumiya_config['osu_api_key'],
+        tillerino_api_key=gumiya_config.get('tillerino_api_key', fallback=''),
+        osu_api_base=gumiya_config.get('osu_api_base', fallback=''),
+        tillerino_api_base=gumiya_config.get('tillerino_api_base', fallback=''),
+        bancho_nick=gumiya_config['bancho_username'],
+        twitch_channel=gumiya_config.get('twitch_channel', fallback=''),
+        twitch_channels=twitch_channels,
+        pp_cache_negative_ttl=gumiya_config.getint('pp_cache_negative_ttl', fallback=5 * 60),
+        pp_concurrency=gumiya_config.getint('pp_concurrency', fallback=8),
+        request_concurrency=gumiya_config.getint('request_concurrency', fallback=8),
+        request_queue_size=gumiya_config.getint('request_queue_size', fallback=32),
+        request_drop_policy=gumiya_config.get('request_drop_policy', fallback='oldest'),
+        twitch_message_template=gumiya_config.get('twitch_message_template', fallback=''),
+        bancho_message_template=gumiya_config.get('bancho_message_template', fallback=''),
+        message_cache_size=gumiya_config.getint('message_cache_size', fallback=4096),
+        search_index_size=gumiya_config.getint('search_index_size', fallback=50000),
+        search_results=gumiya_config.getint('search_results', fallback=3),
+        prefetch=gumiya_config.get('prefetch', fallback='off'),
+        prefetch_rate=gumiya_config.getfloat('prefetch_rate', fallback=1),
+        prefetch_mods=gumiya_config.getint('prefetch_mods', fallback=3),
+        prefetch_queue_size=gumiya_config.getint('prefetch_queue_size', fallback=64),
+        user_cooldown=gumiya_config.getfloat('user_cooldown', fallback=0),
+        map_cooldown=gumiya_config.getfloat('map_cooldown', fallback=0),
+        cooldown_exempt_subs=gumiya_config.get('cooldown_exempt_subs', fallback='on'),
+        upstream_min_timeout=gumiya_config.getfloat('upstream_min_timeout', fallback=1),
+        upstream_hedge=gumiya_config.get('upstream_hedge', fallback='on'),
+        upstream_failure_threshold=gumiya_config.getint('upstream_failure_threshold', fallback=5),
+        upstream_reset_timeout=gumiya_config.getint('upstream_reset_timeout', fallback=30),
+        local_pp=gumiya_config.get('local_pp', fallback='off'),
+        osu_file_cache_dir=gumiya_config.get('osu_file_cache_dir', fallback='osu_files'),
+        twitch_rate_limit=gumiya_config.getint('twitch_rate_limit', fallback=20),
+        twitch_mod_rate_limit=gumiya_config.getint('twitch_mod_rate_limit', fallback=100),
+        twitch_rate_period=gumiya_config.getint('twitch_rate_period', fallback=30),
+        twitch_stats_interval=gumiya_config.getint('twitch_stats_interval', fallback=0),
+        user_refresh_interval=gumiya_config.getint('user_refresh_interval', fallback=0),
+    )
+    twitch_config.update(make_config_common(debug))
+    return twitch_config
+
+
+def make_bancho_config(gumiya_config, debug=False):
+    bancho_config = dict(
+        host=gumiya_config.get('bancho_host', fallback='irc.ppy.sh'),
+        port=gumiya_config.getint('bancho_port', fallback=6667),
+        includes=[
+            'irc3.plugins.core',
+            'irc3.plugins.command',
+        ] + raw_log_includes(gumiya_config, debug) + [
+            'gumiyabot.bancho',
+        ],
+        nick=gumiya_config['bancho_username'],
+        password=gumiya_config['bancho_password'],
+        bancho_stats_interval=gumiya_config.getint('bancho_stats_interval', fallback=0),
+    )
+    bancho_config.update(make_config_common(debug))
+    return bancho_config
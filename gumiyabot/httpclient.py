@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+"""
+Shared HTTP client used for osu! API and Tillerino requests.
+"""
+import asyncio
+
+import aiohttp
+
+from osuapi import endpoints
+from osuapi.errors import HTTPError
+
+
+class HttpClient(object):
+    """Pooled aiohttp session shared by every API client in the bot.
+
+    The underlying session is created lazily on first use so that it is
+    always bound to the running event loop. Connections are kept alive and
+    reused, so bursts of requests to the same host do not need to open new
+    (TLS) connections.
+    """
+
+    def __init__(self, limit=100, limit_per_host=10, keepalive_timeout=30, dns_cache_ttl=300,
+                 connect_timeout=5, read_timeout=15):
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.keepalive_timeout = keepalive_timeout
+        self.dns_cache_ttl = dns_cache_ttl
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self._session = None
+
+    @property
+    def session(self):
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.limit,
+                limit_per_host=self.limit_per_host,
+                keepalive_timeout=self.keepalive_timeout,
+                use_dns_cache=True,
+                ttl_dns_cache=self.dns_cache_ttl,
+            )
+            timeout = aiohttp.ClientTimeout(
+                total=None,
+                connect=self.connect_timeout,
+                sock_read=self.read_timeout,
+            )
+            self._session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+        return self._session
+
+    def get(self, url, **kwargs):
+        return self.session.get(url, **kwargs)
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+
+class OsuApiConnector(object):
+    """osuapi connector which sends requests through a shared HttpClient
+
+    If api_base is set, requests are sent to api_base instead of the official
+    osu! API (i.e. to a proxy or a local fake API).
+    """
+
+    def __init__(self, http, api_base=None):
+        self.http = http
+        self.api_base = api_base.rstrip('/') if api_base else None
+
+    def close(self):
+        # the shared client is closed by its owner
+        pass
+
+    async def process_request(self, endpoint, data, type_, retries=5):
+        """Make and process an osu! API request.
+
+        Behaves like osuapi.AHConnector.process_request, 504 responses are
+        retried up to retries times and other errors raise osuapi HTTPError.
+        """
+        if self.api_base and endpoint.startswith(endpoints.API_BASE):
+            endpoint = self.api_base + endpoint[len(endpoints.API_BASE):]
+        while retries:
+            async with self.http.get(endpoint, params=data) as resp:
+                if resp.status == 200:
+                    return type_(await resp.json())
+                elif resp.status == 504:
+                    retries -= 1
+                    if retries:
+                        await asyncio.sleep(1)
+                        continue
+                raise HTTPError(resp.status, resp.reason, await resp.text())
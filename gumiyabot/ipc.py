@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+"""
+Local IPC used when running the bot as several shard processes.
+
+The coordinator process runs the Bancho bot and an IpcServer. Twitch shard
+processes connect to it and use RemoteBanchoQueue in place of the
+in-process bancho_queue, and SharedCacheClient as a cache shared between
+all shards. Messages are newline delimited JSON objects over a local TCP
+connection.
+"""
+import asyncio
+import itertools
+import json
+import logging
+import time
+
+from .cache import TTLCache
+from .outbound import PRIORITY_NORMAL
+
+
+log = logging.getLogger(__name__)
+
+
+def _encode(obj):
+    return json.dumps(obj, separators=(',', ':')).encode('utf-8') + b'\n'
+
+
+class IpcServer(object):
+    """Coordinator side IPC server
+
+    Handles Bancho messages from shards (which are added to bancho_queue) and
+    shared cache requests.
+    """
+
+    def __init__(self, bancho_queue, cache_size=8192, clock=time.monotonic):
+        self.bancho_queue = bancho_queue
+        self.cache = TTLCache(maxsize=cache_size, clock=clock)
+        self.server = None
+        self.handlers = {
+            'bancho_put': self.bancho_put,
+            'cache_get': self.cache_get,
+            'cache_set': self.cache_set,
+        }
+
+    async def start(self, host='127.0.0.1', port=0):
+        """Start listening and return the (host, port) the server is bound to"""
+        self.server = await asyncio.start_server(self._client, host, port)
+        return self.server.sockets[0].getsockname()[:2]
+
+    async def close(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+
+    async def _client(self, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    request = json.loads(line.decode('utf-8'))
+                    result = await self.handlers[request['op']](**request.get('args', {}))
+                except (ValueError, KeyError, TypeError) as e:
+                    log.warning('[ipc] Invalid request %r: %s', line, e)
+                    continue
+                if 'id' in request:
+                    writer.write(_encode({'id': request['id'], 'result': result}))
+                    await writer.drain()
+        except ConnectionError as e:
+            log.debug('[ipc] %s', e)
+        finally:
+            writer.close()
+
+    async def bancho_put(self, target, msg, priority=PRIORITY_NORMAL, ttl=None, started=None):
+        await self.bancho_queue.put((target, msg), priority=priority, ttl=ttl, started=started)
+
+    async def cache_get(self, key):
+        return self.cache.get(key)
+
+    async def cache_set(self, key, value, ttl):
+        self.cache.set(key, value, ttl=ttl)
+
+
+class IpcClient(object):
+    """Shard side IPC connection, (re)connected on demand"""
+
+    def __init__(self, host, port, timeout=2):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self._reader = None
+        self._writer = None
+        self._read_task = None
+        self._connect_lock = asyncio.Lock()
+        self._ids = itertools.count()
+        self._waiting = {}
+
+    async def _connect(self):
+        async with self._connect_lock:
+            if self._writer is None:
+                (self._reader, self._writer) = await asyncio.open_connection(self.host, self.port)
+                self._read_task = asyncio.ensure_future(self._read_responses(self._reader))
+        return self._writer
+
+    async def _read_responses(self, reader):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                response = json.loads(line.decode('utf-8'))
+                fut = self._waiting.pop(response['id'], None)
+                if fut is not None and not fut.done():
+                    fut.set_result(response.get('result'))
+        except (ConnectionError, ValueError) as e:
+            log.debug('[ipc] %s', e)
+        finally:
+            self._disconnected()
+
+    def _disconnected(self):
+        if self._writer is not None:
+            self._writer.close()
+        self._reader = self._writer = self._read_task = None
+        (waiting, self._waiting) = (self._waiting, {})
+        for fut in waiting.values():
+            if not fut.done():
+                fut.set_exception(ConnectionError('IPC connection closed'))
+
+    async def send(self, op, **args):
+        """Send a request without waiting for a response"""
+        writer = await self._connect()
+        writer.write(_encode({'op': op, 'args': args}))
+        await writer.drain()
+
+    async def request(self, op, **args):
+        """Send a request and return its result"""
+        writer = await self._connect()
+        request_id = next(self._ids)
+        fut = asyncio.get_event_loop().create_future()
+        self._waiting[request_id] = fut
+        writer.write(_encode({'id': request_id, 'op': op, 'args': args}))
+        try:
+            await writer.drain()
+            return await asyncio.wait_for(fut, self.timeout)
+        finally:
+            self._waiting.pop(request_id, None)
+
+    async def close(self):
+        if self._read_task is not None:
+            self._read_task.cancel()
+        self._disconnected()
+
+
+class RemoteBanchoQueue(object):
+    """bancho_queue replacement which forwards messages to the coordinator process"""
+
+    def __init__(self, client):
+        self.client = client
+
+    async def put(self, item, priority=PRIORITY_NORMAL, ttl=None, started=None):
+        (target, msg) = item
+        try:
+            # started is a time.monotonic() value, which is system wide
+            await self.client.send('bancho_put', target=target, msg=msg, priority=priority, ttl=ttl,
+                                   started=started)
+        except (ConnectionError, OSError) as e:
+            log.warning('[ipc] Could not send Bancho message to %s: %s', target, e)
+
+    def put_nowait(self, item, priority=PRIORITY_NORMAL, ttl=None, started=None):
+        asyncio.ensure_future(self.put(item, priority=priority, ttl=ttl, started=started))
+
+
+class SharedCacheClient(object):
+    """Cache shared by all shard processes, stored in the coordinator process
+
+    Values must be JSON serializable. Lookup failures are treated as cache
+    misses, so a shard keeps working (without the shared cache) if the
+    coordinator is unreachable.
+    """
+
+    def __init__(self, client, clock=time.time):
+        self.client = client
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+
+    def _key(self, namespace, key):
+        return json.dumps([namespace, key])
+
+    async def get(self, namespace, key):
+        """Return (value, age) for a cached entry, or (None, 0)"""
+        try:
+            entry = await self.client.request('cache_get', key=self._key(namespace, key))
+        except (ConnectionError, OSError, asyncio.TimeoutError) as e:
+            log.debug('[ipc] shared cache get failed: %s', e)
+            self.errors += 1
+            return (None, 0)
+        if entry is None:
+            self.misses += 1
+            return (None, 0)
+        self.hits += 1
+        return (entry['value'], max(0, self.clock() - entry['stored']))
+
+    async def set(self, namespace, key, value, ttl):
+        entry = {'value': value, 'stored': self.clock()}
+        try:
+            await self.client.send('cache_set', key=self._key(namespace, key), value=entry, ttl=ttl)
+        except (ConnectionError, OSError) as e:
+            log.debug('[ipc] shared cache set failed: %s', e)
+            self.errors += 1
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'errors': self.errors,
+        }
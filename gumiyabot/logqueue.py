@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+"""
+Off-loop logging.
+
+Log records are handed to a background thread through a bounded queue, and
+are only formatted and written out (to the console or log files) in that
+thread, so slow log output never stalls the event loop.
+"""
+import collections
+import logging
+import logging.handlers
+import queue
+import time
+
+from .ratelimit import TokenBucket
+
+
+# loggers configured by irc3 (the bots log to irc3.<nick>, raw IRC traffic
+# is logged to raw.<nick> << and raw.<nick> >>) and by setup_logging (the
+# gumiyabot.* module loggers)
+LOGGERS = ('irc3', 'irc3d', 'raw', 'asyncio', 'gumiyabot')
+
+
+class RateLimitFilter(logging.Filter):
+    """Let at most rate records per second (with bursts of up to burst) through for every message
+
+    Records are grouped by logger and unformatted message, so log calls
+    should pass their arguments separately (i.e. log.debug('%s', value)).
+    Raw IRC traffic is grouped by logger only. Records at or above min_level
+    are never limited. The number of suppressed records is added to the
+    next record of the group which gets through.
+    """
+
+    def __init__(self, rate=10, burst=None, min_level=logging.WARNING, max_groups=1024, clock=time.monotonic):
+        super().__init__()
+        self.rate = rate
+        self.burst = burst or rate
+        self.min_level = min_level
+        self.max_groups = max_groups
+        self.clock = clock
+        # key -> [TokenBucket, suppressed records]
+        self._groups = collections.OrderedDict()
+        self.suppressed = 0
+
+    def _key(self, record):
+        if record.name.startswith('raw.'):
+            return record.name
+        return (record.name, record.msg)
+
+    def filter(self, record):
+        if record.levelno >= self.min_level:
+            return True
+        key = self._key(record)
+        group = self._groups.get(key)
+        if group is None:
+            group = self._groups[key] = [TokenBucket(self.rate, self.burst, clock=self.clock), 0]
+            while len(self._groups) > self.max_groups:
+                self._groups.popitem(last=False)
+        else:
+            self._groups.move_to_end(key)
+        if group[0].try_acquire():
+            group[1] += 1
+            self.suppressed += 1
+            return False
+        if group[1]:
+            record.msg = '{} ({} similar messages suppressed)'.format(record.msg, group[1])
+            group[1] = 0
+        return True
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    """Queues records for the target handlers of a logger, without formatting them"""
+
+    def __init__(self, log_queue, targets):
+        super().__init__(log_queue)
+        self.targets = targets
+        self.setLevel(min(target.level for target in targets))
+        self.dropped = 0
+
+    def prepare(self, record):
+        # records are only formatted by the target handlers in the listener thread
+        return (self.targets, record)
+
+    def enqueue(self, item):
+        try:
+            self.queue.put_nowait(item)
+        except queue.Full:
+            self.dropped += 1
+
+
+class _QueueListener(logging.handlers.QueueListener):
+
+    def handle(self, item):
+        (targets, record) = item
+        for target in targets:
+            if record.levelno >= target.level:
+                target.handle(record)
+
+    def enqueue_sentinel(self):
+        # wait for room, so records queued before stop() are still written
+        self.queue.put(self._sentinel)
+
+
+class LogQueue(object):
+    """Moves the handlers of loggers to a background writer thread
+
+    The handlers of each of the given loggers are replaced by a single
+    QueueHandler which puts records on a queue of up to maxsize records,
+    records are dropped while the queue is full. If rate_limit is set,
+    records below WARNING are limited to rate_limit records per second per
+    message (see RateLimitFilter) before they are queued, so every record
+    is counted once, however many handlers it is written to.
+
+    irc3 resets the logging config whenever a bot is created, so start()
+    must be called after all bots were created.
+    """
+
+    def __init__(self, loggers=LOGGERS, maxsize=10000, rate_limit=0):
+        self.loggers = loggers
+        self.queue = queue.Queue(maxsize)
+        self.listener = _QueueListener(self.queue)
+        self.rate_filter = RateLimitFilter(rate_limit) if rate_limit else None
+        self.queue_handlers = {}
+
+    def _queue_handler(self, handlers):
+        queue_handler = self.queue_handlers.get(handlers)
+        if queue_handler is None:
+            queue_handler = self.queue_handlers[handlers] = _QueueHandler(self.queue, handlers)
+            if self.rate_filter is not None:
+                queue_handler.addFilter(self.rate_filter)
+        return queue_handler
+
+    def start(self):
+        for name in self.loggers:
+            logger = logging.getLogger(name)
+            handlers = tuple(logger.handlers)
+            if handlers and not any(isinstance(handler, _QueueHandler) for handler in handlers):
+                logger.handlers = [self._queue_handler(handlers)]
+        self.listener.start()
+
+    def stop(self):
+        """Write out all queued records and stop the writer thread"""
+        self.listener.stop()
+
+    def stats(self):
+        return {
+            'queued': self.queue.qsize(),
+            'dropped': sum(handler.dropped for handler in self.queue_handlers.values()),
+            'suppressed': self.rate_filter.suppressed if self.rate_filter is not None else 0,
+        }
@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+"""
+Prometheus style metrics, served from an optional local HTTP endpoint.
+
+Latencies are recorded in Histograms as they happen. Everything else
+(queue depths, counters kept by the bot's components) is read from the
+components' stats() when the endpoint is scraped, through collectors.
+"""
+import bisect
+import collections
+import logging
+
+
+log = logging.getLogger(__name__)
+
+COUNTER = 'counter'
+GAUGE = 'gauge'
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{{{}}}'.format(','.join(
+        '{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for (k, v) in labels))
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Histogram(object):
+    """Cumulative histogram with optional labels"""
+
+    DEFAULT_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30)
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # label values -> [bucket counts..., +Inf count], sum
+        self._counts = {}
+        self._sums = collections.defaultdict(float)
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels.get(name, '')) for name in self.labelnames)
+        counts = self._counts.get(key)
+        if counts is None:
+            counts = self._counts[key] = [0] * (len(self.buckets) + 1)
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        self._sums[key] += value
+
+    def render(self):
+        lines = [
+            '# HELP {} {}'.format(self.name, self.help),
+            '# TYPE {} histogram'.format(self.name),
+        ]
+        for (key, counts) in sorted(self._counts.items()):
+            labels = list(zip(self.labelnames, key))
+            total = 0
+            for (bound, count) in zip(self.buckets + (float('inf'),), counts):
+                total += count
+                lines.append('{}_bucket{} {}'.format(
+                    self.name, _format_labels(labels + [('le', _format_value(float(bound)))]), total))
+            lines.append('{}_sum{} {}'.format(self.name, _format_labels(labels), _format_value(self._sums[key])))
+            lines.append('{}_count{} {}'.format(self.name, _format_labels(labels), total))
+        return lines
+
+
+class Registry(object):
+    """Holds histograms and collectors and renders them in Prometheus text format
+
+    A collector is a function returning a list of
+    (name, type, help, [(labels dict, value), ...]) tuples.
+    """
+
+    def __init__(self, prefix='gumiyabot_'):
+        self.prefix = prefix
+        self.histograms = collections.OrderedDict()
+        self.collectors = []
+
+    def histogram(self, name, help, labelnames=(), buckets=Histogram.DEFAULT_BUCKETS):
+        """Return the histogram called name, creating it if needed"""
+        name = self.prefix + name
+        if name not in self.histograms:
+            self.histograms[name] = Histogram(name, help, labelnames=labelnames, buckets=buckets)
+        return self.histograms[name]
+
+    def add_collector(self, collector):
+        self.collectors.append(collector)
+
+    def render(self):
+        lines = []
+        for histogram in self.histograms.values():
+            lines.extend(histogram.render())
+        families = collections.OrderedDict()
+        for collector in self.collectors:
+            try:
+                metrics = collector()
+            except Exception:
+                log.exception('[metrics] collector failed')
+                continue
+            for (name, type_, help, samples) in metrics:
+                family = families.setdefault(self.prefix + name, (type_, help, []))
+                family[2].extend(samples)
+        for (name, (type_, help, samples)) in families.items():
+            lines.append('# HELP {} {}'.format(name, help))
+            lines.append('# TYPE {} {}'.format(name, type_))
+            for (labels, value) in samples:
+                lines.append('{}{} {}'.format(name, _format_labels(sorted(labels.items())), _format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+
+class MetricsServer(object):
+    """aiohttp server exposing a Registry at /metrics"""
+
+    def __init__(self, registry):
+        self.registry = registry
+        self.runner = None
+
+    async def handle_metrics(self, request):
+        from aiohttp import web
+        return web.Response(text=self.registry.render(), content_type='text/plain', charset='utf-8',
+                            headers={'X-Content-Type-Options': 'nosniff'})
+
+    async def start(self, host='127.0.0.1', port=9100):
+        # aiohttp.web is only imported if the metrics endpoint is enabled
+        from aiohttp import web
+        app = web.Application()
+        app.router.add_get('/metrics', self.handle_metrics)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, host, port)
+        await site.start()
+        log.info('[metrics] Serving metrics on http://%s:%s/metrics', host, port)
+
+    async def close(self):
+        if self.runner is not None:
+            await self.runner.cleanup()
+            self.runner = None
+
+
+def cache_metrics(name, stats):
+    """Return collector metrics for a TTLCache.stats() dict"""
+    lookups = stats['hits'] + stats['misses']
+    labels = {'cache': name}
+    return [
+        ('cache_hits_total', COUNTER, 'Cache hits', [(labels, stats['hits'])]),
+        ('cache_misses_total', COUNTER, 'Cache misses', [(labels, stats['misses'])]),
+        ('cache_evictions_total', COUNTER, 'Cache evictions', [(labels, stats['evictions'])]),
+        ('cache_size', GAUGE, 'Cache entries', [(labels, stats['size'])]),
+        ('cache_hit_ratio', GAUGE, 'Cache hits / lookups since start',
+         [(labels, stats['hits'] / lookups if lookups else 0.0)]),
+    ]
+
+
+def bancho_queue_metrics(stats):
+    """Return collector metrics for an OutboundScheduler.stats() dict"""
+    return [
+        ('bancho_queue_depth', GAUGE, 'Bancho messages waiting to be sent', [({}, stats['depth'])]),
+        ('bancho_messages_sent_total', COUNTER, 'Bancho messages sent', [({}, stats['sent'])]),
+        ('bancho_messages_dropped_total', COUNTER, 'Bancho messages dropped',
+         [({'reason': 'deduplicated'}, stats['deduplicated']),
+          ({'reason': 'expired'}, stats['expired']),
+          ({'reason': 'queue_full'}, stats['dropped'])]),
+        ('rate_limit_stalls_total', COUNTER, 'Times a sender waited for its rate limit',
+         [({'service': 'bancho'}, stats['rate_limit_stalls'])]),
+        ('rate_limit_stalled_seconds_total', COUNTER, 'Time spent waiting for rate limits',
+         [({'service': 'bancho'}, stats['rate_limit_stalled_time'])]),
+    ]
+
+
+def twitch_sender_metrics(stats):
+    """Return collector metrics for a TwitchSender.stats() dict"""
+    return [
+        ('twitch_queue_depth', GAUGE, 'Twitch chat messages waiting to be sent', [({}, stats['depth'])]),
+        ('twitch_messages_sent_total', COUNTER, 'Twitch chat messages sent', [({}, stats['sent'])]),
+        ('twitch_messages_merged_total', COUNTER, 'Replies merged into another chat message',
+         [({}, stats['merged'])]),
+        ('twitch_messages_dropped_total', COUNTER, 'Twitch chat messages dropped', [({}, stats['dropped'])]),
+        ('rate_limit_stalls_total', COUNTER, 'Times a sender waited for its rate limit',
+         [({'service': 'twitch'}, stats['rate_limit_stalls'])]),
+        ('rate_limit_stalled_seconds_total', COUNTER, 'Time spent waiting for rate limits',
+         [({'service': 'twitch'}, stats['rate_limit_stalled_time'])]),
+    ]
+
+
+def upstream_metrics(stats, name):
+    """Return collector metrics for an Upstream.stats() dict"""
+    labels = {'upstream': name}
+    return [
+        ('upstream_requests_total', COUNTER, 'Upstream API calls', [(labels, stats['calls'])]),
+        ('upstream_failures_total', COUNTER, 'Failed upstream API calls', [(labels, stats['failures'])]),
+        ('upstream_timeouts_total', COUNTER, 'Timed out upstream API calls', [(labels, stats['timeouts'])]),
+        ('upstream_rejected_total', COUNTER, 'Calls rejected by an open circuit breaker',
+         [(labels, stats['rejected'])]),
+        ('upstream_hedged_total', COUNTER, 'Hedged upstream requests', [(labels, stats['hedged'])]),
+        ('upstream_circuit_open', GAUGE, '1 if the circuit breaker is open',
+         [(labels, int(stats['state'] == 'open'))]),
+    ]
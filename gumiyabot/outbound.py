@@ -0,0 +1,355 @@
+# -*- coding: utf-8 -*-
+"""
+Rate limited outbound message schedulers.
+"""
+import asyncio
+import collections
+import time
+
+from .ratelimit import SlidingWindowLimiter, TokenBucket
+from .utils import percentile
+
+
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+PRIORITY_LOW = 2
+
+
+_Entry = collections.namedtuple(
+    '_Entry', ['target', 'msg', 'priority', 'enqueued', 'deadline', 'started', 'record_id'])
+
+
+class OutboundScheduler(object):
+    """Bounded, prioritized and rate limited queue of (target, msg) pairs.
+
+    Drop-in replacement for the ``asyncio.Queue`` used as ``bancho_queue``:
+    producers ``put((target, msg))`` and the sender loop ``get()``s the next
+    message, where ``get`` only returns once the token bucket allows another
+    message to be sent.
+
+    * Higher priority messages are always sent first, within one priority
+      targets are served round robin so one busy target cannot starve others.
+    * A message identical to one that is already pending is dropped.
+    * Messages still pending after their deadline are dropped.
+    * When the queue is full the oldest message of the busiest target in the
+      lowest non-empty priority (no higher than the new message) is dropped to
+      make room, otherwise the new message is dropped.
+
+    If set, ``on_sent(wait, latency)`` is called for every message returned
+    by ``get``, with the time it spent in the queue and the time since it was
+    started (see ``put_nowait``).
+
+    The sender loop should call ``ack()`` once the message returned by
+    ``get`` was sent, or ``requeue()`` if it could not be sent. If a journal
+    (see ``gumiyabot.outbox.OutboxJournal``) is set, every queued message is
+    journaled until it is acked, expired or dropped, and ``restore`` queues
+    the messages left in the journal by a previous run.
+    """
+
+    def __init__(self, maxsize=256, rate=2.0, burst=10, message_ttl=60, journal=None, clock=time.monotonic):
+        self.maxsize = maxsize
+        self.message_ttl = message_ttl
+        self.journal = journal
+        self.clock = clock
+        self.bucket = TokenBucket(rate, burst, clock=clock)
+        self._queues = [collections.OrderedDict() for _ in (PRIORITY_HIGH, PRIORITY_NORMAL, PRIORITY_LOW)]
+        self._pending = set()
+        self._size = 0
+        self._not_empty = asyncio.Event()
+        self._waits = collections.deque(maxlen=1024)
+        self.on_sent = None
+        self._sending = None
+        self.max_depth = 0
+        self.enqueued = 0
+        self.sent = 0
+        self.deduplicated = 0
+        self.expired = 0
+        self.dropped = 0
+        self.requeued = 0
+        self.restored = 0
+
+    def qsize(self):
+        return self._size
+
+    def empty(self):
+        return not self._size
+
+    def full(self):
+        return self._size >= self.maxsize
+
+    def put_nowait(self, item, priority=PRIORITY_NORMAL, ttl=None, started=None):
+        """Queue a (target, msg) pair, returns False if the message was dropped
+
+        started is the (monotonic clock) time at which handling of the request
+        which produced this message started, it defaults to now.
+        """
+        return self._add(tuple(item), priority, ttl, started)
+
+    def _add(self, item, priority, ttl, started, record_id=None):
+        (target, msg) = item
+        if item in self._pending:
+            self.deduplicated += 1
+            self._ack(record_id)
+            return False
+        if self.full() and not self._evict(priority):
+            self.dropped += 1
+            self._ack(record_id)
+            return False
+        now = self.clock()
+        if ttl is None:
+            ttl = self.message_ttl
+        if record_id is None and self.journal is not None:
+            record_id = self.journal.put(target, msg, priority, ttl)
+        entry = _Entry(target, msg, priority, now, now + ttl if ttl else None, started or now, record_id)
+        queue = self._queues[priority]
+        if target not in queue:
+            queue[target] = collections.deque()
+        queue[target].append(entry)
+        self._pending.add(item)
+        self._size += 1
+        self.enqueued += 1
+        self.max_depth = max(self.max_depth, self._size)
+        self._not_empty.set()
+        return True
+
+    async def put(self, item, priority=PRIORITY_NORMAL, ttl=None, started=None):
+        return self.put_nowait(item, priority=priority, ttl=ttl, started=started)
+
+    def restore(self, records):
+        """Queue journaled messages (see OutboxJournal.load), returns the number of queued messages"""
+        now = time.time()
+        restored = 0
+        for record in records:
+            expires = record['expires']
+            if expires is not None and expires <= now:
+                self.expired += 1
+                self._ack(record['id'])
+                continue
+            ttl = expires - now if expires is not None else 0
+            if self._add((record['target'], record['msg']), record['priority'], ttl, None, record['id']):
+                restored += 1
+        self.restored += restored
+        return restored
+
+    def _ack(self, record_id):
+        if record_id is not None and self.journal is not None:
+            self.journal.ack(record_id)
+
+    def _evict(self, priority):
+        for queue in reversed(self._queues[priority:]):
+            if queue:
+                target = max(queue, key=lambda t: len(queue[t]))
+                self._ack(self._remove(queue, target).record_id)
+                self.dropped += 1
+                return True
+        return False
+
+    def _remove(self, queue, target):
+        pending = queue[target]
+        entry = pending.popleft()
+        if pending:
+            # rotate target to the back of the round robin order
+            queue.move_to_end(target)
+        else:
+            del queue[target]
+        self._pending.discard((entry.target, entry.msg))
+        self._size -= 1
+        return entry
+
+    def _pop(self):
+        now = self.clock()
+        for queue in self._queues:
+            while queue:
+                entry = self._remove(queue, next(iter(queue)))
+                if entry.deadline is not None and entry.deadline < now:
+                    self.expired += 1
+                    self._ack(entry.record_id)
+                    continue
+                return entry
+        return None
+
+    async def get(self):
+        """Wait for the next message that may be sent and return it as (target, msg)"""
+        while True:
+            while not self._size:
+                self._not_empty.clear()
+                await self._not_empty.wait()
+            await self.bucket.acquire()
+            entry = self._pop()
+            if entry is None:
+                # everything left in the queue had expired
+                self.bucket.refund()
+                continue
+            now = self.clock()
+            self._waits.append(now - entry.enqueued)
+            if self.on_sent is not None:
+                self.on_sent(now - entry.enqueued, now - entry.started)
+            self.sent += 1
+            self._sending = entry
+            return (entry.target, entry.msg)
+
+    def ack(self):
+        """Mark the message last returned by get as sent"""
+        (entry, self._sending) = (self._sending, None)
+        if entry is not None:
+            self._ack(entry.record_id)
+
+    def requeue(self):
+        """Put the message last returned by get back at the front of the queue"""
+        (entry, self._sending) = (self._sending, None)
+        if entry is None:
+            return
+        item = (entry.target, entry.msg)
+        self.sent -= 1
+        self.bucket.refund()
+        if item in self._pending:
+            self.deduplicated += 1
+            self._ack(entry.record_id)
+            return
+        queue = self._queues[entry.priority]
+        if entry.target not in queue:
+            queue[entry.target] = collections.deque()
+        queue.move_to_end(entry.target, last=False)
+        queue[entry.target].appendleft(entry)
+        self._pending.add(item)
+        self._size += 1
+        self.requeued += 1
+        self._not_empty.set()
+
+    async def close(self):
+        if self.journal is not None:
+            await self.journal.close()
+
+    def stats(self):
+        waits = list(self._waits)
+        return {
+            'depth': self._size,
+            'depth_by_priority': [sum(len(d) for d in queue.values()) for queue in self._queues],
+            'targets': len(set(t for queue in self._queues for t in queue)),
+            'max_depth': self.max_depth,
+            'enqueued': self.enqueued,
+            'sent': self.sent,
+            'deduplicated': self.deduplicated,
+            'expired': self.expired,
+            'dropped': self.dropped,
+            'requeued': self.requeued,
+            'restored': self.restored,
+            'rate_limit_stalls': self.bucket.stalls,
+            'rate_limit_stalled_time': self.bucket.stalled_time,
+            'wait_avg': sum(waits) / len(waits) if waits else 0.0,
+            'wait_p50': percentile(waits, .5),
+            'wait_p95': percentile(waits, .95),
+            'wait_max': max(waits) if waits else 0.0,
+        }
+
+
+class TwitchSender(object):
+    """Sliding window rate limited sender for Twitch chat.
+
+    Twitch allows 20 messages per 30 seconds, or 100 per 30 seconds when the
+    bot is a moderator (or broadcaster) in the channel it is sending to.
+    Both limits count all messages sent in the window. Messages beyond the
+    limit are held back instead of being silently dropped by Twitch, while
+    channels with a higher limit keep sending. Once the window is more than
+    batch_threshold full, pending batchable messages (map request replies)
+    for the same channel are merged into a single chat line.
+    """
+
+    MAX_MESSAGE_LENGTH = 500
+
+    def __init__(self, send, limit=20, mod_limit=100, period=30, batch_threshold=.5, batch_separator=' || ',
+                 max_pending=50, clock=time.monotonic):
+        self._send = send
+        self.limit = limit
+        self.mod_limit = mod_limit
+        self.batch_threshold = batch_threshold
+        self.batch_separator = batch_separator
+        self.max_pending = max_pending
+        self.clock = clock
+        self.limiter = SlidingWindowLimiter(limit, period, clock=clock)
+        self.moderator_channels = set()
+        self._pending = collections.OrderedDict()
+        self._not_empty = asyncio.Event()
+        self._latencies = collections.deque(maxlen=1024)
+        self.sent = 0
+        self.merged = 0
+        self.dropped = 0
+
+    def set_moderator(self, channel, is_mod):
+        channel = channel.lower()
+        if is_mod:
+            self.moderator_channels.add(channel)
+        else:
+            self.moderator_channels.discard(channel)
+
+    def limit_for(self, target):
+        if str(target).lower() in self.moderator_channels:
+            return self.mod_limit
+        return self.limit
+
+    def qsize(self):
+        return sum(len(pending) for pending in self._pending.values())
+
+    def send(self, target, msg, batchable=False):
+        """Queue msg to be sent to target as soon as the rate limit allows"""
+        pending = self._pending.get(target)
+        if pending is None:
+            pending = self._pending[target] = collections.deque()
+        if len(pending) >= self.max_pending:
+            pending.popleft()
+            self.dropped += 1
+        pending.append((msg, batchable, self.clock()))
+        self._not_empty.set()
+
+    def _next_target(self):
+        """Return the pending target which may be sent to soonest, round robin between equals"""
+        return min(self._pending, key=lambda target: self.limiter.delay(self.limit_for(target)))
+
+    def _next_line(self, target, merge):
+        pending = self._pending[target]
+        (msg, batchable, enqueued) = pending.popleft()
+        sent = [enqueued]
+        if merge and batchable:
+            while pending and pending[0][1]:
+                line = self.batch_separator.join([msg, pending[0][0]])
+                if len(line) > self.MAX_MESSAGE_LENGTH:
+                    break
+                msg = line
+                sent.append(pending.popleft()[2])
+                self.merged += 1
+        if pending:
+            self._pending.move_to_end(target)
+        else:
+            del self._pending[target]
+        return (msg, sent)
+
+    async def run(self):
+        while True:
+            while not self._pending:
+                self._not_empty.clear()
+                await self._not_empty.wait()
+            target = self._next_target()
+            limit = self.limit_for(target)
+            # waiting for the window lets more replies queue up to be merged
+            await self.limiter.acquire(limit)
+            merge = self.limiter.usage(limit) >= self.batch_threshold
+            (msg, enqueued) = self._next_line(target, merge)
+            self._send(target, msg)
+            now = self.clock()
+            self._latencies.extend(now - t for t in enqueued)
+            self.sent += 1
+
+    def stats(self):
+        latencies = list(self._latencies)
+        return {
+            'depth': self.qsize(),
+            'sent': self.sent,
+            'merged': self.merged,
+            'dropped': self.dropped,
+            'rate_limit_stalls': self.limiter.stalls,
+            'rate_limit_stalled_time': self.limiter.stalled_time,
+            'latency_avg': sum(latencies) / len(latencies) if latencies else 0.0,
+            'latency_p50': percentile(latencies, .5),
+            'latency_p95': percentile(latencies, .95),
+            'latency_max': max(latencies) if latencies else 0.0,
+        }
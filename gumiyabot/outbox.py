@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+"""
+Append-only on-disk journal for outbound Bancho messages.
+
+Messages are journaled when they are queued and acknowledged once they were
+written to the Bancho connection, so messages which were still queued when
+the bot stopped (or crashed) are sent after a restart. Journal records are
+written and fsynced in batches from a background thread, queueing a message
+never waits on the disk.
+"""
+import asyncio
+import concurrent.futures
+import json
+import logging
+import os
+import time
+from collections import OrderedDict
+
+
+log = logging.getLogger(__name__)
+
+
+class OutboxJournal(object):
+    """Append-only journal of queued Bancho messages
+
+    put() and ack() only add a record to an in-memory batch, the batch is
+    appended to the journal file (with a single fsync) every sync_interval
+    seconds. Messages queued less than sync_interval seconds before a crash
+    may therefore be lost, and messages sent less than sync_interval seconds
+    before a crash may be sent again.
+
+    load() returns the messages which were put but never acked. Once the
+    journal holds more than compact_threshold records and most of them are
+    acked, it is rewritten with only the unacked messages. If the journal
+    cannot be written, the failed records are discarded and the journal is
+    rewritten with the unacked messages once it can be written again.
+    """
+
+    def __init__(self, path, sync_interval=.5, compact_threshold=1000):
+        self.path = path
+        self.sync_interval = sync_interval
+        self.compact_threshold = compact_threshold
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self._file = None
+        self._pending = []
+        self._unacked = OrderedDict()
+        self._records = 0
+        self._next_id = 1
+        self._flusher = None
+        # set when the file no longer matches _unacked because a write failed
+        self._stale = False
+        self.syncs = 0
+        self.compactions = 0
+        self.errors = 0
+
+    def __len__(self):
+        return len(self._unacked)
+
+    def load(self):
+        """Read the journal file and return the unacked messages, oldest first
+
+        Messages are returned as dicts with id, target, msg, priority and
+        expires (wall clock time or None) keys.
+        """
+        self._unacked.clear()
+        self._records = 0
+        try:
+            with open(self.path, encoding='utf8') as f:
+                lines = f.readlines()
+        except FileNotFoundError:
+            lines = []
+        for line in lines:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # partially written record from a crash
+                continue
+            self._records += 1
+            if 'ack' in record:
+                self._unacked.pop(record['ack'], None)
+            else:
+                self._unacked[record['id']] = record
+                self._next_id = max(self._next_id, record['id'] + 1)
+        return list(self._unacked.values())
+
+    def put(self, target, msg, priority, ttl=None):
+        """Journal a queued message and return its record id"""
+        record_id = self._next_id
+        self._next_id += 1
+        record = {
+            'id': record_id,
+            'target': str(target),
+            'msg': msg,
+            'priority': priority,
+            'expires': time.time() + ttl if ttl else None,
+        }
+        self._unacked[record_id] = record
+        self._pending.append(record)
+        return record_id
+
+    def ack(self, record_id):
+        """Mark a journaled message as sent (or dropped)"""
+        if self._unacked.pop(record_id, None) is not None:
+            self._pending.append({'ack': record_id})
+
+    async def _run(self, func, *args):
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self._executor, func, *args)
+
+    def start(self):
+        """Start the background sync task"""
+        if self._flusher is None:
+            self._flusher = asyncio.ensure_future(self._flush_loop())
+
+    async def _flush_loop(self):
+        failing = False
+        while True:
+            await asyncio.sleep(self.sync_interval)
+            try:
+                await self.flush()
+            except OSError as e:
+                if not failing:
+                    log.warning('[outbox] Could not write %s, queued messages will be lost on restart: %s',
+                                self.path, e)
+                failing = True
+            else:
+                if failing:
+                    log.info('[outbox] %s can be written again', self.path)
+                failing = False
+
+    def _sync(self, f):
+        f.flush()
+        os.fsync(f.fileno())
+
+    # _append and _compact run in the writer thread, so records are serialized there
+    # rather than on the event loop
+
+    def _append(self, batch):
+        if self._file is None:
+            self._file = open(self.path, 'a', encoding='utf8')
+        self._file.write(''.join(json.dumps(record) + '\n' for record in batch))
+        self._sync(self._file)
+
+    def _compact(self, records):
+        tmp_path = '{}.tmp'.format(self.path)
+        with open(tmp_path, 'w', encoding='utf8') as f:
+            f.write(''.join(json.dumps(record) + '\n' for record in records))
+            self._sync(f)
+        self._close()
+        os.replace(tmp_path, self.path)
+        try:
+            dir_fd = os.open(os.path.dirname(os.path.abspath(self.path)), os.O_RDONLY)
+        except OSError:
+            return
+        try:
+            os.fsync(dir_fd)
+        except OSError:
+            pass
+        finally:
+            os.close(dir_fd)
+
+    async def flush(self):
+        """Write and fsync all pending records, raises OSError if the journal could not be written"""
+        if not (self._pending or self._stale):
+            return
+        (batch, self._pending) = (self._pending, [])
+        records = self._records + len(batch)
+        try:
+            if self._stale or (records > self.compact_threshold and len(self._unacked) * 4 < records):
+                # every record in batch is already reflected in _unacked
+                unacked = list(self._unacked.values())
+                await self._run(self._compact, unacked)
+                self._records = len(unacked)
+                self._stale = False
+                self.compactions += 1
+            else:
+                await self._run(self._append, batch)
+                self._records = records
+        except OSError:
+            self._stale = True
+            self.errors += 1
+            raise
+        self.syncs += 1
+
+    async def close(self):
+        if self._flusher is not None:
+            self._flusher.cancel()
+            self._flusher = None
+        try:
+            await self.flush()
+        except OSError as e:
+            log.warning('[outbox] Could not write %s, %d queued messages are lost: %s', self.path, len(self), e)
+        await self._run(self._close)
+        self._executor.shutdown(wait=True)
+
+    def _close(self):
+        (f, self._file) = (self._file, None)
+        if f is not None:
+            f.close()
+
+    def stats(self):
+        return {
+            'unacked': len(self._unacked),
+            'records': self._records,
+            'syncs': self.syncs,
+            'compactions': self.compactions,
+            'errors': self.errors,
+        }
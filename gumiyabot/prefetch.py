@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+"""
+Background cache warming on idle capacity.
+"""
+import asyncio
+import collections
+import logging
+import time
+
+from .ratelimit import TokenBucket
+
+
+log = logging.getLogger(__name__)
+
+
+class Prefetcher(object):
+    """Runs low priority cache warming jobs one at a time
+
+    Jobs are coroutine functions keyed by what they fetch, scheduling a key
+    which is already queued does nothing. The newest job runs first, when
+    more than max_jobs are queued the oldest one is dropped.
+
+    A job only starts while is_idle() returns True, and takes a token from a
+    TokenBucket (rate jobs per second, bursts of up to burst) which limits
+    the share of the API rate budget used for prefetching. A job should
+    return False if it did not need an API call (i.e. the data was already
+    cached), in which case its token is refunded.
+    """
+
+    def __init__(self, is_idle, rate=1.0, burst=5, max_jobs=64, idle_poll=.5, clock=time.monotonic):
+        self.is_idle = is_idle
+        self.bucket = TokenBucket(rate, burst, clock=clock)
+        self.max_jobs = max_jobs
+        self.idle_poll = idle_poll
+        self.jobs = collections.OrderedDict()
+        self._wakeup = asyncio.Event()
+        self.scheduled = 0
+        self.fetched = 0
+        self.skipped = 0
+        self.dropped = 0
+        self.failed = 0
+
+    def __len__(self):
+        return len(self.jobs)
+
+    def schedule(self, key, func, *args, **kwargs):
+        if key in self.jobs:
+            self.jobs.move_to_end(key)
+            return
+        self.jobs[key] = (func, args, kwargs)
+        self.scheduled += 1
+        while len(self.jobs) > self.max_jobs:
+            self.jobs.popitem(last=False)
+            self.dropped += 1
+        self._wakeup.set()
+
+    async def run(self):
+        while True:
+            if not self.jobs:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            if not self.is_idle():
+                await asyncio.sleep(self.idle_poll)
+                continue
+            await self.bucket.acquire()
+            if not self.jobs:
+                self.bucket.refund()
+                continue
+            (key, (func, args, kwargs)) = self.jobs.popitem(last=True)
+            try:
+                fetched = await func(*args, **kwargs)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                log.debug('[prefetch] %r failed: %s', key, e)
+                self.failed += 1
+                continue
+            if fetched:
+                self.fetched += 1
+            else:
+                self.bucket.refund()
+                self.skipped += 1
+
+    def stats(self):
+        return {
+            'queued': len(self.jobs),
+            'scheduled': self.scheduled,
+            'fetched': self.fetched,
+            'skipped': self.skipped,
+            'dropped': self.dropped,
+            'failed': self.failed,
+        }
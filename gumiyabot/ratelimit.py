@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+"""
+Rate limiting primitives.
+"""
+import asyncio
+import collections
+import time
+
+
+class TokenBucket(object):
+    """Token bucket allowing bursts of up to burst messages, refilled at rate tokens per second"""
+
+    def __init__(self, rate, burst, clock=time.monotonic):
+        self.rate = float(rate)
+        self.burst = burst
+        self.clock = clock
+        self.tokens = float(burst)
+        self.updated = clock()
+        self.stalls = 0
+        self.stalled_time = 0.0
+
+    def _refill(self):
+        now = self.clock()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_acquire(self):
+        """Take a token if one is available
+
+        Returns 0 on success, otherwise the number of seconds until the next
+        token will be available.
+        """
+        self._refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def refund(self):
+        """Return a token taken by try_acquire or acquire that was not used"""
+        self.tokens = min(self.burst, self.tokens + 1)
+
+    async def acquire(self):
+        """Wait until a token is available and take it"""
+        delay = self.try_acquire()
+        if delay:
+            self.stalls += 1
+            start = self.clock()
+            while delay:
+                await asyncio.sleep(delay)
+                delay = self.try_acquire()
+            self.stalled_time += self.clock() - start
+
+
+class SlidingWindowLimiter(object):
+    """Allow at most limit events in any period second window"""
+
+    def __init__(self, limit, period, clock=time.monotonic):
+        self.limit = limit
+        self.period = period
+        self.clock = clock
+        self.events = collections.deque()
+        self.stalls = 0
+        self.stalled_time = 0.0
+
+    def _prune(self, now):
+        while self.events and self.events[0] <= now - self.period:
+            self.events.popleft()
+
+    def usage(self, limit=None):
+        """Return the fraction of limit used in the current window"""
+        self._prune(self.clock())
+        return len(self.events) / float(limit or self.limit)
+
+    def delay(self, limit=None):
+        """Return the number of seconds until another event is allowed"""
+        if limit is None:
+            limit = self.limit
+        now = self.clock()
+        self._prune(now)
+        if len(self.events) < limit:
+            return 0
+        return self.events[len(self.events) - limit] + self.period - now
+
+    def record(self):
+        self.events.append(self.clock())
+
+    async def acquire(self, limit=None):
+        """Wait until another event is allowed and record it"""
+        delay = self.delay(limit)
+        if delay:
+            self.stalls += 1
+            start = self.clock()
+            while delay:
+                await asyncio.sleep(delay)
+                delay = self.delay(limit)
+            self.stalled_time += self.clock() - start
+        self.record()
+
+
+class AdmissionController(object):
+    """Limit the number of concurrently handled requests
+
+    At most max_in_flight requests run at once, up to max_queue more wait
+    for a free slot (in arrival order). When the queue is full a request is
+    shed according to policy:
+
+        oldest    the longest waiting request is dropped (default)
+        newest    the incoming request is dropped
+        per-user  only the newest waiting request of each user is kept, a
+                  full queue then drops the oldest request
+    """
+
+    POLICIES = ('oldest', 'newest', 'per-user')
+
+    def __init__(self, max_in_flight=8, max_queue=32, policy='oldest'):
+        if policy not in self.POLICIES:
+            raise ValueError('Unknown drop policy {}'.format(policy))
+        self.max_in_flight = max_in_flight
+        self.max_queue = max_queue
+        self.policy = policy
+        self.in_flight = 0
+        self.waiting = collections.OrderedDict()
+        self.admitted = 0
+        self.shed = 0
+
+    def _shed(self, key):
+        (fut, _) = self.waiting.pop(key)
+        if not fut.done():
+            fut.set_result(False)
+        self.shed += 1
+
+    async def admit(self, user=None):
+        """Wait for a free slot
+
+        Returns True once the request may run (release() must be called when
+        it is done), or False if the request was shed.
+        """
+        if self.in_flight < self.max_in_flight and not self.waiting:
+            self.in_flight += 1
+            self.admitted += 1
+            return True
+        if self.policy == 'per-user' and user is not None:
+            for (key, (_, waiting_user)) in list(self.waiting.items()):
+                if waiting_user == user:
+                    self._shed(key)
+        if len(self.waiting) >= self.max_queue:
+            if self.policy == 'newest' or not self.max_queue:
+                self.shed += 1
+                return False
+            self._shed(next(iter(self.waiting)))
+        fut = asyncio.get_event_loop().create_future()
+        key = object()
+        self.waiting[key] = (fut, user)
+        try:
+            return await fut
+        except asyncio.CancelledError:
+            self.waiting.pop(key, None)
+            if fut.done() and not fut.cancelled() and fut.result():
+                # a slot was handed over right before cancellation
+                self.release()
+            raise
+
+    def release(self):
+        """Free the slot of an admitted request, passing it on to the next waiting request"""
+        while self.waiting:
+            (fut, _) = self.waiting.popitem(last=False)[1]
+            if not fut.done():
+                fut.set_result(True)
+                self.admitted += 1
+                return
+        self.in_flight -= 1
+
+    def stats(self):
+        return {
+            'in_flight': self.in_flight,
+            'queued': len(self.waiting),
+            'admitted': self.admitted,
+            'shed': self.shed,
+        }
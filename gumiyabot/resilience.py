@@ -0,0 +1,236 @@
+# -*- coding: utf-8 -*-
+"""
+Timeouts, hedged requests and circuit breaking for upstream API calls.
+"""
+import asyncio
+import collections
+import logging
+import time
+
+from .utils import percentile
+
+
+log = logging.getLogger(__name__)
+
+
+class UpstreamUnavailable(asyncio.TimeoutError):
+    """Raised without calling the upstream API while its circuit breaker is open
+
+    This is a TimeoutError so callers can handle it the same way as a request
+    which timed out, only without waiting for the timeout.
+    """
+
+
+class LatencyTracker(object):
+    """Keeps the last window latency samples for an endpoint"""
+
+    def __init__(self, window=200):
+        self.samples = collections.deque(maxlen=window)
+
+    def __len__(self):
+        return len(self.samples)
+
+    def add(self, latency):
+        self.samples.append(latency)
+
+    def percentile(self, pct):
+        return percentile(self.samples, pct)
+
+
+class CircuitBreaker(object):
+    """Opens after failure_threshold consecutive failures
+
+    While open, calls are rejected. After reset_timeout seconds the breaker
+    is half-open and lets a single trial call through, other calls are
+    rejected until it completes. If the trial call succeeds the breaker is
+    closed, if it fails the breaker opens again. A trial call which was
+    cancelled must be release()d so another call can be tried.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, failure_threshold=5, reset_timeout=30, clock=time.monotonic):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened = 0.0
+        self.open_count = 0
+        self.trial = False
+
+    def allow(self):
+        if self.state == self.OPEN:
+            if self.clock() - self.opened < self.reset_timeout:
+                return False
+            self.state = self.HALF_OPEN
+        if self.state == self.HALF_OPEN:
+            if self.trial:
+                return False
+            self.trial = True
+        return True
+
+    def release(self):
+        """Allow another trial call after a trial call was cancelled"""
+        self.trial = False
+
+    def record_success(self):
+        self.failures = 0
+        self.state = self.CLOSED
+        self.trial = False
+
+    def record_failure(self):
+        self.failures += 1
+        self.trial = False
+        if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+            if self.state != self.OPEN:
+                self.open_count += 1
+            self.state = self.OPEN
+            self.opened = self.clock()
+
+
+class Upstream(object):
+    """Wraps calls to one upstream API (i.e. osu! API or Tillerino)
+
+    Latency is tracked per endpoint. Once an endpoint has min_samples
+    successful calls, its timeout is derived from the observed p99 latency
+    (timeout_factor * p99, between min_timeout and the endpoint's configured
+    timeout), and if hedge is set, a second identical request is sent when
+    the first one has not completed after the observed p95 latency. Whichever
+    request completes first is used.
+
+    Failures and timeouts feed a circuit breaker shared by all endpoints;
+    while it is open calls fail immediately with UpstreamUnavailable.
+
+    If histogram (a metrics.Histogram) is set, the latency of successful calls
+    is recorded in it, labelled with upstream and endpoint.
+    """
+
+    def __init__(self, name, timeouts=None, default_timeout=15, min_timeout=1, timeout_factor=3,
+                 min_samples=20, hedge=True, failure_threshold=5, reset_timeout=30, histogram=None,
+                 clock=time.monotonic):
+        self.name = name
+        self.histogram = histogram
+        self.timeouts = dict(timeouts or {})
+        self.default_timeout = default_timeout
+        self.min_timeout = min_timeout
+        self.timeout_factor = timeout_factor
+        self.min_samples = min_samples
+        self.hedge = hedge
+        self.clock = clock
+        self.breaker = CircuitBreaker(failure_threshold=failure_threshold, reset_timeout=reset_timeout, clock=clock)
+        self.latency = collections.defaultdict(LatencyTracker)
+        self.calls = 0
+        self.failures = 0
+        self.timeouts_hit = 0
+        self.rejected = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+
+    def timeout_for(self, endpoint):
+        max_timeout = self.timeouts.get(endpoint, self.default_timeout)
+        tracker = self.latency[endpoint]
+        if len(tracker) < self.min_samples:
+            return max_timeout
+        return min(max_timeout, max(self.min_timeout, tracker.percentile(.99) * self.timeout_factor))
+
+    def hedge_delay_for(self, endpoint):
+        tracker = self.latency[endpoint]
+        if not self.hedge or len(tracker) < self.min_samples:
+            return None
+        return tracker.percentile(.95)
+
+    async def call(self, endpoint, func, *args, **kwargs):
+        """Return await func(*args, **kwargs)
+
+        Raises:
+            UpstreamUnavailable if the circuit breaker is open
+            asyncio.TimeoutError if the call timed out
+            any exception raised by func
+        """
+        if not self.breaker.allow():
+            self.rejected += 1
+            raise UpstreamUnavailable('{} is unavailable'.format(self.name))
+        self.calls += 1
+        start = self.clock()
+        state = self.breaker.state
+        try:
+            result = await asyncio.wait_for(self._hedged(endpoint, func, args, kwargs), self.timeout_for(endpoint))
+        except asyncio.TimeoutError:
+            self.timeouts_hit += 1
+            self._failed()
+            raise
+        except asyncio.CancelledError:
+            self.breaker.release()
+            raise
+        except Exception:
+            self._failed()
+            raise
+        latency = self.clock() - start
+        self.latency[endpoint].add(latency)
+        if self.histogram is not None:
+            self.histogram.observe(latency, upstream=self.name, endpoint=endpoint)
+        self.breaker.record_success()
+        if state != self.breaker.state:
+            log.info('[%s] upstream recovered, circuit breaker closed', self.name)
+        return result
+
+    def _failed(self):
+        self.failures += 1
+        state = self.breaker.state
+        self.breaker.record_failure()
+        if state != self.breaker.state:
+            log.warning(
+                '[%s] upstream is failing, circuit breaker opened for %ss', self.name, self.breaker.reset_timeout)
+
+    async def _hedged(self, endpoint, func, args, kwargs):
+        delay = self.hedge_delay_for(endpoint)
+        first = asyncio.ensure_future(func(*args, **kwargs))
+        tasks = [first]
+        try:
+            if delay is None:
+                return await first
+            (done, pending) = await asyncio.wait(tasks, timeout=delay)
+            if done:
+                return first.result()
+            self.hedged += 1
+            tasks.append(asyncio.ensure_future(func(*args, **kwargs)))
+            pending = set(tasks)
+            error = None
+            while pending:
+                (done, pending) = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is not first:
+                            self.hedge_wins += 1
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+
+    def stats(self):
+        stats = {
+            'state': self.breaker.state,
+            'calls': self.calls,
+            'failures': self.failures,
+            'timeouts': self.timeouts_hit,
+            'rejected': self.rejected,
+            'hedged': self.hedged,
+            'hedge_wins': self.hedge_wins,
+            'breaker_opened': self.breaker.open_count,
+            'endpoints': {},
+        }
+        for (endpoint, tracker) in self.latency.items():
+            stats['endpoints'][endpoint] = {
+                'samples': len(tracker),
+                'p50': tracker.percentile(.5),
+                'p95': tracker.percentile(.95),
+                'p99': tracker.percentile(.99),
+                'timeout': self.timeout_for(endpoint),
+            }
+        return stats
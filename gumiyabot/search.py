@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+"""
+In-memory beatmap search index.
+"""
+import bisect
+import heapq
+import re
+from collections import OrderedDict
+
+
+# searchable beatmap fields and their weight when ranking results
+FIELD_WEIGHTS = (('title', 4), ('artist', 3), ('version', 2), ('creator', 1))
+
+_TOKEN = re.compile(r'\w+')
+
+
+def tokenize(text):
+    """Return the lower case words in text"""
+    if not text:
+        return []
+    return _TOKEN.findall(str(text).casefold())
+
+
+class SearchIndex(object):
+    """Inverted index over beatmap artist, title, difficulty name and mapper
+
+    Every query word must match a word of the beatmap, either exactly or
+    (for words of at least min_prefix characters) as a prefix, so partial
+    titles typed in chat still match. Results are ranked by where the words
+    matched (title first) and exact matches rank above prefix matches.
+
+    At most maxsize beatmaps are indexed, the least recently added beatmap is
+    dropped first.
+    """
+
+    def __init__(self, maxsize=50000, min_prefix=2, max_prefix_tokens=64, max_query_tokens=8,
+                 max_candidates=200):
+        self.maxsize = maxsize
+        self.min_prefix = min_prefix
+        self.max_prefix_tokens = max_prefix_tokens
+        self.max_query_tokens = max_query_tokens
+        self.max_candidates = max_candidates
+        # beatmap_id -> (beatmap, {field: frozenset of tokens})
+        self.entries = OrderedDict()
+        # token -> set of beatmap_ids
+        self.postings = {}
+        # first min_prefix characters -> sorted list of the tokens starting with them, for prefix
+        # lookups (small sorted lists keep inserts and deletes cheap)
+        self.tokens = {}
+        self.searches = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, beatmap):
+        """Add (or update) a beatmap"""
+        beatmap_id = beatmap.beatmap_id
+        old = self.entries.get(beatmap_id)
+        if old is not None:
+            if old[0] is beatmap:
+                self.entries.move_to_end(beatmap_id)
+                return
+            del self.entries[beatmap_id]
+            self._unindex(beatmap_id, old[1])
+        fields = {name: frozenset(tokenize(getattr(beatmap, name, None))) for (name, _) in FIELD_WEIGHTS}
+        self.entries[beatmap_id] = (beatmap, fields)
+        for token in frozenset().union(*fields.values()):
+            ids = self.postings.get(token)
+            if ids is None:
+                ids = self.postings[token] = set()
+                if len(token) >= self.min_prefix:
+                    bisect.insort(self.tokens.setdefault(token[:self.min_prefix], []), token)
+            ids.add(beatmap_id)
+        while len(self.entries) > self.maxsize:
+            (old_id, (_, old_fields)) = self.entries.popitem(last=False)
+            self._unindex(old_id, old_fields)
+
+    def add_beatmaps(self, beatmaps):
+        for beatmap in beatmaps:
+            self.add(beatmap)
+
+    def _unindex(self, beatmap_id, fields):
+        for token in frozenset().union(*fields.values()):
+            ids = self.postings[token]
+            ids.discard(beatmap_id)
+            if not ids:
+                del self.postings[token]
+                if len(token) >= self.min_prefix:
+                    key = token[:self.min_prefix]
+                    tokens = self.tokens[key]
+                    del tokens[bisect.bisect_left(tokens, token)]
+                    if not tokens:
+                        del self.tokens[key]
+
+    def _prefix_tokens(self, token):
+        """Return indexed tokens (other than token itself) starting with token"""
+        if len(token) < self.min_prefix:
+            return []
+        tokens = self.tokens.get(token[:self.min_prefix], ())
+        i = bisect.bisect_left(tokens, token)
+        end = min(len(tokens), i + self.max_prefix_tokens)
+        matched = []
+        while i < end and tokens[i].startswith(token):
+            if tokens[i] != token:
+                matched.append(tokens[i])
+            i += 1
+        return matched
+
+    def _matching_ids(self, token, prefixed):
+        # returns the postings set itself if only one token matched, which must not be modified
+        matched = [self.postings[t] for t in prefixed]
+        if token in self.postings:
+            matched.append(self.postings[token])
+        if len(matched) == 1:
+            return matched[0]
+        return set().union(*matched)
+
+    def _score(self, fields, query):
+        score = 0
+        for (name, weight) in FIELD_WEIGHTS:
+            field_tokens = fields[name]
+            for (token, prefixed) in query:
+                if token in field_tokens:
+                    score += 2 * weight
+                elif not field_tokens.isdisjoint(prefixed):
+                    score += weight
+        return score
+
+    def search(self, query, limit=3):
+        """Return up to limit best matching beatmaps, at most one per mapset
+
+        When more than max_candidates beatmaps match, only the newest
+        (highest beatmap_id) max_candidates are ranked.
+        """
+        self.searches += 1
+        tokens = list(OrderedDict.fromkeys(tokenize(query)))[:self.max_query_tokens]
+        if not tokens:
+            return []
+        query = [(token, frozenset(self._prefix_tokens(token))) for token in tokens]
+        matches = sorted((self._matching_ids(token, prefixed) for (token, prefixed) in query), key=len)
+        candidates = matches[0]
+        for ids in matches[1:]:
+            if not candidates:
+                break
+            candidates = candidates & ids
+        if len(candidates) > self.max_candidates:
+            candidates = heapq.nlargest(self.max_candidates, candidates)
+        best = {}
+        for beatmap_id in candidates:
+            (beatmap, fields) = self.entries[beatmap_id]
+            score = (self._score(fields, query), beatmap_id)
+            mapset = beatmap.beatmapset_id
+            if mapset not in best or score > best[mapset][0]:
+                best[mapset] = (score, beatmap)
+        return [beatmap for (_, beatmap) in heapq.nlargest(limit, best.values(), key=lambda x: x[0])]
+
+    def stats(self):
+        return {
+            'beatmaps': len(self.entries),
+            'tokens': len(self.postings),
+            'searches': self.searches,
+        }
@@ -0,0 +1,240 @@
+# -*- coding: utf-8 -*-
+"""
+Sharded mode, which spreads Twitch channels over several worker processes.
+"""
+import asyncio
+import logging
+import multiprocessing
+import signal
+import time
+
+import irc3
+
+from .bancho import BanchoConnection
+from .config import (
+    load_config, make_bancho_config, make_bancho_queue, make_caches, make_http_client, make_twitch_config, open_metrics,
+    open_store, setup_logging)
+from .ipc import IpcClient, IpcServer, RemoteBanchoQueue, SharedCacheClient
+from .startup import StartupProfiler, new_event_loop
+
+
+log = logging.getLogger(__name__)
+
+
+def stop_on_signals(loop):
+    """Stop loop on SIGINT or SIGTERM
+
+    Later signals are ignored, so they cannot interrupt shutting down.
+    """
+    def stop():
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.remove_signal_handler(signum)
+            signal.signal(signum, signal.SIG_IGN)
+        loop.stop()
+
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(signum, stop)
+        except NotImplementedError:
+            # not supported on Windows, where SIGINT raises KeyboardInterrupt
+            pass
+
+
+class _Shard(object):
+
+    def __init__(self, index, args):
+        self.index = index
+        self.args = args
+        self.process = None
+        self.started = None
+        self.restart_at = None
+        self.restart_delay = None
+
+
+class ShardSupervisor(object):
+    """Runs the shard processes, restarting shards which exit unexpectedly
+
+    A shard which exited is restarted after restart_delay seconds. The delay
+    doubles (up to max_restart_delay) every time a shard exits within
+    max_restart_delay seconds of being started.
+    """
+
+    def __init__(self, context, target, restart_delay=1, max_restart_delay=60, check_interval=1,
+                 clock=time.monotonic):
+        self.context = context
+        self.target = target
+        self.restart_delay = restart_delay
+        self.max_restart_delay = max_restart_delay
+        self.check_interval = check_interval
+        self.clock = clock
+        self.shards = []
+        self._watcher = None
+        self.restarts = 0
+
+    def _spawn(self, shard):
+        shard.process = self.context.Process(
+            target=self.target, args=shard.args, name='gumiyabot-shard-{}'.format(shard.index), daemon=True)
+        shard.process.start()
+        shard.started = self.clock()
+        shard.restart_at = None
+
+    def add(self, index, args):
+        """Start a shard process running target(*args)"""
+        shard = _Shard(index, args)
+        shard.restart_delay = self.restart_delay
+        self._spawn(shard)
+        self.shards.append(shard)
+
+    def start(self):
+        """Start watching the shard processes"""
+        if self._watcher is None:
+            self._watcher = asyncio.ensure_future(self._watch())
+
+    async def _watch(self):
+        while True:
+            await asyncio.sleep(self.check_interval)
+            self.check()
+
+    def check(self):
+        """Restart shards which exited"""
+        now = self.clock()
+        for shard in self.shards:
+            if shard.restart_at is None and not shard.process.is_alive():
+                if now - shard.started < self.max_restart_delay:
+                    shard.restart_delay = min(self.max_restart_delay, shard.restart_delay * 2)
+                else:
+                    shard.restart_delay = self.restart_delay
+                shard.restart_at = now + shard.restart_delay
+                log.error('[shard] Shard %d exited unexpectedly with exit code %s, restarting it in %.0fs',
+                          shard.index, shard.process.exitcode, shard.restart_delay)
+            elif shard.restart_at is not None and now >= shard.restart_at:
+                self._spawn(shard)
+                self.restarts += 1
+
+    def stop(self, timeout=10):
+        """Ask every shard to stop, and kill shards which did not stop within timeout seconds"""
+        if self._watcher is not None:
+            self._watcher.cancel()
+            self._watcher = None
+        processes = [shard.process for shard in self.shards if shard.process.is_alive()]
+        for process in processes:
+            # shards shut down cleanly on SIGTERM (see stop_on_signals)
+            process.terminate()
+        deadline = time.monotonic() + timeout
+        for process in processes:
+            process.join(max(0, deadline - time.monotonic()))
+        for process in processes:
+            if process.is_alive():
+                log.warning('[shard] %s did not stop within %ds, killing it', process.name, timeout)
+                process.kill()
+                process.join()
+
+
+def run_sharded(config_file='config.ini', shards=2, debug=False, profiler=None):
+    """Run the Bancho bot here and spread Twitch channels over shards worker processes
+
+    This (coordinator) process sends all Bancho messages and holds the cache
+    shared by the shards, shards talk to it over a local TCP connection.
+    If metrics are enabled, this process serves them on metrics_port and
+    shard i on metrics_port + 1 + i. If profiler (a StartupProfiler) is set,
+    the shards report their startup times as well.
+    """
+    (gumiya_config, twitch_channels) = load_config(config_file)
+    twitch_channel = gumiya_config.get('twitch_channel', fallback='')
+    if twitch_channel:
+        twitch_channels.setdefault(twitch_channel, {'osu_username': gumiya_config['bancho_username']})
+
+    loop = new_event_loop(gumiya_config.get('event_loop', fallback='asyncio'))
+    if profiler is not None:
+        profiler.mark('config loaded')
+    bancho_queue = make_bancho_queue(gumiya_config)
+    ipc_server = IpcServer(bancho_queue, cache_size=gumiya_config.getint('shared_cache_size', fallback=8192))
+    (ipc_host, ipc_port) = loop.run_until_complete(ipc_server.start(
+        host='127.0.0.1', port=gumiya_config.getint('shard_ipc_port', fallback=0)))
+    (registry, metrics_server) = open_metrics(loop, gumiya_config)
+
+    supervisor = ShardSupervisor(multiprocessing.get_context('spawn'), run_shard)
+    names = sorted(twitch_channels, key=str.lower)
+    for i in range(shards):
+        shard_channels = {name: twitch_channels[name] for name in names[i::shards]}
+        if not shard_channels:
+            continue
+        supervisor.add(i, (config_file, shard_channels, i, shards, ipc_host, ipc_port, debug,
+                           profiler.started if profiler is not None else None))
+    supervisor.start()
+
+    bancho_config = make_bancho_config(gumiya_config, debug=debug)
+    bancho_bot = irc3.IrcBot(loop=loop, bancho_queue=bancho_queue, connection=BanchoConnection, metrics=registry,
+                             **bancho_config)
+    if profiler is not None:
+        profiler.attach(bancho_bot, 'bancho')
+    bancho_bot.run(forever=False)
+    log_queue = setup_logging(gumiya_config, debug=debug)
+
+    stop_on_signals(loop)
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        supervisor.stop(timeout=gumiya_config.getint('shard_stop_timeout', fallback=10))
+        if metrics_server is not None:
+            loop.run_until_complete(metrics_server.close())
+        loop.run_until_complete(ipc_server.close())
+        loop.run_until_complete(bancho_queue.close())
+        if log_queue is not None:
+            log_queue.stop()
+
+
+def run_shard(config_file, twitch_channels, shard_index, shards, ipc_host, ipc_port, debug=False,
+              profile_started=None):
+    """Run a Twitch bot for twitch_channels in a shard process
+
+    If profile_started is set, startup times (measured from profile_started)
+    are reported for this shard.
+    """
+    (gumiya_config, _) = load_config(config_file)
+
+    loop = new_event_loop(gumiya_config.get('event_loop', fallback='asyncio'))
+    if profile_started is not None:
+        profiler = StartupProfiler('shard {}'.format(shard_index), started=profile_started)
+    else:
+        profiler = None
+    ipc_client = IpcClient(ipc_host, ipc_port)
+    http_client = make_http_client(gumiya_config)
+    caches = make_caches(gumiya_config)
+    store = open_store(loop, gumiya_config, caches, shard_index=shard_index)
+    (registry, metrics_server) = open_metrics(loop, gumiya_config, port_offset=1 + shard_index)
+
+    twitch_config = make_twitch_config(gumiya_config, twitch_channels, debug=debug)
+    # Twitch rate limits apply to the account, which every shard shares
+    twitch_config.update(
+        twitch_channel='',
+        twitch_rate_limit=max(1, twitch_config['twitch_rate_limit'] // shards),
+        twitch_mod_rate_limit=max(1, twitch_config['twitch_mod_rate_limit'] // shards),
+    )
+    twitch_bot = irc3.IrcBot(loop=loop, bancho_queue=RemoteBanchoQueue(ipc_client),
+                             shared_cache=SharedCacheClient(ipc_client), http_client=http_client, store=store,
+                             metrics=registry, **caches, **twitch_config)
+    if profiler is not None:
+        profiler.mark('bot created')
+        profiler.attach(twitch_bot, 'twitch', joins=True)
+        if store is not None:
+            store.warmup.add_done_callback(lambda fut: profiler.mark('cache warmed'))
+    twitch_bot.run(forever=False)
+    log_queue = setup_logging(gumiya_config, debug=debug)
+
+    stop_on_signals(loop)
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if metrics_server is not None:
+            loop.run_until_complete(metrics_server.close())
+        if store is not None:
+            loop.run_until_complete(store.close())
+        loop.run_until_complete(ipc_client.close())
+        loop.run_until_complete(http_client.close())
+        if log_queue is not None:
+            log_queue.stop()
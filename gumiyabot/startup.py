@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+"""
+Event loop selection and startup profiling.
+"""
+import asyncio
+import logging
+import sys
+import time
+
+
+log = logging.getLogger(__name__)
+
+
+def new_event_loop(event_loop='asyncio'):
+    """Create and set the event loop for this process
+
+    event_loop is asyncio (the default event loop) or uvloop, which falls
+    back to asyncio if uvloop is not installed.
+    """
+    if event_loop == 'uvloop':
+        try:
+            import uvloop
+        except ImportError:
+            log.warning('[startup] uvloop is not installed, using the default asyncio event loop')
+        else:
+            asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    elif event_loop != 'asyncio':
+        raise ValueError('Unknown event_loop {!r}, use asyncio or uvloop'.format(event_loop))
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    return loop
+
+
+class StartupProfiler(object):
+    """Reports how long startup steps took, until the first channel was joined
+
+    Times are measured from started (by default when the profiler was
+    created) and written to stream as they happen.
+    """
+
+    def __init__(self, name='gumiyabot', started=None, stream=None, clock=time.monotonic):
+        self.name = name
+        self.clock = clock
+        self.started = clock() if started is None else started
+        self.stream = stream
+        self.marks = []
+
+    def mark(self, step):
+        """Record the time at which step finished, only the first time it is called for step"""
+        if any(name == step for (name, _) in self.marks):
+            return
+        elapsed = self.clock() - self.started
+        self.marks.append((step, elapsed))
+        print('[startup] {}: {} after {:.3f}s'.format(self.name, step, elapsed), file=self.stream or sys.stderr)
+
+    def attach(self, bot, name, joins=False):
+        """Mark when bot has connected and (if joins is set) when it joined its first channel"""
+        import irc3
+
+        def connected(**kwargs):
+            self.mark('{} connected'.format(name))
+
+        def joined(mask=None, **kwargs):
+            if mask is not None and mask.nick == bot.nick:
+                self.mark('first channel joined')
+
+        events = [irc3.event(irc3.rfc.CONNECTED, connected)]
+        if joins:
+            events.append(irc3.event(irc3.rfc.JOIN, joined))
+        bot.attach_events(*events)
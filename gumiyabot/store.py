@@ -0,0 +1,314 @@
+# -*- coding: utf-8 -*-
+"""
+Optional SQLite backed persistent store for osu! API data.
+
+Beatmaps, pp results and user lookups are written to disk in batches from a
+background thread (write-behind), so the event loop never waits on SQLite.
+On startup the most requested entries are loaded back into the in-memory
+caches, so a restarted bot can answer popular links immediately.
+"""
+import asyncio
+import collections
+import concurrent.futures
+import json
+import logging
+import sqlite3
+import time
+
+from osuapi.model import User
+
+from .beatmap import BeatmapRecord, value_to_json
+
+
+log = logging.getLogger(__name__)
+
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS beatmaps (
+    beatmap_id INTEGER PRIMARY KEY,
+    beatmapset_id INTEGER NOT NULL,
+    data TEXT NOT NULL,
+    fetched REAL NOT NULL,
+    hits INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS beatmaps_beatmapset_id ON beatmaps (beatmapset_id);
+CREATE TABLE IF NOT EXISTS mapsets (
+    beatmapset_id INTEGER PRIMARY KEY,
+    beatmap_ids TEXT NOT NULL,
+    fetched REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS pp (
+    key TEXT PRIMARY KEY,
+    beatmap_id INTEGER NOT NULL,
+    data TEXT NOT NULL,
+    fetched REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS users (
+    username TEXT PRIMARY KEY,
+    data TEXT NOT NULL,
+    fetched REAL NOT NULL,
+    hits INTEGER NOT NULL DEFAULT 0
+);
+'''
+
+
+def _to_json(value):
+    if isinstance(value, list):
+        if all(isinstance(v, str) for v in value):
+            # CsvList
+            return ','.join(value)
+        return [model_to_dict(v) for v in value]
+    return value_to_json(value)
+
+
+def model_to_dict(obj):
+    """Convert an osuapi model (or BeatmapRecord) back into the osu! API JSON it was created from"""
+    if isinstance(obj, BeatmapRecord):
+        return obj.to_dict()
+    data = {}
+    values = vars(obj)
+    for (name, attr) in type(obj).__attributemodel__.items():
+        if attr.field_name in values:
+            data[name] = _to_json(values[attr.field_name])
+    return data
+
+
+class PersistentStore(object):
+    """Write-behind SQLite store for beatmaps, pp results and users
+
+    At most max_pending writes wait for the next flush, the oldest pending
+    writes are dropped beyond that. If a flush fails because the database
+    could not be opened or written (i.e. it is locked by another process),
+    the batch is kept and written by the next flush.
+    """
+
+    def __init__(self, path, flush_interval=5, hot_set_size=2000, max_pending=10000):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.hot_set_size = hot_set_size
+        self.max_pending = max_pending
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self._conn = None
+        self._pending = collections.deque()
+        self._hits = collections.Counter()
+        self._user_hits = collections.Counter()
+        self._flusher = None
+        self.warmup = None
+        self.writes = 0
+        self.flushes = 0
+        self.errors = 0
+        self.dropped = 0
+
+    def _connect(self):
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            try:
+                conn.execute('PRAGMA journal_mode=WAL')
+                conn.execute('PRAGMA synchronous=NORMAL')
+                conn.executescript(SCHEMA)
+            except sqlite3.Error:
+                conn.close()
+                raise
+            self._conn = conn
+        return self._conn
+
+    async def _run(self, func, *args):
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self._executor, func, *args)
+
+    def start(self):
+        """Start the background flush task"""
+        if self._flusher is None:
+            self._flusher = asyncio.ensure_future(self._flush_loop())
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                log.warning('[store] Could not write to %s: %s', self.path, e)
+
+    # writes
+
+    # Pending writes are kept as (kind, args) and only serialized in the
+    # writer thread.
+
+    def _add(self, kind, args):
+        if len(self._pending) >= self.max_pending:
+            self._pending.popleft()
+            self.dropped += 1
+        self._pending.append((kind, args))
+
+    def put_beatmaps(self, beatmaps, complete_mapset=False):
+        self._add('beatmaps', (list(beatmaps), complete_mapset, time.time()))
+
+    def record_hit(self, beatmap_id):
+        self._hits[int(beatmap_id)] += 1
+
+    def put_pp(self, key, data):
+        """Store a pp cache entry, key is a pp cache key ending in (beatmap_id, mods)"""
+        self._add('pp', (key, data, time.time()))
+
+    def put_user(self, username, users):
+        self._add('user', (username.lower(), list(users), time.time()))
+
+    def record_user_hit(self, username):
+        self._user_hits[username.lower()] += 1
+
+    def _write_beatmaps(self, conn, beatmaps, complete_mapset, fetched):
+        conn.executemany(
+            'INSERT INTO beatmaps (beatmap_id, beatmapset_id, data, fetched) VALUES (?, ?, ?, ?) '
+            'ON CONFLICT(beatmap_id) DO UPDATE SET '
+            'beatmapset_id=excluded.beatmapset_id, data=excluded.data, fetched=excluded.fetched',
+            [(b.beatmap_id, b.beatmapset_id, json.dumps(model_to_dict(b)), fetched) for b in beatmaps])
+        if complete_mapset and beatmaps:
+            conn.execute(
+                'INSERT OR REPLACE INTO mapsets (beatmapset_id, beatmap_ids, fetched) VALUES (?, ?, ?)',
+                (beatmaps[0].beatmapset_id, json.dumps([b.beatmap_id for b in beatmaps]), fetched))
+
+    def _write_pp(self, conn, key, data, fetched):
+        conn.execute(
+            'INSERT OR REPLACE INTO pp (key, beatmap_id, data, fetched) VALUES (?, ?, ?, ?)',
+            (json.dumps(key), key[-2], json.dumps(data), fetched))
+
+    def _write_user(self, conn, username, users, fetched):
+        conn.execute(
+            'INSERT INTO users (username, data, fetched) VALUES (?, ?, ?) '
+            'ON CONFLICT(username) DO UPDATE SET data=excluded.data, fetched=excluded.fetched',
+            (username, json.dumps([model_to_dict(u) for u in users]), fetched))
+
+    def _write_batch(self, batch, hits, user_hits):
+        writers = {
+            'beatmaps': self._write_beatmaps,
+            'pp': self._write_pp,
+            'user': self._write_user,
+        }
+        conn = self._connect()
+        with conn:
+            for (kind, args) in batch:
+                writers[kind](conn, *args)
+            conn.executemany(
+                'UPDATE beatmaps SET hits = hits + ? WHERE beatmap_id = ?',
+                [(count, beatmap_id) for (beatmap_id, count) in hits.items()])
+            conn.executemany(
+                'UPDATE users SET hits = hits + ? WHERE username = ?',
+                [(count, username) for (username, count) in user_hits.items()])
+
+    async def flush(self):
+        """Write all pending changes to disk
+
+        If the database cannot be opened or written, the changes are kept
+        for the next flush. Changes that cannot be written for any other
+        reason are dropped. Errors are raised in both cases.
+        """
+        if not (self._pending or self._hits or self._user_hits):
+            return
+        (batch, self._pending) = (self._pending, collections.deque())
+        (hits, self._hits) = (self._hits, collections.Counter())
+        (user_hits, self._user_hits) = (self._user_hits, collections.Counter())
+        try:
+            await self._run(self._write_batch, batch, hits, user_hits)
+        except sqlite3.OperationalError:
+            self.errors += 1
+            self._requeue(batch, hits, user_hits)
+            raise
+        except Exception:
+            self.errors += 1
+            self.dropped += len(batch)
+            raise
+        self.writes += len(batch)
+        self.flushes += 1
+
+    def _requeue(self, batch, hits, user_hits):
+        # older writes go first, and are the first to be dropped
+        batch.extend(self._pending)
+        while len(batch) > self.max_pending:
+            batch.popleft()
+            self.dropped += 1
+        self._pending = batch
+        self._hits.update(hits)
+        self._user_hits.update(user_hits)
+
+    async def close(self):
+        if self.warmup is not None and not self.warmup.done():
+            self.warmup.cancel()
+        if self._flusher is not None:
+            self._flusher.cancel()
+            self._flusher = None
+        try:
+            await self.flush()
+        except Exception as e:
+            log.warning('[store] Could not write %d pending changes to %s: %s', len(self._pending), self.path, e)
+        await self._run(self._close)
+        self._executor.shutdown(wait=True)
+
+    def _close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    # warm start
+
+    def _load_hot_set(self):
+        conn = self._connect()
+        beatmaps = conn.execute(
+            'SELECT data, fetched FROM beatmaps ORDER BY hits DESC, fetched DESC LIMIT ?',
+            (self.hot_set_size,)).fetchall()
+        mapsets = conn.execute(
+            'SELECT beatmap_ids, fetched FROM mapsets ORDER BY fetched DESC LIMIT ?',
+            (self.hot_set_size,)).fetchall()
+        pp = conn.execute(
+            'SELECT key, data, fetched FROM pp WHERE beatmap_id IN (SELECT beatmap_id FROM beatmaps '
+            'ORDER BY hits DESC, fetched DESC LIMIT ?)', (self.hot_set_size,)).fetchall()
+        users = conn.execute(
+            'SELECT username, data, fetched FROM users ORDER BY hits DESC, fetched DESC LIMIT ?',
+            (self.hot_set_size,)).fetchall()
+        beatmaps = [(BeatmapRecord.from_dict(json.loads(data)), fetched) for (data, fetched) in beatmaps]
+        mapsets = [(json.loads(data), fetched) for (data, fetched) in mapsets]
+        pp = [(tuple(json.loads(key)), json.loads(data), fetched) for (key, data, fetched) in pp]
+        users = [(username, [User(u) for u in json.loads(data)], fetched) for (username, data, fetched) in users]
+        return (beatmaps, mapsets, pp, users)
+
+    def start_warm(self, **caches):
+        """Start warm() in the background, the task is kept as warmup"""
+        self.warmup = asyncio.ensure_future(self.warm(**caches))
+        return self.warmup
+
+    async def warm(self, beatmap_cache=None, pp_cache=None, user_cache=None):
+        """Load the most requested entries into the in-memory caches
+
+        Entries are added with their remaining TTL, entries which are already
+        expired or which were cached meanwhile are skipped. Returns the
+        number of loaded entries.
+        """
+        (beatmaps, mapsets, pp, users) = await self._run(self._load_hot_set)
+        now = time.time()
+        loaded = 0
+        if beatmap_cache is not None:
+            by_id = {}
+            # beatmaps which were fetched while the store was loading
+            cached = set()
+            for (beatmap, fetched) in beatmaps:
+                by_id[beatmap.beatmap_id] = beatmap
+                if beatmap.beatmap_id in beatmap_cache.beatmaps:
+                    cached.add(beatmap.beatmap_id)
+                elif beatmap_cache.put_beatmaps([beatmap], age=now - fetched):
+                    loaded += 1
+            for (ids, fetched) in mapsets:
+                if all(beatmap_id in by_id for beatmap_id in ids) and cached.isdisjoint(ids):
+                    beatmap_cache.put_beatmaps(
+                        [by_id[beatmap_id] for beatmap_id in ids], complete_mapset=True, age=now - fetched)
+        if pp_cache is not None:
+            for (key, data, fetched) in pp:
+                ttl = pp_cache.ttl - (now - fetched)
+                if ttl > 0 and key not in pp_cache:
+                    pp_cache.set(key, data, ttl=ttl)
+                    loaded += 1
+        if user_cache is not None:
+            for (username, users, fetched) in users:
+                ttl = user_cache.ttl - (now - fetched)
+                if ttl > 0 and username not in user_cache:
+                    user_cache.set(username, users, ttl=ttl)
+                    loaded += 1
+        return loaded
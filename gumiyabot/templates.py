@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+"""
+Precompiled message templates for beatmap request replies.
+"""
+import string
+
+from osuapi.enums import OsuMod
+
+
+DEFAULT_TWITCH_TEMPLATE = (
+    '[{status}] {artist} - {title} [{version}] (by {creator}){mods}, ♫ {bpm:g}, ★ {stars:.2f}{pp}')
+DEFAULT_BANCHO_TEMPLATE = (
+    '{nick} > [http://osu.ppy.sh/b/{beatmap_id} {artist} - {title} [{version}]]{mods} '
+    '{length} ★ {stars:.2f} ♫ {bpm:g} AR{ar:g} OD{od:g}{pp}')
+
+FIELDS = frozenset([
+    'nick', 'status', 'artist', 'title', 'version', 'creator', 'beatmap_id', 'beatmapset_id', 'mods',
+    'bpm', 'stars', 'ar', 'od', 'cs', 'hp', 'length', 'pp95', 'pp98', 'pp100', 'pp',
+])
+
+_CONVERSIONS = {'r': repr, 's': str, 'a': ascii}
+
+
+class _Missing(object):
+    """Value of fields which are not known (i.e. pp without pp data), rendered as '?'"""
+
+    def __str__(self):
+        return '?'
+
+    __repr__ = __str__
+
+    def __format__(self, spec):
+        try:
+            return format('?', spec)
+        except ValueError:
+            # numeric format spec
+            return '?'
+
+
+MISSING = _Missing()
+
+# Field values used to check format specs when a template is compiled
+SAMPLE_FIELDS = {
+    'status': 'Ranked', 'artist': 'Artist', 'title': 'Title', 'version': 'Insane', 'creator': 'Creator',
+    'beatmap_id': 1, 'beatmapset_id': 1, 'mods': ' +HD', 'bpm': 180.5, 'stars': 5.25, 'ar': 9.3, 'od': 8.0,
+    'cs': 4.0, 'hp': 6.0, 'length': '3:25', 'pp95': 150, 'pp98': 180, 'pp100': 200,
+    'pp': ' | 95%: 150pp | 98%: 180pp | 100%: 200pp',
+}
+
+
+class MessageTemplate(object):
+    """A message template compiled once
+
+    Templates use str.format syntax with the names in FIELDS. {nick} is the
+    requesting user, which is filled in per request, so it cannot have a
+    format spec or conversion. Unknown values (pp95, pp98 and pp100 without
+    pp data) are rendered as '?'. Raises ValueError for invalid templates,
+    including format specs which do not fit a field's value.
+    """
+
+    def __init__(self, source):
+        self.source = source
+        self.segments = []
+        try:
+            parsed = list(string.Formatter().parse(source))
+        except ValueError as e:
+            raise ValueError('Invalid message template {!r}: {}'.format(source, e))
+        for (literal, field, spec, conversion) in parsed:
+            if field is not None:
+                if field not in FIELDS:
+                    raise ValueError('Unknown field {{{}}} in message template {!r}'.format(field, source))
+                if '{' in spec:
+                    raise ValueError('Nested fields are not supported in message template {!r}'.format(source))
+                if field == 'nick' and (spec or conversion):
+                    raise ValueError('{{nick}} cannot be formatted in message template {!r}'.format(source))
+            self.segments.append((literal, field, spec, _CONVERSIONS.get(conversion)))
+        try:
+            self.render(SAMPLE_FIELDS)
+        except (ValueError, TypeError) as e:
+            raise ValueError('Invalid format spec in message template {!r}: {}'.format(source, e))
+
+    def render(self, fields):
+        """Return the rendered message as a tuple of the parts around {nick} fields"""
+        parts = []
+        current = []
+        for (literal, field, spec, conversion) in self.segments:
+            current.append(literal)
+            if field is None:
+                continue
+            if field == 'nick':
+                parts.append(''.join(current))
+                current = []
+                continue
+            value = fields[field]
+            if conversion is not None and value is not MISSING:
+                value = conversion(value)
+            current.append(format(value, spec))
+        parts.append(''.join(current))
+        return tuple(parts)
+
+
+def fill(parts, nick):
+    """Return the message for rendered parts with {nick} filled in"""
+    return nick.join(parts)
+
+
+def beatmap_fields(beatmap, mods=OsuMod.NoMod):
+    """Return template fields for a (modded, evaluated) beatmap"""
+    (m, s) = divmod(beatmap.total_length, 60)
+    pp = getattr(beatmap, 'pp', None)
+    fields = {
+        'status': beatmap.approved.name.capitalize(),
+        'artist': beatmap.artist,
+        'title': beatmap.title,
+        'version': beatmap.version,
+        'creator': beatmap.creator,
+        'beatmap_id': beatmap.beatmap_id,
+        'beatmapset_id': beatmap.beatmapset_id,
+        'mods': '' if mods == OsuMod.NoMod else ' +{:s}'.format(mods),
+        'bpm': beatmap.bpm,
+        'stars': round(beatmap.difficultyrating, 2),
+        'ar': round(beatmap.diff_approach, 1),
+        'od': round(beatmap.diff_overall, 1),
+        'cs': round(beatmap.diff_size, 1),
+        'hp': round(beatmap.diff_drain, 1),
+        'length': '{}:{:02d}'.format(m, s),
+    }
+    if pp:
+        fields.update({
+            'pp95': round(pp[.95]),
+            'pp98': round(pp[.98]),
+            'pp100': round(pp[1.0]),
+        })
+        fields['pp'] = ' | 95%: {pp95}pp | 98%: {pp98}pp | 100%: {pp100}pp'.format(**fields)
+    else:
+        fields.update({'pp95': MISSING, 'pp98': MISSING, 'pp100': MISSING, 'pp': ''})
+    return fields
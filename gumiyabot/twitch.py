@@ -3,21 +3,108 @@
 twitch_osu_bot Twitch chat irc3 plugin.
 """
 import asyncio
+import collections
+import functools
+import itertools
 import math
 import re
+import time
 
-import async_timeout
+import aiohttp
 
 import irc3
 from irc3.plugins.command import command
 
-from osuapi import OsuApi, AHConnector
+from osuapi import OsuApi
 from osuapi.enums import OsuMod
 from osuapi.errors import HTTPError
-
+from osuapi.model import User
+
+from . import calc, metrics
+from .beatmap import BeatmapRecord
+from .cache import BeatmapCache, SingleFlight, TTLCache
+from .httpclient import HttpClient, OsuApiConnector
+from .outbound import TwitchSender
+from .prefetch import Prefetcher
+from .ratelimit import AdmissionController
+from .resilience import CircuitBreaker, Upstream
+from .search import SearchIndex
+from .store import model_to_dict
+from .templates import DEFAULT_BANCHO_TEMPLATE, DEFAULT_TWITCH_TEMPLATE, MessageTemplate, beatmap_fields, fill
 from .utils import TillerinoApi
 
 
+# Matches every supported osu! beatmap/mapset link form in a single pass:
+#   osu.ppy.sh/b/<beatmap_id>
+#   osu.ppy.sh/s/<mapset_id>
+#   osu.ppy.sh/beatmapsets/<mapset_id>[#<mode>][/<beatmap_id>]
+# optionally followed by a mod string (i.e. " +HDDT"), which must not be the
+# scheme of another link
+LINK_PATTERN = re.compile(
+    r'https?://osu\.ppy\.sh/(?:(?P<short>b)|(?P<set>s)|beatmapsets)/'
+    r'(?(short)|(?P<mapset_id>\d+)(?(set)|(#(?P<mode>[a-z]+))?/?))'
+    r'(?(set)|(?P<beatmap_id>\d+)?)'
+    r'(/?\s*\+?(?P<mods>[A-Za-z]+)(?![A-Za-z:]))?')
+
+# Substring every link must contain, used to cheaply skip regular chat messages
+LINK_PREFIX = 'osu.ppy.sh/'
+
+MOD_FLAGS = {
+    'NF': OsuMod.NoFail, 'EZ': OsuMod.Easy, 'HD': OsuMod.Hidden, 'HR': OsuMod.HardRock,
+    'SD': OsuMod.SuddenDeath, 'DT': OsuMod.DoubleTime, 'RX': OsuMod.Relax, 'HT': OsuMod.HalfTime,
+    'NC': OsuMod.Nightcore, 'FL': OsuMod.Flashlight, 'SO': OsuMod.SpunOut, 'AP': OsuMod.Autopilot,
+    'PF': OsuMod.Perfect,
+}
+
+# Mods prefetched (if enabled) until enough requests with mods were seen
+DEFAULT_PREFETCH_MODS = (OsuMod.NoMod, OsuMod.Hidden, OsuMod.HardRock, OsuMod.DoubleTime)
+
+
+def _link_rank(match):
+    if match.group('short'):
+        return 0
+    elif match.group('set'):
+        return 1
+    return 2
+
+
+def find_link(data):
+    """Return the LINK_PATTERN match for the link requested by a message, or None
+
+    /b/ links are preferred over /s/ links, which are preferred over
+    /beatmapsets/ links. Of several links of the same kind the first one is
+    used.
+    """
+    found = None
+    for m in LINK_PATTERN.finditer(data):
+        if m.group('short') and not m.group('beatmap_id'):
+            continue
+        if found is None or _link_rank(m) < _link_rank(found):
+            found = m
+            if _link_rank(m) == 0:
+                break
+    return found
+
+
+def config_bool(value):
+    """Return True for on/true/yes/1 config values"""
+    return str(value).lower() in ('on', 'true', 'yes', '1')
+
+
+@functools.lru_cache(maxsize=256)
+def parse_mods(mods):
+    """Return OsuMod flags for a mod string like 'HDDT'"""
+    mods = mods.upper()
+    mod_flags = OsuMod.NoMod
+    for i in range(0, len(mods) - 1, 2):
+        mod_flags |= MOD_FLAGS.get(mods[i:i + 2], OsuMod.NoMod)
+    return mod_flags
+
+
+# Errors from osu! API and Tillerino requests, including UpstreamUnavailable
+UPSTREAM_ERRORS = (HTTPError, aiohttp.ClientError, asyncio.TimeoutError)
+
+
 class BeatmapValidationError(Exception):
 
     def __init__(self, reason):
@@ -27,59 +114,353 @@ class BeatmapValidationError(Exception):
 @irc3.plugin
 class BaseTwitchPlugin:
 
+    # If True, pp is fetched for every requested difficulty before
+    # validate_beatmaps is called, so validation rules can use beatmap.pp
+    evaluate_beatmaps = False
+
     def __init__(self, bot):
         self.bot = bot
         self.bancho_queue = self.bot.config.get('bancho_queue')
         self.bancho_nick = self.bot.config.get('bancho_nick')
+        self.http = self.bot.config.get('http_client')
+        if self.http is None:
+            self.http = HttpClient()
         self.osu = OsuApi(
             self.bot.config.get('osu_api_key'),
-            connector=AHConnector())
+            connector=OsuApiConnector(self.http, api_base=self.bot.config.get('osu_api_base')))
         tillerino_key = self.bot.config.get('tillerino_api_key')
         if tillerino_key:
-            self.tillerino = TillerinoApi(tillerino_key)
+            self.tillerino = TillerinoApi(
+                tillerino_key, http=self.http, api_base=self.bot.config.get('tillerino_api_base'))
         else:
             self.tillerino = None
-        self.twitch_channel = self.bot.config.get('twitch_channel')
-        if not self.twitch_channel.startswith('#'):
-            self.twitch_channel = '#{}'.format(self.twitch_channel)
+        self.channels = {}
+        for (channel, settings) in (self.bot.config.get('twitch_channels') or {}).items():
+            self.channels[self._channel_name(channel)] = dict(settings)
+        twitch_channel = self.bot.config.get('twitch_channel')
+        if twitch_channel:
+            self.channels.setdefault(self._channel_name(twitch_channel), {
+                'osu_username': self.bancho_nick,
+            })
+        self.twitch_channel = next(iter(self.channels), None)
+        self.beatmap_cache = self.bot.config.get('beatmap_cache')
+        if self.beatmap_cache is None:
+            self.beatmap_cache = BeatmapCache(
+                maxsize=int(self.bot.config.get('beatmap_cache_size', 2048)),
+                ranked_ttl=int(self.bot.config.get('beatmap_cache_ttl_ranked', 24 * 60 * 60)),
+                unranked_ttl=int(self.bot.config.get('beatmap_cache_ttl_unranked', 10 * 60)))
+        self.pp_cache = self.bot.config.get('pp_cache')
+        if self.pp_cache is None:
+            self.pp_cache = TTLCache(
+                maxsize=int(self.bot.config.get('pp_cache_size', 4096)),
+                ttl=int(self.bot.config.get('pp_cache_ttl', 60 * 60)))
+        self.user_cache = self.bot.config.get('user_cache')
+        if self.user_cache is None:
+            self.user_cache = TTLCache(
+                maxsize=int(self.bot.config.get('user_cache_size', 1024)),
+                ttl=int(self.bot.config.get('user_cache_ttl', 60)),
+                stale_ttl=int(self.bot.config.get('cache_stale_ttl', 60 * 60)))
+        self.user_flight = SingleFlight()
+        self.store = self.bot.config.get('store')
+        self.shared_cache = self.bot.config.get('shared_cache')
+        self.metrics = self.bot.config.get('metrics')
+        if self.metrics is not None:
+            upstream_histogram = self.metrics.histogram(
+                'upstream_request_seconds', 'osu! API and Tillerino request latency', ['upstream', 'endpoint'])
+            self.request_histogram = self.metrics.histogram(
+                'request_seconds', 'Time from a map link in chat until the replies were queued')
+        else:
+            upstream_histogram = self.request_histogram = None
+        upstream_config = dict(
+            histogram=upstream_histogram,
+            min_timeout=float(self.bot.config.get('upstream_min_timeout', 1)),
+            hedge=config_bool(self.bot.config.get('upstream_hedge', 'on')),
+            failure_threshold=int(self.bot.config.get('upstream_failure_threshold', 5)),
+            reset_timeout=int(self.bot.config.get('upstream_reset_timeout', 30)),
+        )
+        self.osu_upstream = Upstream(
+            'osu', timeouts={'get_beatmap': 10, 'get_mapset': 15, 'get_user': 10}, **upstream_config)
+        self.tillerino_upstream = Upstream('tillerino', timeouts={'beatmapinfo': 15}, **upstream_config)
+        self.pp_cache_negative_ttl = int(self.bot.config.get('pp_cache_negative_ttl', 5 * 60))
+        self.pp_flight = SingleFlight()
+        self.pp_semaphore = asyncio.Semaphore(int(self.bot.config.get('pp_concurrency', 8)))
+        self.admission = AdmissionController(
+            max_in_flight=int(self.bot.config.get('request_concurrency', 8)),
+            max_queue=int(self.bot.config.get('request_queue_size', 32)),
+            policy=self.bot.config.get('request_drop_policy', 'oldest'))
+        self.cooldowns = TTLCache(maxsize=int(self.bot.config.get('cooldown_cache_size', 8192)))
+        self.cooldown_suppressed = 0
+        self.message_cache = TTLCache(maxsize=int(self.bot.config.get('message_cache_size', 4096)), ttl=60 * 60)
+        # compile every configured template at startup, so invalid templates fail early
+        self.templates = {}
+        for channel in [None] + list(self.channels):
+            self._template(channel, 'twitch_message_template', DEFAULT_TWITCH_TEMPLATE)
+            self._template(channel, 'bancho_message_template', DEFAULT_BANCHO_TEMPLATE)
+        self.search_index = SearchIndex(maxsize=int(self.bot.config.get('search_index_size', 50000)))
+        self.search_results = int(self.bot.config.get('search_results', 3))
+        # start with whatever is already cached, and add the beatmaps loaded from the
+        # persistent store once the (background) cache warmup is done
+        self.search_index.add_beatmaps(self.beatmap_cache.beatmaps.values())
+        if self.store is not None and self.store.warmup is not None:
+            self.store.warmup.add_done_callback(self._cache_warmed)
+        self.mod_counts = collections.Counter()
+        self.prefetch_mods = int(self.bot.config.get('prefetch_mods', 3))
+        if config_bool(self.bot.config.get('prefetch', 'off')):
+            self.prefetcher = Prefetcher(
+                self._prefetch_idle,
+                rate=float(self.bot.config.get('prefetch_rate', 1)),
+                max_jobs=int(self.bot.config.get('prefetch_queue_size', 64)))
+            asyncio.ensure_future(self.prefetcher.run())
+        else:
+            self.prefetcher = None
+        self.local_pp = self.bot.config.get('local_pp', 'off')
+        self.calculator = None
+        if self.local_pp in ('primary', 'fallback'):
+            if calc.available():
+                self.calculator = calc.LocalCalculator(
+                    self.http, self.bot.config.get('osu_file_cache_dir', 'osu_files'))
+            else:
+                self.bot.log.warning('[twitch] local_pp requires NumPy, local pp calculation is disabled')
+        self.sender = TwitchSender(
+            self.bot.privmsg,
+            limit=int(self.bot.config.get('twitch_rate_limit', 20)),
+            mod_limit=int(self.bot.config.get('twitch_mod_rate_limit', 100)),
+            period=int(self.bot.config.get('twitch_rate_period', 30)))
+        asyncio.ensure_future(self.sender.run())
+        self.messages_seen = 0
+        stats_interval = int(self.bot.config.get('twitch_stats_interval', 0))
+        if stats_interval:
+            asyncio.ensure_future(self.log_sender_stats(stats_interval))
+        user_refresh_interval = int(self.bot.config.get('user_refresh_interval', 0))
+        if user_refresh_interval:
+            asyncio.ensure_future(self.refresh_followed_users(user_refresh_interval))
+        if self.metrics is not None:
+            self.metrics.add_collector(self.collect_metrics)
+
+    def collect_metrics(self):
+        """Return metrics for the metrics endpoint"""
+        collected = [
+            ('twitch_chat_messages_total', metrics.COUNTER, 'Twitch chat messages received',
+             [({}, self.messages_seen)]),
+            ('requests_shed_total', metrics.COUNTER, 'Map requests dropped by load shedding',
+             [({}, self.admission.shed)]),
+            ('requests_on_cooldown_total', metrics.COUNTER, 'Map requests ignored because of cooldowns',
+             [({}, self.cooldown_suppressed)]),
+            ('requests_in_flight', metrics.GAUGE, 'Map requests being handled',
+             [({}, self.admission.in_flight)]),
+            ('search_index_beatmaps', metrics.GAUGE, 'Beatmaps in the search index',
+             [({}, len(self.search_index))]),
+            ('searches_total', metrics.COUNTER, 'Beatmap searches',
+             [({}, self.search_index.searches)]),
+        ]
+        if self.prefetcher is not None:
+            stats = self.prefetcher.stats()
+            collected.append(('prefetch_jobs_total', metrics.COUNTER, 'Background prefetch jobs', [
+                ({'result': result}, stats[result]) for result in ('fetched', 'skipped', 'dropped', 'failed')]))
+        collected.extend(metrics.twitch_sender_metrics(self.sender.stats()))
+        collected.extend(metrics.upstream_metrics(self.osu_upstream.stats(), 'osu'))
+        collected.extend(metrics.upstream_metrics(self.tillerino_upstream.stats(), 'tillerino'))
+        for (name, stats) in (('beatmap', self.beatmap_cache.beatmaps.stats()),
+                              ('mapset', self.beatmap_cache.mapsets.stats()),
+                              ('pp', self.pp_cache.stats()),
+                              ('message', self.message_cache.stats()),
+                              ('user', self.user_cache.stats())):
+            collected.extend(metrics.cache_metrics(name, stats))
+        return collected
 
     @irc3.event(irc3.rfc.CONNECTED)
     def connected(self, **kw):
-        self.bot.log.info('[twitch] Connected to twitch as {}'.format(self.bot.nick))
-        self.join(self.twitch_channel)
+        self.bot.log.info('[twitch] Connected to twitch as %s', self.bot.nick)
+        for channel in self.channels:
+            self.join(channel)
+
+    def _channel_name(self, channel):
+        channel = channel.lower()
+        if not channel.startswith('#'):
+            channel = '#{}'.format(channel)
+        return channel
+
+    def channel_config(self, channel, key, default=None):
+        """Return a setting for channel
+
+        Per-channel settings come from [channel:<name>] config sections and
+        fall back to the global bot config.
+        """
+        settings = self.channels.get(self._channel_name(channel), {})
+        if key in settings:
+            return settings[key]
+        return self.bot.config.get(key, default)
+
+    def _bancho_target(self, channel):
+        """Return the osu! user that receives map requests from channel"""
+        settings = self.channels.get(self._channel_name(channel), {})
+        return settings.get('bancho_target') or settings.get('osu_username') or self.bancho_nick
+
+    async def log_sender_stats(self, interval):
+        while True:
+            await asyncio.sleep(interval)
+            stats = self.sender.stats()
+            self.bot.log.info(
+                '[twitch] sent %(sent)s (%(merged)s merged replies), pending %(depth)s, dropped %(dropped)s, '
+                'latency p50 %(latency_p50).2fs p95 %(latency_p95).2fs max %(latency_max).2fs, '
+                'rate limit stalls %(rate_limit_stalls)s', stats)
+            self.bot.log.info(
+                '[twitch] requests in flight %(in_flight)s, queued %(queued)s, admitted %(admitted)s, '
+                'shed %(shed)s, on cooldown %(cooldown)s',
+                dict(self.admission.stats(), cooldown=self.cooldown_suppressed))
+            if self.prefetcher is not None:
+                self.bot.log.info(
+                    '[twitch] prefetch queued %(queued)s, fetched %(fetched)s, already cached %(skipped)s, '
+                    'dropped %(dropped)s, failed %(failed)s', self.prefetcher.stats())
+
+    @irc3.event(r'^(@(?P<tags>\S+) )?:(?P<mask>\S+) USERSTATE (?P<channel>\S+)')
+    def userstate(self, tags=None, mask=None, channel=None, **kwargs):
+        """Track whether the bot is a moderator in channel, which raises the Twitch rate limit"""
+        tags = getattr(tags, 'tagdict', tags) or {}
+        self.sender.set_moderator(channel, self._is_mod(tags))
 
     def join(self, channel):
-        self.bot.log.info('[twitch] Trying to join channel {}'.format(channel))
+        self.bot.log.info('[twitch] Trying to join channel %s', channel)
         self.bot.join(channel)
 
     def part(self, channel):
-        self.bot.log.info('[twitch] Leaving channel {}'.format(channel))
+        self.bot.log.info('[twitch] Leaving channel %s', channel)
         self.bot.part(channel)
 
-    async def _get_pp(self, beatmap, mods=OsuMod.NoMod):
+    def _share(self, namespace, key, value, ttl):
+        """Add an entry to the cache shared with other shard processes"""
+        if self.shared_cache is not None and ttl > 0:
+            asyncio.ensure_future(self.shared_cache.set(namespace, key, value, ttl))
+
+    async def _get_shared_pp(self, key):
+        """Return pp data from the shared cache and add it to the local pp cache"""
+        if self.shared_cache is None:
+            return None
+        (data, age) = await self.shared_cache.get('pp', key)
+        if data:
+            self.pp_cache.set(key, data, ttl=max(1, self.pp_cache.ttl - age))
+            return data
+        return None
+
+    async def _fetch_pp_data(self, beatmap_id, mods):
+        data = await self._get_shared_pp((beatmap_id, mods))
+        if data:
+            return data
+        try:
+            data = await self.tillerino_upstream.call(
+                'beatmapinfo', self.tillerino.beatmapinfo, beatmap_id, mods=mods)
+        except UPSTREAM_ERRORS:
+            data = self.pp_cache.peek((beatmap_id, mods), stale=True)
+            if data:
+                return data
+            raise
+        if data:
+            self.pp_cache.set((beatmap_id, mods), data)
+            self._share('pp', (beatmap_id, mods), data, self.pp_cache.ttl)
+            if self.store:
+                self.store.put_pp((beatmap_id, mods), data)
+        else:
+            # Tillerino has no data (yet) for this map + mods combination,
+            # remember that for a while instead of asking again on every link
+            data = {}
+            self.pp_cache.set((beatmap_id, mods), data, ttl=self.pp_cache_negative_ttl)
+        return data
+
+    async def _get_pp_data(self, beatmap_id, mods=0):
+        """Return (possibly cached) Tillerino beatmapinfo for a map + mods combination
+
+        Concurrent lookups for the same map and mods share a single Tillerino
+        request. An empty dict is returned when Tillerino has no data.
+        """
+        key = (beatmap_id, mods)
+        data = self.pp_cache.get(key)
+        if data is None:
+            data = await self.pp_flight.do(key, self._fetch_pp_data, beatmap_id, mods)
+        return data
+
+    async def _fetch_local_pp_data(self, beatmap, mods):
+        data = await self._get_shared_pp(('local', beatmap.beatmap_id, mods))
+        if data:
+            return data
+        data = await asyncio.wait_for(self.calculator.beatmapinfo(beatmap, mods=mods), 15)
+        self.pp_cache.set(('local', beatmap.beatmap_id, mods), data)
+        self._share('pp', ('local', beatmap.beatmap_id, mods), data, self.pp_cache.ttl)
+        if self.store:
+            self.store.put_pp(('local', beatmap.beatmap_id, mods), data)
+        return data
+
+    async def _get_local_pp_data(self, beatmap, mods=0):
+        """Return (possibly cached) locally calculated beatmapinfo for a map + mods combination"""
+        key = ('local', beatmap.beatmap_id, mods)
+        data = self.pp_cache.get(key)
+        if data is None:
+            data = await self.pp_flight.do(key, self._fetch_local_pp_data, beatmap, mods)
+        return data
+
+    def _pp_sources(self, beatmap, mods=OsuMod.NoMod):
+        """Return pp lookup coroutine functions in the order they should be tried"""
+        sources = []
         if self.tillerino:
+            sources.append(functools.partial(self._get_pp_data, beatmap.beatmap_id, mods=mods.value))
+        if self.calculator:
+            local = functools.partial(self._get_local_pp_data, beatmap, mods=mods.value)
+            if self.local_pp == 'primary':
+                sources.insert(0, local)
+            else:
+                sources.append(local)
+        return sources
+
+    async def _with_pp(self, beatmap, mods=OsuMod.NoMod):
+        """Return a copy of beatmap with pp (None if unavailable) and star rating set"""
+        stars = None
+        for source in self._pp_sources(beatmap, mods=mods):
             try:
-                with async_timeout.timeout(15):
-                    data = await self.tillerino.beatmapinfo(beatmap.beatmap_id, mods=mods.value)
+                data = await source()
                 if data:
                     if 'starDiff' in data:
-                        # use Tillerino star rating since it factors in mods
-                        beatmap.difficultyrating = data['starDiff']
+                        # use Tillerino (or calculated) star rating since it factors in mods
+                        stars = data['starDiff']
                     pp = {
                         float(acc): pp_val
                         for acc, pp_val in data.get('ppForAcc', {}).items()
                     }
                     if pp:
-                        beatmap.pp = pp
-                        return pp
-            except (HTTPError, asyncio.TimeoutError) as e:
-                self.bot.log.debug('[twitch] {}'.format(e))
-        beatmap.pp = None
-        return None
+                        return beatmap.with_pp(pp, stars=stars)
+            except UPSTREAM_ERRORS + (calc.CalculationError,) as e:
+                self.bot.log.debug('[twitch] %s', e)
+        return beatmap.with_pp(None, stars=stars)
+
+    async def _evaluate_beatmap(self, beatmap, mods=OsuMod.NoMod):
+        async with self.pp_semaphore:
+            return await self._with_pp(beatmap, mods=mods)
+
+    async def get_beatmaps_pp(self, beatmaps, mods=OsuMod.NoMod):
+        """Return modded copies of beatmaps with pp and star rating filled in
+
+        pp for all beatmaps is fetched concurrently, with at most pp_concurrency
+        lookups running at once.
+        """
+        return await asyncio.gather(*[
+            self._evaluate_beatmap(self._apply_mods(beatmap, mods), mods=mods)
+            for beatmap in beatmaps
+        ])
+
+    async def _validate(self, beatmaps, mods=OsuMod.NoMod, **kwargs):
+        """Return validated, modded beatmaps"""
+        if self.evaluate_beatmaps:
+            beatmaps = await self.get_beatmaps_pp(beatmaps, mods=mods)
+            return self.validate_beatmaps(beatmaps, **kwargs)
+        return [self._apply_mods(beatmap, mods) for beatmap in self.validate_beatmaps(beatmaps, **kwargs)]
 
     def validate_beatmaps(self, beatmaps, **kwargs):
         """Return subset of maps in beatmaps that pass validation criteria
 
+        The requesting Twitch channel is passed as the channel keyword
+        argument, per-channel settings can be read with channel_config().
+
+        If evaluate_beatmaps is set, beatmaps already have mods applied and
+        beatmap.pp set (None if pp is unavailable).
+
         Raises:
             BeatmapValidationError if a map fails validation
 
@@ -87,68 +468,212 @@ class BaseTwitchPlugin:
         """
         return beatmaps
 
-    async def _beatmap_msg(self, beatmap, mods=OsuMod.NoMod):
-        if mods == OsuMod.NoMod:
-            mod_string = ''
-        else:
-            mod_string = ' +{:s}'.format(mods)
-        beatmap = self._apply_mods(beatmap, mods)
-        # get pp before generating message since it may update star rating based on
-        await self._get_pp(beatmap, mods=mods)
-        msg = '[{}] {} - {} [{}] (by {}){}, ♫ {:g}, ★ {:.2f}'.format(
-            beatmap.approved.name.capitalize(),
-            beatmap.artist,
-            beatmap.title,
-            beatmap.version,
-            beatmap.creator,
-            mod_string,
-            beatmap.bpm,
-            round(beatmap.difficultyrating, 2),
-        )
-        if beatmap.pp:
-            msg = ' | '.join([
-                msg,
-                '95%: {}pp'.format(round(beatmap.pp[.95])),
-                '98%: {}pp'.format(round(beatmap.pp[.98])),
-                '100%: {}pp'.format(round(beatmap.pp[1.0])),
-            ])
-        return msg
+    def _cache_warmed(self, fut):
+        if fut.cancelled():
+            return
+        if fut.exception() is not None:
+            self.bot.log.warning('[twitch] Cache warmup failed: %s', fut.exception())
+            return
+        self.bot.log.info('[twitch] Loaded %d cache entries from the persistent store', fut.result())
+        self.search_index.add_beatmaps(self.beatmap_cache.beatmaps.values())
+
+    def _template(self, channel, name, default):
+        """Return the compiled message template setting name for channel"""
+        source = self.channel_config(channel, name, '') if channel else self.bot.config.get(name, '')
+        source = source or default
+        template = self.templates.get(source)
+        if template is None:
+            template = self.templates[source] = MessageTemplate(source)
+        return template
+
+    def _render(self, template, beatmap, mods=OsuMod.NoMod, nick=''):
+        """Render a message for an evaluated beatmap
+
+        Rendered messages are cached per beatmap (id, status and last
+        update), mods, template, star rating and pp, only the requesting
+        user's nick is filled in per request.
+        """
+        if not isinstance(beatmap, BeatmapRecord):
+            return fill(template.render(beatmap_fields(beatmap, mods)), nick)
+        pp = getattr(beatmap, 'pp', None)
+        key = (template.source, beatmap.beatmap_id, beatmap.approved, beatmap.last_update, mods.value,
+               beatmap.difficultyrating, tuple(sorted(pp.items())) if pp else None)
+        parts = self.message_cache.get(key)
+        if parts is None:
+            parts = template.render(beatmap_fields(beatmap, mods))
+            self.message_cache.set(key, parts)
+        return fill(parts, nick)
+
+    async def _beatmap_msg(self, beatmap, mods=OsuMod.NoMod, channel=None, nick=''):
+        # get pp before generating message since it may update star rating based on mods
+        if not hasattr(beatmap, 'pp'):
+            beatmap = await self._with_pp(beatmap, mods=mods)
+        template = self._template(channel, 'twitch_message_template', DEFAULT_TWITCH_TEMPLATE)
+        return self._render(template, beatmap, mods=mods, nick=nick)
+
+    async def _get_shared_beatmaps(self, namespace, key):
+        """Return beatmaps from the shared cache and add them to the local beatmap cache"""
+        if self.shared_cache is None:
+            return None
+        (data, age) = await self.shared_cache.get(namespace, key)
+        if not data:
+            return None
+        beatmaps = [BeatmapRecord.from_dict(b) for b in data]
+        self.beatmap_cache.put_beatmaps(beatmaps, complete_mapset=(namespace == 'mapset'), age=age)
+        self.search_index.add_beatmaps(beatmaps)
+        return beatmaps
+
+    def _share_beatmaps(self, namespace, key, beatmaps):
+        if self.shared_cache is not None and beatmaps:
+            ttl = min(self.beatmap_cache.ttl_for(beatmap) for beatmap in beatmaps)
+            self._share(namespace, key, [model_to_dict(beatmap) for beatmap in beatmaps], ttl)
+
+    async def _get_mapset(self, beatmapset_id):
+        """Return all difficulties in a mapset, using the beatmap cache if possible"""
+        mapset = self.beatmap_cache.get_mapset(beatmapset_id)
+        if mapset is None:
+            mapset = await self._get_shared_beatmaps('mapset', int(beatmapset_id))
+        if mapset is None:
+            try:
+                mapset = await self.osu_upstream.call(
+                    'get_mapset', self.osu.get_beatmaps,
+                    beatmapset_id=beatmapset_id,
+                    include_converted=0)
+            except UPSTREAM_ERRORS:
+                mapset = self.beatmap_cache.get_mapset(beatmapset_id, stale=True)
+                if mapset is not None:
+                    return mapset
+                raise
+            mapset = [BeatmapRecord.from_model(beatmap) for beatmap in mapset]
+            self.beatmap_cache.put_beatmaps(mapset, complete_mapset=True)
+            self.search_index.add_beatmaps(mapset)
+            self._share_beatmaps('mapset', int(beatmapset_id), mapset)
+            if self.store:
+                self.store.put_beatmaps(mapset, complete_mapset=True)
+        return mapset
+
+    async def _get_beatmap(self, beatmap_id):
+        """Return a list containing the requested beatmap, using the beatmap cache if possible"""
+        if self.store:
+            self.store.record_hit(beatmap_id)
+        beatmap = self.beatmap_cache.get_beatmap(beatmap_id)
+        if beatmap is not None:
+            return [beatmap]
+        beatmaps = await self._get_shared_beatmaps('beatmap', int(beatmap_id))
+        if beatmaps is not None:
+            return beatmaps
+        try:
+            beatmaps = await self.osu_upstream.call(
+                'get_beatmap', self.osu.get_beatmaps,
+                beatmap_id=beatmap_id,
+                include_converted=0)
+        except UPSTREAM_ERRORS:
+            beatmap = self.beatmap_cache.get_beatmap(beatmap_id, stale=True)
+            if beatmap is not None:
+                return [beatmap]
+            raise
+        beatmaps = [BeatmapRecord.from_model(beatmap) for beatmap in beatmaps]
+        self.beatmap_cache.put_beatmaps(beatmaps)
+        self.search_index.add_beatmaps(beatmaps)
+        self._share_beatmaps('beatmap', int(beatmap_id), beatmaps)
+        if self.store:
+            self.store.put_beatmaps(beatmaps)
+        return beatmaps
+
+    def _prefetch_idle(self):
+        """Prefetch only while no map requests are waiting and at most half of the request slots are used"""
+        return (not self.admission.waiting
+                and self.admission.in_flight <= self.admission.max_in_flight // 2
+                and self.osu_upstream.breaker.state == CircuitBreaker.CLOSED)
+
+    def _popular_mods(self, exclude=OsuMod.NoMod):
+        """Return the prefetch_mods most requested mod combinations, other than exclude"""
+        popular = []
+        requested = (OsuMod(value) for (value, _) in self.mod_counts.most_common())
+        for mods in itertools.chain(requested, DEFAULT_PREFETCH_MODS):
+            if mods != exclude and mods not in popular:
+                popular.append(mods)
+                if len(popular) >= self.prefetch_mods:
+                    break
+        return popular
+
+    def _schedule_prefetch(self, beatmap, mods=OsuMod.NoMod):
+        """Warm the caches for likely follow-up requests after a request for beatmap
+
+        The rest of the mapset is fetched (then pp for every difficulty with
+        the same mods), and pp for the requested difficulty with the most
+        requested mods. The newest job runs first, so jobs are scheduled
+        from least to most important.
+        """
+        if self.tillerino or self.calculator:
+            for pp_mods in reversed(self._popular_mods(exclude=mods)):
+                self.prefetcher.schedule(
+                    ('pp', beatmap.beatmap_id, pp_mods.value), self._prefetch_pp, beatmap, mods=pp_mods)
+        self.prefetcher.schedule(
+            ('mapset', beatmap.beatmapset_id), self._prefetch_mapset, beatmap.beatmapset_id, mods=mods)
+
+    async def _prefetch_mapset(self, beatmapset_id, mods=OsuMod.NoMod):
+        """Cache every difficulty of a mapset and schedule pp lookups for them"""
+        mapset = self.beatmap_cache.peek_mapset(beatmapset_id)
+        fetched = mapset is None
+        if fetched:
+            mapset = await self._get_mapset(beatmapset_id)
+        if self.tillerino or self.calculator:
+            for beatmap in mapset or []:
+                self.prefetcher.schedule(
+                    ('pp', beatmap.beatmap_id, mods.value), self._prefetch_pp, beatmap, mods=mods)
+        return fetched
+
+    async def _prefetch_pp(self, beatmap, mods=OsuMod.NoMod):
+        """Look up pp for a map + mods combination unless it is already cached"""
+        keys = []
+        if self.tillerino:
+            keys.append((beatmap.beatmap_id, mods.value))
+        if self.calculator:
+            keys.append(('local', beatmap.beatmap_id, mods.value))
+        if any(self.pp_cache.peek(key) is not None for key in keys):
+            return False
+        for source in self._pp_sources(beatmap, mods=mods):
+            try:
+                if await source():
+                    break
+            except UPSTREAM_ERRORS + (calc.CalculationError,) as e:
+                self.bot.log.debug('[twitch] prefetch: %s', e)
+        return True
 
     async def _request_mapset(self, match, mask, target, mods=OsuMod.NoMod, **kwargs):
         try:
-            with async_timeout.timeout(15):
-                mapset = await self.osu.get_beatmaps(
-                    beatmapset_id=match.group('mapset_id'),
-                    include_converted=0)
+            mapset = await self._get_mapset(match.group('mapset_id'))
             if not mapset:
                 return (None, None)
             mapset = sorted(mapset, key=lambda x: x.difficultyrating)
-        except (HTTPError, asyncio.TimeoutError) as e:
-            self.bot.log.debug('[twitch] {}'.format(e))
+        except UPSTREAM_ERRORS as e:
+            self.bot.log.debug('[twitch] %s', e)
             return (None, None)
         try:
-            beatmap = self.validate_beatmaps(mapset, **kwargs)[-1]
+            beatmap = (await self._validate(mapset, mods=mods, channel=target, **kwargs))[-1]
         except BeatmapValidationError as e:
             return (None, e.reason)
-        msg = await self._beatmap_msg(beatmap, mods=mods)
+        if not hasattr(beatmap, 'pp'):
+            beatmap = await self._with_pp(beatmap, mods=mods)
+        msg = await self._beatmap_msg(beatmap, mods=mods, channel=target, nick=mask.nick)
         return (beatmap, msg)
 
     async def _request_beatmap(self, match, mask, target, mods=OsuMod.NoMod, **kwargs):
         try:
-            with async_timeout.timeout(10):
-                beatmaps = await self.osu.get_beatmaps(
-                    beatmap_id=match.group('beatmap_id'),
-                    include_converted=0)
+            beatmaps = await self._get_beatmap(match.group('beatmap_id'))
             if not beatmaps:
                 return (None, None)
-        except (HTTPError, asyncio.TimeoutError) as e:
-            self.bot.log.debug('[twitch] {}'.format(e))
+        except UPSTREAM_ERRORS as e:
+            self.bot.log.debug('[twitch] %s', e)
             return (None, None)
         try:
-            beatmap = self.validate_beatmaps(beatmaps, **kwargs)[0]
+            beatmap = (await self._validate(beatmaps, mods=mods, channel=target, **kwargs))[0]
         except BeatmapValidationError as e:
             return (None, e.reason)
-        msg = await self._beatmap_msg(beatmap, mods=mods)
+        if not hasattr(beatmap, 'pp'):
+            beatmap = await self._with_pp(beatmap, mods=mods)
+        msg = await self._beatmap_msg(beatmap, mods=mods, channel=target, nick=mask.nick)
         return (beatmap, msg)
 
     def _badge_list(self, badges):
@@ -160,15 +685,63 @@ class BaseTwitchPlugin:
                 b_list.append(badge)
         return b_list
 
+    def _is_mod(self, privmsg_tags):
+        """Check if twitch irc3 tags include mod (or broadcaster) badge"""
+        badges = self._badge_list(privmsg_tags.get('badges', ''))
+        if any(b in badges for b in ['broadcaster', 'moderator']):
+            return True
+        return str(privmsg_tags.get('mod', 0)) == '1'
+
     def _is_sub(self, privmsg_tags):
         """Check if twitch irc3 tags include sub (or mod) badge"""
         badges = self._badge_list(privmsg_tags.get('badges', ''))
         if any(b in badges for b in ['broadcaster', 'moderator', 'subscriber']):
             return True
-        elif privmsg_tags.get('mod', 0) == 1:
+        elif str(privmsg_tags.get('mod', 0)) == '1':
             return True
-        elif privmsg_tags.get('subscriber', 0) == 1:
+        elif str(privmsg_tags.get('subscriber', 0)) == '1':
+            return True
+
+    def _cooldown_keys(self, tags, mask, target, match, mods=OsuMod.NoMod):
+        """Return the (cooldown key, cooldown) pairs which apply to a link
+
+        The user is on cooldown for user_cooldown seconds after a request,
+        a map (with mods) for map_cooldown seconds after it was requested in
+        the channel. Subs and mods are exempt unless cooldown_exempt_subs is
+        off.
+        """
+        user_cooldown = float(self.channel_config(target, 'user_cooldown', 0))
+        map_cooldown = float(self.channel_config(target, 'map_cooldown', 0))
+        if not (user_cooldown or map_cooldown):
+            return []
+        if config_bool(self.channel_config(target, 'cooldown_exempt_subs', 'on')):
+            if self._is_sub(getattr(tags, 'tagdict', tags) or {}):
+                return []
+        channel = target.lower()
+        keys = []
+        if user_cooldown:
+            keys.append((('user', channel, mask.nick.lower()), user_cooldown))
+        if map_cooldown:
+            if match.group('beatmap_id'):
+                map_key = ('map', channel, 'b', int(match.group('beatmap_id')), mods.value)
+            else:
+                map_key = ('map', channel, 's', int(match.group('mapset_id')), mods.value)
+            keys.append((map_key, map_cooldown))
+        return keys
+
+    def _on_cooldown(self, cooldown_keys):
+        """Check and update request cooldowns
+
+        Returns True if the request should be ignored because one of
+        cooldown_keys (from _cooldown_keys()) is on cooldown, otherwise
+        starts the cooldowns.
+        """
+        if any(key in self.cooldowns for (key, _) in cooldown_keys):
+            self.cooldown_suppressed += 1
             return True
+        for (key, cooldown) in cooldown_keys:
+            self.cooldowns.set(key, True, ttl=cooldown)
+        return False
 
     async def _request_beatmapsets(self, match, mask, target, **kwargs):
         """Handle "new" osu web style beatmapsets links"""
@@ -177,147 +750,128 @@ class BaseTwitchPlugin:
         else:
             return await self._request_mapset(match, mask, target, **kwargs)
 
-    def _bancho_msg(self, mask, beatmap, mods=OsuMod.NoMod):
-        m, s = divmod(beatmap.total_length, 60)
-        if mods == OsuMod.NoMod:
-            mod_string = ''
-        else:
-            mod_string = ' +{:s}'.format(mods)
-        bancho_msg = ' '.join([
-            '{} >'.format(mask.nick),
-            '[http://osu.ppy.sh/b/{} {} - {} [{}]]{}'.format(
-                beatmap.beatmap_id,
-                beatmap.artist,
-                beatmap.title,
-                beatmap.version,
-                mod_string,
-            ),
-            '{}:{:02d} ★ {:.2f} ♫ {:g} AR{:g} OD{:g}'.format(
-                m, s,
-                round(beatmap.difficultyrating, 2),
-                beatmap.bpm,
-                round(beatmap.diff_approach, 1),
-                round(beatmap.diff_overall, 1),
-            ),
-        ])
-        if beatmap.pp:
-            bancho_msg = ' | '.join([
-                bancho_msg,
-                '95%: {}pp'.format(round(beatmap.pp[.95])),
-                '98%: {}pp'.format(round(beatmap.pp[.98])),
-                '100%: {}pp'.format(round(beatmap.pp[1.0])),
-            ])
-        return bancho_msg
+    def _bancho_msg(self, mask, beatmap, mods=OsuMod.NoMod, channel=None):
+        template = self._template(channel, 'bancho_message_template', DEFAULT_BANCHO_TEMPLATE)
+        return self._render(template, beatmap, mods=mods, nick=mask.nick)
 
     def _parse_mods(self, mods):
-        mod_dict = {
-            'NF': OsuMod.NoFail, 'EZ': OsuMod.Easy, 'HD': OsuMod.Hidden, 'HR': OsuMod.HardRock,
-            'SD': OsuMod.SuddenDeath, 'DT': OsuMod.DoubleTime, 'RX': OsuMod.Relax, 'HT': OsuMod.HalfTime,
-            'NC': OsuMod.Nightcore, 'FL': OsuMod.Flashlight, 'SO': OsuMod.SpunOut, 'AP': OsuMod.Autopilot,
-            'PF': OsuMod.Perfect,
-        }
-        if (len(mods) % 2) != 0:
-            mods = mods[:-1]
-        mod_flags = OsuMod.NoMod
-        for mod in [mods.upper()[i:i + 2] for i in range(0, len(mods), 2)]:
-            mod_flags |= mod_dict.get(mod, OsuMod.NoMod)
-        return mod_flags
-
-    def _mod_ar(self, ar, ar_mul, speed_mul):
-        ar0_ms = 1800
-        ar5_ms = 1200
-        ar10_ms = 450
-        ar_ms_step1 = (ar0_ms - ar5_ms) / 5.0
-        ar_ms_step2 = (ar5_ms - ar10_ms) / 5.0
-
-        ar_ms = ar5_ms
-        ar *= ar_mul
-        if ar < 5.0:
-            ar_ms = ar0_ms - ar_ms_step1 * ar
-        else:
-            ar_ms = ar5_ms - ar_ms_step2 * (ar - 5.0)
-        # cap between 0-10 before applying HT/DT
-        ar_ms = min(ar0_ms, max(ar10_ms, ar_ms))
-        ar_ms /= speed_mul
-        if ar_ms > ar5_ms:
-            ar = (ar0_ms - ar_ms) / ar_ms_step1
-        else:
-            ar = 5.0 + (ar5_ms - ar_ms) / ar_ms_step2
-        return ar
-
-    def _mod_od(self, od, od_mul, speed_mul):
-        od0_ms = 79.5
-        od10_ms = 19.5
-        od_ms_step = (od0_ms - od10_ms) / 10.0
-
-        od *= od_mul
-        od_ms = od0_ms - math.ceil(od_ms_step * od)
-        # cap between 0-10 before applying HT/DT
-        od_ms = min(od0_ms, max(od10_ms, od_ms))
-        od_ms /= speed_mul
-        od = (od0_ms - od_ms) / od_ms_step
-        return od
+        return parse_mods(mods)
 
     def _apply_mods(self, beatmap, mods=OsuMod.NoMod):
-        """Return a copy of beatmap with difficulty modifiers applied"""
-        if mods == OsuMod.NoMod:
-            return beatmap
-
-        modded = beatmap
-
-        if (OsuMod.DoubleTime | OsuMod.Nightcore) in mods and OsuMod.HalfTime not in mods:
-            speed_mul = 1.5
-        elif OsuMod.HalfTime in mods and (OsuMod.DoubleTime | OsuMod.Nightcore) not in mods:
-            speed_mul = .75
-        else:
-            speed_mul = 1.0
-        modded.bpm *= speed_mul
-
-        if OsuMod.HardRock in mods and OsuMod.Easy not in mods:
-            od_ar_hp_mul = 1.4
-            cs_mul = 1.3
-        elif OsuMod.Easy in mods and OsuMod.HardRock not in mods:
-            od_ar_hp_mul = .5
-            cs_mul = .5
-        else:
-            od_ar_hp_mul = 1.0
-            cs_mul = 1.0
-        modded.diff_approach = self._mod_ar(beatmap.diff_approach, od_ar_hp_mul, speed_mul)
-        modded.diff_overall = self._mod_ar(beatmap.diff_overall, od_ar_hp_mul, speed_mul)
-        modded.diff_drain = min(10.0, beatmap.diff_drain * od_ar_hp_mul)
-        modded.diff_size = min(10.0, beatmap.diff_size * cs_mul)
+        """Return beatmap with difficulty modifiers applied
 
-        return modded
+        Mod adjusted beatmaps are immutable records memoized per mod
+        combination, use with_pp() to get a copy with pp set.
+        """
+        return BeatmapRecord.from_model(beatmap).with_mods(mods)
 
     @irc3.event(irc3.rfc.PRIVMSG)
     async def request_beatmap(self, tags=None, mask=None, target=None, data=None, bancho_target=None, **kwargs):
-        if not target.is_channel or not data:
+        self.messages_seen += 1
+        if not data or LINK_PREFIX not in data or not target.is_channel:
             return
-        patterns = [
-            (r'https?://osu\.ppy\.sh/b/(?P<beatmap_id>\d+)',
-             self._request_beatmap),
-            (r'https?://osu\.ppy\.sh/s/(?P<mapset_id>\d+)',
-             self._request_mapset),
-            (r'https?://osu\.ppy\.sh/beatmapsets/(?P<mapset_id>\d+)(#(?P<mode>[a-z]+))?(/(?P<beatmap_id>\d+))?',
-             self._request_beatmapsets),
-        ]
-        for pattern, callback in patterns:
-            mod_pattern = r'(/?\s*\+?(?P<mods>[A-Za-z]+))?'
-            m = re.search(''.join([pattern, mod_pattern]), data)
-            if m:
-                if m.group('mods'):
-                    mod_flags = self._parse_mods(m.group('mods'))
-                else:
-                    mod_flags = OsuMod.NoMod
-                (beatmap, msg) = await callback(m, mask, target, mods=mod_flags, **kwargs)
-                if beatmap:
-                    bancho_msg = self._bancho_msg(mask, beatmap, mods=mod_flags)
-                    if not bancho_target:
-                        bancho_target = self.bancho_nick
-                    await self.bancho_queue.put((bancho_target, bancho_msg))
-                if msg:
-                    self.bot.privmsg(target, msg)
-                break
+        if target.lower() not in self.channels:
+            return
+        started = time.monotonic()
+        m = find_link(data)
+        if m is None:
+            return
+        if m.group('short'):
+            callback = self._request_beatmap
+        else:
+            # /s/ and /beatmapsets/ links, with or without a beatmap_id
+            callback = self._request_beatmapsets
+        if m.group('mods'):
+            mod_flags = self._parse_mods(m.group('mods'))
+        else:
+            mod_flags = OsuMod.NoMod
+        cooldown_keys = self._cooldown_keys(tags, mask, target, m, mods=mod_flags)
+        if self._on_cooldown(cooldown_keys):
+            self.bot.log.debug('[twitch] Ignored request from %s in %s, on cooldown', mask.nick, target)
+            return
+        if not await self.admission.admit((target.lower(), mask.nick)):
+            # the request was never handled, so it does not count towards cooldowns
+            for (key, _) in cooldown_keys:
+                self.cooldowns.pop(key)
+            self.bot.log.debug(
+                '[twitch] Dropped request from %s in %s, too many pending requests', mask.nick, target)
+            return
+        try:
+            (beatmap, msg) = await callback(m, mask, target, mods=mod_flags, **kwargs)
+        finally:
+            self.admission.release()
+        if beatmap:
+            bancho_msg = self._bancho_msg(mask, beatmap, mods=mod_flags, channel=target)
+            if not bancho_target:
+                bancho_target = self._bancho_target(target)
+            if self.metrics is not None:
+                await self.bancho_queue.put((bancho_target, bancho_msg), started=started)
+            else:
+                await self.bancho_queue.put((bancho_target, bancho_msg))
+            if self.prefetcher is not None:
+                self.mod_counts[mod_flags.value] += 1
+                self._schedule_prefetch(beatmap, mods=mod_flags)
+        if msg:
+            self.sender.send(target, msg, batchable=beatmap is not None)
+        if self.request_histogram is not None:
+            self.request_histogram.observe(time.monotonic() - started)
+
+    async def _get_user(self, osu_username):
+        """Return osu! API get_user results for a username, using the user cache if possible
+
+        Expired (stale) cache entries are returned right away while the user
+        is refreshed in the background. Concurrent lookups of a user which
+        is not cached share a single osu! API request.
+        """
+        key = osu_username.lower()
+        if self.store:
+            self.store.record_user_hit(key)
+        users = self.user_cache.get(key)
+        if users is not None:
+            return users
+        users = self.user_cache.peek(key, stale=True)
+        if users is not None:
+            self.user_flight.start(key, self._fetch_user, osu_username)
+            return users
+        return await self.user_flight.do(key, self._fetch_user, osu_username)
+
+    async def _fetch_user(self, osu_username):
+        key = osu_username.lower()
+        if self.shared_cache is not None:
+            (data, age) = await self.shared_cache.get('user', key)
+            if data:
+                users = [User(u) for u in data]
+                self.user_cache.set(key, users, ttl=max(1, self.user_cache.ttl - age))
+                return users
+        try:
+            users = await self.osu_upstream.call('get_user', self.osu.get_user, osu_username)
+        except UPSTREAM_ERRORS as e:
+            self.bot.log.debug('[twitch] %s', e)
+            return self.user_cache.peek(key, [], stale=True)
+        if users:
+            self.user_cache.set(key, users)
+            self._share('user', key, [model_to_dict(user) for user in users], self.user_cache.ttl)
+            if self.store:
+                self.store.put_user(key, users)
+        return users
+
+    def _followed_users(self):
+        """Return the osu! usernames !stats defaults to in the joined channels"""
+        usernames = {}
+        for channel in self.channels:
+            osu_username = self.channel_config(channel, 'osu_username', self.bancho_nick)
+            if osu_username:
+                usernames.setdefault(osu_username.lower(), osu_username)
+        if self.bancho_nick:
+            usernames.setdefault(self.bancho_nick.lower(), self.bancho_nick)
+        return usernames
+
+    async def refresh_followed_users(self, interval):
+        """Refresh the streamers' own osu! stats every interval seconds, so !stats never waits on the osu! API"""
+        while True:
+            for (key, osu_username) in self._followed_users().items():
+                self.user_flight.start(key, self._fetch_user, osu_username)
+            await asyncio.sleep(interval)
 
     @command
     async def stats(self, mask, target, args, default_user=None):
@@ -325,7 +879,7 @@ class BaseTwitchPlugin:
 
             %%stats [<username>]...
         """
-        self.bot.log.debug('[twitch] !stats {}'.format(args))
+        self.bot.log.debug('[twitch] !stats %s', args)
         if target.is_channel:
             dest = target
         else:
@@ -334,16 +888,13 @@ class BaseTwitchPlugin:
         if not osu_username:
             if default_user:
                 osu_username = default_user
+            elif target.is_channel:
+                osu_username = self.channel_config(target, 'osu_username', self.bancho_nick)
             else:
                 osu_username = self.bancho_nick
-        try:
-            with async_timeout.timeout(10):
-                users = await self.osu.get_user(osu_username)
-        except (HTTPError, asyncio.TimeoutError) as e:
-            self.bot.log.debug('[twitch] {}'.format(e))
-            users = []
+        users = await self._get_user(osu_username)
         if not users:
-            self.bot.privmsg(dest, 'Could not find osu! user {}'.format(osu_username))
+            self.sender.send(dest, 'Could not find osu! user {}'.format(osu_username))
             return
         user = users[0]
         msg = ' | '.join([
@@ -354,4 +905,25 @@ class BaseTwitchPlugin:
             'Plays: {:,} (lv{})'.format(user.playcount, math.floor(user.level)),
             'https://osu.ppy.sh/users/{}'.format(user.user_id),
         ])
-        self.bot.privmsg(dest, msg)
+        self.sender.send(dest, msg)
+
+    @command
+    def search(self, mask, target, args):
+        """Search beatmaps the bot has seen by artist, title, difficulty name or mapper
+
+            %%search <query>...
+        """
+        self.bot.log.debug('[twitch] !search %s', args)
+        if target.is_channel:
+            dest = target
+        else:
+            dest = mask
+        query = ' '.join(args.get('<query>')).strip()
+        beatmaps = self.search_index.search(query, limit=self.search_results)
+        if not beatmaps:
+            self.sender.send(dest, 'No beatmaps found for {}'.format(query))
+            return
+        self.sender.send(dest, ' | '.join(
+            '{} - {} [{}] (by {}) https://osu.ppy.sh/b/{}'.format(
+                beatmap.artist, beatmap.title, beatmap.version, beatmap.creator, beatmap.beatmap_id)
+            for beatmap in beatmaps))
@@ -1,6 +1,14 @@
 # -*- coding: utf-8 -*-
 #
-import aiohttp
+from .httpclient import HttpClient
+
+
+def percentile(values, pct):
+    """Return the pct (0 to 1) percentile of values, or 0.0 if values is empty"""
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct))]
 
 
 class TillerinoApi(object):
@@ -10,16 +18,21 @@ class TillerinoApi(object):
     BOT_INFO = '/'.join((API_BASE, 'botinfo'))
     USER_BY_ID = '/'.join((API_BASE, 'userbyid'))
 
-    def __init__(self, key):
+    def __init__(self, key, http=None, api_base=None):
         self.key = key
-        self.session = None
-
-    async def _get(self, url, params={}):
-        if not self.session:
-            self.session = aiohttp.ClientSession()
+        if api_base:
+            api_base = api_base.rstrip('/')
+            self.BEATMAP_INFO = '/'.join((api_base, 'beatmapinfo'))
+            self.BOT_INFO = '/'.join((api_base, 'botinfo'))
+            self.USER_BY_ID = '/'.join((api_base, 'userbyid'))
+        if http is None:
+            http = HttpClient()
+        self.http = http
 
-        params.update({'k': self.key})
-        async with self.session.get(url, params=params) as r:
+    async def _get(self, url, params=None):
+        params = dict(params or {})
+        params['k'] = self.key
+        async with self.http.get(url, params=params) as r:
             if r.status == 200:
                 return await r.json()
             else:
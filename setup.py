@@ -8,6 +8,11 @@ version = '1.0.1'
 
 install_requires = ['aiohttp', 'irc3', 'osuapi']
 
+extras_require = {
+    'calc': ['numpy'],
+    'uvloop': ['uvloop'],
+}
+
 here = path.abspath(path.dirname(__file__))
 
 with open(path.join(here, 'README.rst'), encoding='utf-8') as f:
@@ -41,4 +46,5 @@ setup(
         'console_scripts': ['gumiyabot = gumiyabot.__main__:main'],
     },
     install_requires=install_requires,
+    extras_require=extras_require,
 )
@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import logging
+import random
+import time
+
+import pytest
+
+
+DIFFS_PER_MAPSET = 4
+
+
+def circles_map(n_objects=400, bpm=180, seed=1):
+    """Return .osu file contents for a map of streams and jumps (hit circles only)"""
+    rng = random.Random(seed)
+    beat = 60000.0 / bpm
+    lines = [
+        'osu file format v14', '',
+        '[General]', 'Mode: 0', '',
+        '[Metadata]', 'Title:Test', 'Artist:Test', 'Creator:Test', 'Version:Test', '',
+        '[Difficulty]', 'HPDrainRate:5', 'CircleSize:4', 'OverallDifficulty:8', 'ApproachRate:9',
+        'SliderMultiplier:1.8', 'SliderTickRate:1', '',
+        '[TimingPoints]', '0,{:f},4,2,0,50,1,0'.format(beat), '',
+        '[HitObjects]',
+    ]
+    t = 1000.0
+    (x, y) = (256, 192)
+    for _ in range(n_objects):
+        if rng.random() < .6:
+            t += beat / 4
+            x = min(512, max(0, x + rng.randint(-30, 30)))
+            y = min(384, max(0, y + rng.randint(-30, 30)))
+        else:
+            t += beat / 2
+            (x, y) = (rng.randint(0, 512), rng.randint(0, 384))
+        lines.append('{},{},{:.0f},1,0,0:0:0:0:'.format(x, y, t))
+    return '\n'.join(lines).encode('utf-8')
+
+
+def fake_beatmap(beatmap_id):
+    """Return osu! API get_beatmaps JSON for a fake beatmap"""
+    rng = random.Random(beatmap_id)
+    diff = beatmap_id % DIFFS_PER_MAPSET
+    length = rng.randint(60, 300)
+    return {
+        'approved': '1',
+        'approved_date': '2018-01-01 00:00:00',
+        'submit_date': '2017-12-01 00:00:00',
+        'last_update': '2017-12-24 00:00:00',
+        'artist': 'Artist {}'.format(beatmap_id // DIFFS_PER_MAPSET),
+        'artist_unicode': None,
+        'beatmap_id': str(beatmap_id),
+        'beatmapset_id': str(beatmap_id // DIFFS_PER_MAPSET),
+        'bpm': str(rng.choice([120, 150, 180, 200, 222])),
+        'creator': 'Mapper',
+        'creator_id': '1',
+        'difficultyrating': '{:.4f}'.format(2 + diff + rng.random()),
+        'diff_aim': '2.5',
+        'diff_speed': '2.5',
+        'diff_size': '4',
+        'diff_overall': str(6 + diff),
+        'diff_approach': str(6 + diff),
+        'diff_drain': '5',
+        'hit_length': str(length - 5),
+        'source': '',
+        'genre_id': '1',
+        'language_id': '1',
+        'title': 'Title {}'.format(beatmap_id // DIFFS_PER_MAPSET),
+        'title_unicode': None,
+        'total_length': str(length),
+        'version': 'Diff {}'.format(diff),
+        'file_md5': '{:032x}'.format(beatmap_id),
+        'mode': '0',
+        'tags': 'bench',
+        'favourite_count': '10',
+        'rating': '9.5',
+        'playcount': '1000',
+        'passcount': '100',
+        'count_normal': '500',
+        'count_slider': '200',
+        'count_spinner': '2',
+        'max_combo': '900',
+        'storyboard': '0',
+        'video': '0',
+        'download_unavailable': '0',
+        'audio_unavailable': '0',
+        'packs': None,
+    }
+
+
+def fake_user(username):
+    """Return osu! API get_user JSON for a fake user"""
+    user_id = sum(map(ord, username))
+    return {
+        'user_id': str(user_id),
+        'username': username,
+        'join_date': '2015-01-01 00:00:00',
+        'count300': '1000000',
+        'count100': '100000',
+        'count50': '10000',
+        'playcount': '10000',
+        'ranked_score': '1000000000',
+        'total_score': '5000000000',
+        'pp_rank': str(user_id),
+        'level': '100.5',
+        'pp_raw': '5000',
+        'accuracy': '98.5',
+        'count_rank_ss': '10',
+        'count_rank_ssh': '1',
+        'count_rank_s': '100',
+        'count_rank_sh': '10',
+        'count_rank_a': '1000',
+        'country': 'JP',
+        'total_seconds_played': '1000000',
+        'pp_country_rank': '100',
+        'events': [],
+    }
+
+
+class FakeClock(object):
+
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+async def wait_until(condition, timeout=5):
+    """Wait until condition() is true, for background tasks which use threads"""
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, 'timed out'
+        await asyncio.sleep(.01)
+
+
+class FakeBot(object):
+
+    def __init__(self, **config):
+        self.config = {
+            'twitch_channel': 'gumiyabot',
+            'bancho_nick': 'GumiyaBot',
+            'osu_api_key': '',
+            'bancho_queue': asyncio.Queue(),
+        }
+        self.config.update(config)
+        self.log = logging.getLogger('tests')
+        self.sent = []
+
+    def privmsg(self, target, msg):
+        self.sent.append((target, msg))
+
+
+@pytest.fixture
+def osu_file():
+    return circles_map()
+
+
+@pytest.fixture
+def run():
+    """Run a coroutine to completion on a new event loop"""
+    return asyncio.run
@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+import pytest
+
+from gumiyabot.bancho import LineFramer
+
+
+LINES = [
+    ':cho.ppy.sh 001 GumiyaBot :Welcome to the osu!Bancho.',
+    ':Someone!cho@ppy.sh PRIVMSG #osu :ünïcödé ♥',
+    'PING :cho.ppy.sh',
+]
+
+
+def _feed_chunks(framer, data, size):
+    lines = []
+    for i in range(0, len(data), size):
+        lines.extend(framer.feed(data[i:i + size]))
+    return lines
+
+
+@pytest.mark.parametrize('line_ending', [b'\n', b'\r\n'])
+@pytest.mark.parametrize('size', [1, 2, 3, 7, 50, 4096])
+def test_lines_split_across_chunks(line_ending, size):
+    data = b''.join(line.encode('utf8') + line_ending for line in LINES)
+    framer = LineFramer()
+    assert _feed_chunks(framer, data, size) == LINES
+    assert not framer.buffer
+
+
+def test_partial_line_is_kept():
+    framer = LineFramer()
+    assert framer.feed(b'PING :cho') == []
+    assert framer.feed(b'.ppy.sh\r') == []
+    assert framer.feed(b'\nPING') == ['PING :cho.ppy.sh']
+    assert framer.feed(b' :x\n') == ['PING :x']
+
+
+def test_mixed_line_endings_and_empty_lines():
+    framer = LineFramer()
+    assert framer.feed(b'a\r\n\nb\n\r\nc\n') == ['a', 'b', 'c']
+
+
+def test_multibyte_character_split_across_chunks():
+    framer = LineFramer()
+    data = 'PRIVMSG #osu :♥\n'.encode('utf8')
+    assert framer.feed(data[:-2]) == []
+    assert framer.feed(data[-2:]) == ['PRIVMSG #osu :♥']
+
+
+def test_overlong_partial_line_is_discarded():
+    framer = LineFramer(max_line_length=16)
+    assert framer.feed(b'x' * 32) == []
+    assert not framer.buffer
+    assert framer.feed(b'yy\nPING\n') == ['yy', 'PING']
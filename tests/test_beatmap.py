@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+import copy
+import json
+
+import pytest
+
+from osuapi.enums import BeatmapStatus, OsuMod
+from osuapi.model import Beatmap
+
+from gumiyabot.beatmap import BeatmapRecord, _scale_length, mod_difficulty
+
+from .conftest import fake_beatmap
+
+
+def _fields(record):
+    return {name: getattr(record, name) for name in BeatmapRecord.FIELDS}
+
+
+def test_from_model_matches_osuapi_model():
+    data = fake_beatmap(1234)
+    model = Beatmap(data)
+    record = BeatmapRecord.from_model(model)
+    assert record.beatmap_id == model.beatmap_id == 1234
+    assert record.approved == BeatmapStatus.ranked
+    assert record.approved_date == model.approved_date
+    assert record.diff_approach == model.diff_approach
+    assert record.version == model.version
+
+
+def test_dict_round_trip():
+    record = BeatmapRecord.from_dict(fake_beatmap(1234))
+    data = record.to_dict()
+    # to_dict returns plain JSON values
+    assert json.loads(json.dumps(data)) == data
+    assert _fields(BeatmapRecord.from_dict(data)) == _fields(record)
+
+
+def test_modded_record_serializes_unmodded_beatmap():
+    record = BeatmapRecord.from_dict(fake_beatmap(1234))
+    modded = record.with_mods(OsuMod.DoubleTime)
+    assert modded.to_dict() == record.to_dict()
+    assert modded.base is record
+
+
+def test_with_mods():
+    record = BeatmapRecord.from_dict(fake_beatmap(1234))
+    modded = record.with_mods(OsuMod.HardRock | OsuMod.DoubleTime)
+    assert modded is record.with_mods(OsuMod.HardRock | OsuMod.DoubleTime)
+    assert modded.with_mods(OsuMod.NoMod) is record
+    assert modded.mods == OsuMod.HardRock | OsuMod.DoubleTime
+    assert modded.bpm == record.bpm * 1.5
+    assert modded.total_length == round(record.total_length / 1.5)
+    assert modded.diff_size == pytest.approx(record.diff_size * 1.3)
+    assert modded.diff_approach > record.diff_approach
+
+
+@pytest.mark.parametrize('mods,expected', [
+    (OsuMod.NoMod, (4, 8, 9, 5, 1.0)),
+    (OsuMod.HardRock, (5.2, 10, 10, 7, 1.0)),
+    (OsuMod.Easy, (2, 4, 4.5, 2.5, 1.0)),
+    (OsuMod.DoubleTime, (4, 9.778, 10.333, 5, 1.5)),
+    (OsuMod.Nightcore, (4, 9.778, 10.333, 5, 1.5)),
+    (OsuMod.HalfTime, (4, 6.222, 7.667, 5, .75)),
+    # conflicting mods cancel out
+    (OsuMod.HardRock | OsuMod.Easy, (4, 8, 9, 5, 1.0)),
+    (OsuMod.DoubleTime | OsuMod.HalfTime, (4, 8, 9, 5, 1.0)),
+    (OsuMod.Nightcore | OsuMod.HalfTime, (4, 8, 9, 5, 1.0)),
+    (OsuMod.HardRock | OsuMod.Easy | OsuMod.DoubleTime, (4, 9.778, 10.333, 5, 1.5)),
+    (OsuMod.DoubleTime | OsuMod.HalfTime | OsuMod.HardRock, (5.2, 10, 10, 7, 1.0)),
+])
+def test_mod_difficulty(mods, expected):
+    assert mod_difficulty(4, 8, 9, 5, mods.value) == pytest.approx(expected, abs=.001)
+
+
+@pytest.mark.parametrize('mods,hit_length,total_length', [
+    (OsuMod.NoMod, 175, 180),
+    (OsuMod.DoubleTime, 117, 120),
+    (OsuMod.Nightcore, 117, 120),
+    (OsuMod.HalfTime, 233, 240),
+    (OsuMod.DoubleTime | OsuMod.HalfTime, 175, 180),
+    (OsuMod.HardRock, 175, 180),
+])
+def test_with_mods_scales_length(mods, hit_length, total_length):
+    data = fake_beatmap(1234)
+    data.update(hit_length='175', total_length='180')
+    modded = BeatmapRecord.from_dict(data).with_mods(mods)
+    assert (modded.hit_length, modded.total_length) == (hit_length, total_length)
+
+
+def test_scale_length():
+    assert _scale_length(100, 1.5) == 67
+    assert _scale_length(100, .75) == 133
+    assert _scale_length(None, 1.5) is None
+
+
+def test_records_are_immutable():
+    record = BeatmapRecord.from_dict(fake_beatmap(1234))
+    with pytest.raises(AttributeError):
+        record.bpm = 200
+    assert copy.copy(record) is record
+    assert copy.deepcopy(record) is record
+    with_pp = record.with_pp({1.0: 300}, stars=5.5)
+    assert (with_pp.pp, with_pp.difficultyrating) == ({1.0: 300}, 5.5)
+    # pp is only set once it was looked up
+    assert not hasattr(record, 'pp')
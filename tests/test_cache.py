@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+import asyncio
+
+import pytest
+
+from gumiyabot.beatmap import BeatmapRecord
+from gumiyabot.cache import BeatmapCache, SingleFlight, TTLCache
+
+from .conftest import FakeClock, fake_beatmap
+
+
+def test_ttl_expiry():
+    clock = FakeClock()
+    cache = TTLCache(ttl=10, clock=clock)
+    cache.set('a', 1)
+    cache.set('b', 2, ttl=20)
+    clock.now += 10
+    assert cache.get('a') is None
+    assert cache.get('b') == 2
+    assert 'a' not in cache
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_stale_entries():
+    clock = FakeClock()
+    cache = TTLCache(ttl=10, stale_ttl=5, clock=clock)
+    cache.set('a', 1)
+    clock.now += 12
+    assert cache.get('a') is None
+    assert cache.peek('a', stale=True) == 1
+    clock.now += 5
+    assert cache.peek('a', stale=True) is None
+    assert len(cache) == 0
+
+
+def test_lru_eviction():
+    cache = TTLCache(maxsize=2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    cache.get('a')
+    cache.set('c', 3)
+    assert 'b' not in cache
+    assert cache.peek('a') == 1
+    assert cache.evictions == 1
+
+
+def test_beatmap_cache_mapsets():
+    clock = FakeClock()
+    cache = BeatmapCache(ranked_ttl=100, unranked_ttl=10, clock=clock)
+    mapset = [BeatmapRecord.from_dict(fake_beatmap(beatmap_id)) for beatmap_id in (100, 101, 102)]
+    cache.put_beatmaps(mapset[:1])
+    assert cache.get_mapset(mapset[0].beatmapset_id) is None
+    cache.put_beatmaps(mapset, complete_mapset=True)
+    assert cache.get_mapset(mapset[0].beatmapset_id) == mapset
+    assert cache.get_beatmap('101') is mapset[1]
+    # a missing difficulty invalidates the mapset entry
+    cache.beatmaps.pop(102)
+    assert cache.get_mapset(mapset[0].beatmapset_id) is None
+    clock.now += 100
+    assert cache.get_beatmap(100) is None
+
+
+def test_single_flight_coalesces_calls(run):
+    calls = []
+
+    async def fetch(key):
+        calls.append(key)
+        await asyncio.sleep(.01)
+        return key * 2
+
+    async def main():
+        flight = SingleFlight()
+        results = await asyncio.gather(*[flight.do(k, fetch, k) for k in (1, 1, 1, 2)])
+        assert len(flight) == 0
+        assert (flight.calls, flight.coalesced) == (2, 2)
+        # finished calls are not cached
+        assert await flight.do(1, fetch, 1) == 2
+        return results
+
+    assert run(main()) == [2, 2, 2, 4]
+    assert calls == [1, 2, 1]
+
+
+def test_single_flight_shares_exceptions(run):
+
+    async def fail():
+        await asyncio.sleep(.01)
+        raise ValueError('upstream error')
+
+    async def main():
+        flight = SingleFlight()
+        return await asyncio.gather(flight.do('k', fail), flight.do('k', fail), return_exceptions=True)
+
+    results = run(main())
+    assert [type(e) for e in results] == [ValueError, ValueError]
+
+
+def test_single_flight_survives_cancelled_waiter(run):
+
+    async def fetch():
+        await asyncio.sleep(.02)
+        return 'done'
+
+    async def main():
+        flight = SingleFlight()
+        first = asyncio.ensure_future(flight.do('k', fetch))
+        second = asyncio.ensure_future(flight.do('k', fetch))
+        await asyncio.sleep(0)
+        first.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await first
+        return await second
+
+    assert run(main()) == 'done'
@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+import pytest
+
+from osuapi.enums import OsuMod
+from osuapi.model import Beatmap
+
+from gumiyabot import calc
+
+
+pytestmark = pytest.mark.skipif(not calc.available(), reason='requires NumPy')
+
+
+# (mods, stars, pp for SS) for conftest.circles_map(), as calculated by oppai-ng 4.1.0
+REFERENCE = [
+    (OsuMod.NoMod, 6.1078, 274.95),
+    (OsuMod.HardRock, 6.5192, 401.48),
+    (OsuMod.Easy, 5.5945, 182.21),
+    (OsuMod.DoubleTime, 8.6755, 815.08),
+    (OsuMod.Hidden | OsuMod.DoubleTime, 8.6755, 871.06),
+    (OsuMod.HalfTime, 4.8210, 129.31),
+]
+
+
+def test_parse_osu_file(osu_file):
+    osu = calc.parse_osu_file(osu_file)
+    assert (osu.cs, osu.od, osu.ar, osu.hp) == (4, 8, 9, 5)
+    assert osu.n_circles == osu.n_objects == 400
+    assert osu.max_combo == 400
+
+
+@pytest.mark.parametrize('data', [
+    b'[General]\nMode: 1\n',
+    b'[HitObjects]\n256,192\n',
+])
+def test_parse_invalid_file(data):
+    with pytest.raises(calc.CalculationError):
+        calc.parse_osu_file(data)
+
+
+@pytest.mark.parametrize('mods,stars,pp', REFERENCE)
+def test_reference_values(osu_file, mods, stars, pp):
+    info = calc.beatmap_info(calc.parse_osu_file(osu_file), mods.value)
+    assert info['starDiff'] == pytest.approx(stars, rel=.005)
+    assert info['ppForAcc'][1.0] == pytest.approx(pp, rel=.015)
+    assert info['ppForAcc'][.95] < info['ppForAcc'][.98] < info['ppForAcc'][1.0]
+
+
+@pytest.mark.parametrize('mods,same_as', [
+    (OsuMod.HardRock | OsuMod.Easy, OsuMod.NoMod),
+    (OsuMod.DoubleTime | OsuMod.HalfTime, OsuMod.NoMod),
+    (OsuMod.DoubleTime | OsuMod.HalfTime | OsuMod.HardRock, OsuMod.HardRock),
+])
+def test_conflicting_mods_reference_values(osu_file, mods, same_as):
+    (stars, pp) = {mods: (stars, pp) for (mods, stars, pp) in REFERENCE}[same_as]
+    info = calc.beatmap_info(calc.parse_osu_file(osu_file), mods.value)
+    assert info['starDiff'] == pytest.approx(stars, rel=.005)
+    assert info['ppForAcc'][1.0] == pytest.approx(pp, rel=.015)
+
+
+def test_unwritable_file_cache(run, tmp_path, osu_file):
+    # the cache directory can not be created
+    cache_dir = tmp_path / 'osu_files'
+    cache_dir.write_bytes(b'')
+
+    async def main():
+        calculator = calc.LocalCalculator(None, str(cache_dir))
+
+        async def download(beatmap_id):
+            return osu_file
+
+        calculator._download = download
+        await calculator.get_osu_file(Beatmap({'beatmap_id': '1000', 'file_md5': 'missing'}))
+
+    with pytest.raises(calc.CalculationError):
+        run(main())
@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+import asyncio
+
+import pytest
+
+from aiohttp import web
+from osuapi import endpoints
+from osuapi.errors import HTTPError
+
+from gumiyabot.httpclient import HttpClient, OsuApiConnector
+
+
+class _Api(object):
+    """Local HTTP server answering with the queued status codes, then 200"""
+
+    def __init__(self, statuses=()):
+        self.statuses = list(statuses)
+        self.requests = []
+        self.runner = None
+
+    async def handle(self, request):
+        self.requests.append((request.path, dict(request.query)))
+        status = self.statuses.pop(0) if self.statuses else 200
+        if status != 200:
+            return web.Response(status=status, text='error {}'.format(status))
+        return web.json_response([{'path': request.path}])
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get('/{path:.*}', self.handle)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, '127.0.0.1', 0)
+        await site.start()
+        return 'http://127.0.0.1:{}'.format(self.runner.addresses[0][1])
+
+    async def close(self):
+        await self.runner.cleanup()
+
+
+@pytest.fixture
+def no_retry_delay(monkeypatch):
+    real_sleep = asyncio.sleep
+    monkeypatch.setattr(asyncio, 'sleep', lambda delay: real_sleep(0))
+
+
+def _request(api, retries=5):
+
+    async def main():
+        base = await api.start()
+        http = HttpClient()
+        connector = OsuApiConnector(http, api_base=base + '/api/')
+        try:
+            return await connector.process_request(endpoints.BEATMAPS, {'b': '1000'}, list, retries=retries)
+        finally:
+            await http.close()
+            await api.close()
+
+    return main()
+
+
+def test_request_to_api_base(run):
+    api = _Api()
+    assert run(_request(api)) == [{'path': '/api/get_beatmaps'}]
+    assert api.requests == [('/api/get_beatmaps', {'b': '1000'})]
+
+
+def test_gateway_timeouts_are_retried(run, no_retry_delay):
+    api = _Api([504, 504])
+    assert run(_request(api)) == [{'path': '/api/get_beatmaps'}]
+    assert len(api.requests) == 3
+
+
+def test_gateway_timeout_retries_are_limited(run, no_retry_delay):
+    api = _Api([504] * 5)
+    with pytest.raises(HTTPError):
+        run(_request(api, retries=3))
+    assert len(api.requests) == 3
+
+
+def test_other_errors_are_not_retried(run, no_retry_delay):
+    api = _Api([500])
+    with pytest.raises(HTTPError):
+        run(_request(api))
+    assert len(api.requests) == 1
+
+
+def test_session_is_created_lazily(run):
+    api = _Api()
+    http = HttpClient()
+
+    async def main():
+        base = await api.start()
+        try:
+            async with http.get(base + '/test') as resp:
+                assert resp.status == 200
+            session = http.session
+            assert http.session is session
+        finally:
+            await http.close()
+            await api.close()
+        return session
+
+    assert http._session is None
+    # the client can be used again on a new event loop after it was closed
+    sessions = [run(main()), run(main())]
+    assert sessions[0] is not sessions[1]
+    assert all(session.closed for session in sessions)
+    assert http._session is None
+    assert len(api.requests) == 2
+
+
+def test_close_unused_client(run):
+    http = HttpClient()
+    run(http.close())
+    assert http._session is None
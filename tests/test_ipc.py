@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import configparser
+import logging
+
+from gumiyabot.config import open_store, shard_store_path
+from gumiyabot.ipc import IpcClient, IpcServer, RemoteBanchoQueue, SharedCacheClient
+from gumiyabot.outbound import PRIORITY_HIGH, PRIORITY_NORMAL
+
+from .conftest import FakeClock, wait_until
+
+
+class _BanchoQueue(object):
+
+    def __init__(self):
+        self.items = []
+
+    async def put(self, item, **kwargs):
+        self.items.append((item, kwargs))
+
+
+async def _server():
+    server = IpcServer(_BanchoQueue(), cache_size=16)
+    (host, port) = await server.start()
+    return (server, IpcClient(host, port, timeout=1))
+
+
+def test_bancho_messages_are_forwarded(run):
+
+    async def main():
+        (server, client) = await _server()
+        queue = RemoteBanchoQueue(client)
+        try:
+            await queue.put(('someone', 'first'))
+            queue.put_nowait(('someone', 'second'), priority=PRIORITY_HIGH, ttl=60, started=5.0)
+            await wait_until(lambda: len(server.bancho_queue.items) == 2)
+        finally:
+            await client.close()
+            await server.close()
+        return server.bancho_queue.items
+
+    assert run(main()) == [
+        (('someone', 'first'), {'priority': PRIORITY_NORMAL, 'ttl': None, 'started': None}),
+        (('someone', 'second'), {'priority': PRIORITY_HIGH, 'ttl': 60, 'started': 5.0}),
+    ]
+
+
+def test_shared_cache(run):
+    clock = FakeClock()
+
+    async def main():
+        (server, client) = await _server()
+        cache = SharedCacheClient(client, clock=clock)
+        try:
+            assert await cache.get('beatmap', 1000) == (None, 0)
+            await cache.set('beatmap', 1000, [{'beatmap_id': '1000'}], ttl=60)
+            # the same key in another namespace is another entry
+            await cache.set('mapset', 1000, 'other', ttl=60)
+            clock.now += 5
+            return (await cache.get('beatmap', 1000), cache.stats())
+        finally:
+            await client.close()
+            await server.close()
+
+    assert run(main()) == (([{'beatmap_id': '1000'}], 5), {'hits': 1, 'misses': 1, 'errors': 0})
+
+
+def test_invalid_requests_are_skipped(run, caplog):
+
+    async def main():
+        (server, client) = await _server()
+        try:
+            writer = await client._connect()
+            writer.write(b'not json\n{"op": "unknown", "id": 1}\n')
+            return await client.request('cache_get', key='missing')
+        finally:
+            await client.close()
+            await server.close()
+
+    with caplog.at_level(logging.WARNING, logger='gumiyabot.ipc'):
+        assert run(main()) is None
+    assert len([r for r in caplog.records if 'Invalid request' in r.getMessage()]) == 2
+
+
+def test_client_reconnects(run):
+
+    async def main():
+        (server, client) = await _server()
+        try:
+            await client.request('cache_set', key='k', value=1, ttl=60)
+            # the coordinator drops the connection
+            client._writer.close()
+            await wait_until(lambda: client._writer is None)
+            return await client.request('cache_get', key='k')
+        finally:
+            await client.close()
+            await server.close()
+
+    assert run(main()) == 1
+
+
+def test_unreachable_coordinator(run, caplog):
+
+    async def main():
+        (server, client) = await _server()
+        await server.close()
+        cache = SharedCacheClient(client)
+        queue = RemoteBanchoQueue(client)
+        try:
+            result = await cache.get('beatmap', 1000)
+            await cache.set('beatmap', 1000, 'value', ttl=60)
+            await queue.put(('someone', 'lost'))
+        finally:
+            await client.close()
+        return (result, cache.stats())
+
+    with caplog.at_level(logging.WARNING, logger='gumiyabot.ipc'):
+        assert run(main()) == ((None, 0), {'hits': 0, 'misses': 0, 'errors': 2})
+    assert any('Could not send Bancho message' in r.getMessage() for r in caplog.records)
+
+
+def test_pending_requests_fail_when_connection_closes(run):
+
+    async def main():
+        # a server which never answers
+        async def silent(reader, writer):
+            await reader.read()
+
+        server = await asyncio.start_server(silent, '127.0.0.1', 0)
+        client = IpcClient(*server.sockets[0].getsockname()[:2], timeout=5)
+        try:
+            request = asyncio.ensure_future(client.request('cache_get', key='k'))
+            await wait_until(lambda: client._waiting)
+            client._read_task.cancel()
+            try:
+                await request
+            except ConnectionError:
+                return True
+            return False
+        finally:
+            await client.close()
+            server.close()
+            await server.wait_closed()
+
+    assert run(main())
+
+
+def test_shard_store_path():
+    assert shard_store_path('gumiyabot.db', 0) == 'gumiyabot.shard0.db'
+    assert shard_store_path('/var/lib/gumiyabot/store', 2) == '/var/lib/gumiyabot/store.shard2'
+
+
+def test_shards_open_their_own_store(run, tmp_path):
+    config = configparser.ConfigParser()
+    config.read_dict({'gumiya': {'store_path': str(tmp_path / 'store.db')}})
+
+    async def main():
+        stores = [open_store(None, config['gumiya'], {}, shard_index=i) for i in range(2)]
+        for store in stores:
+            await store.warmup
+            await store.close()
+        return [store.path for store in stores]
+
+    assert run(main()) == [str(tmp_path / 'store.shard0.db'), str(tmp_path / 'store.shard1.db')]
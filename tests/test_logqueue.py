@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+import configparser
+import io
+import logging
+
+import pytest
+
+from gumiyabot.config import setup_logging
+from gumiyabot.logqueue import LogQueue
+
+from .conftest import FakeClock
+
+
+@pytest.fixture
+def irc3_logging():
+    # the console handler irc3 sets up whenever a bot is created
+    stream = io.StringIO()
+    handler = logging.StreamHandler(stream)
+    handler.setFormatter(logging.Formatter('%(levelname)s %(name)s %(message)s'))
+    logging.getLogger('irc3').handlers = [handler]
+    yield stream
+    logging.getLogger('irc3').handlers = []
+    gumiyabot_logger = logging.getLogger('gumiyabot')
+    gumiyabot_logger.handlers = []
+    gumiyabot_logger.setLevel(logging.NOTSET)
+    gumiyabot_logger.propagate = True
+
+
+def _config(**settings):
+    config = configparser.ConfigParser()
+    config['gumiya'] = settings
+    return config['gumiya']
+
+
+@pytest.mark.parametrize('log_queue', ['off', 'on'])
+def test_module_loggers_are_handled(irc3_logging, log_queue):
+    queue = setup_logging(_config(log_queue=log_queue))
+    logging.getLogger('gumiyabot.resilience').info('[upstream] osu recovered')
+    logging.getLogger('gumiyabot.store').debug('[store] not logged')
+    if queue is not None:
+        queue.stop()
+    output = irc3_logging.getvalue()
+    assert 'INFO gumiyabot.resilience [upstream] osu recovered' in output
+    assert 'not logged' not in output
+
+
+def test_rate_limit_counts_records_once():
+    clock = FakeClock()
+    (first, second) = (io.StringIO(), io.StringIO())
+    raw_logger = logging.getLogger('raw')
+    raw_logger.handlers = [logging.StreamHandler(first), logging.StreamHandler(second)]
+    raw_logger.setLevel(logging.INFO)
+    queue = LogQueue(loggers=('raw',), rate_limit=1)
+    queue.rate_filter.clock = clock
+    queue.start()
+    try:
+        for i in range(3):
+            logging.getLogger('raw.gumiyabot >>').info('PRIVMSG #channel :%d', i)
+        clock.now += 1
+        logging.getLogger('raw.gumiyabot >>').info('PRIVMSG #channel :%d', 3)
+    finally:
+        queue.stop()
+        raw_logger.handlers = []
+        raw_logger.setLevel(logging.NOTSET)
+    assert queue.stats()['suppressed'] == 2
+    expected = 'PRIVMSG #channel :0\nPRIVMSG #channel :3 (2 similar messages suppressed)\n'
+    assert first.getvalue() == second.getvalue() == expected
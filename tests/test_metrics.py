@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+import logging
+
+from gumiyabot import metrics
+from gumiyabot.metrics import Histogram, MetricsServer, Registry
+from gumiyabot.twitch import BaseTwitchPlugin
+
+from .conftest import FakeBot
+
+
+def test_histogram_buckets():
+    histogram = Histogram('latency_seconds', 'Latency', buckets=(1, .5))
+    for value in (.25, .5, 1, 4):
+        histogram.observe(value)
+    # bucket counts are cumulative, and a value equal to a bound is counted in that bucket
+    assert histogram.render() == [
+        '# HELP latency_seconds Latency',
+        '# TYPE latency_seconds histogram',
+        'latency_seconds_bucket{le="0.5"} 2',
+        'latency_seconds_bucket{le="1.0"} 3',
+        'latency_seconds_bucket{le="+Inf"} 4',
+        'latency_seconds_sum 5.75',
+        'latency_seconds_count 4',
+    ]
+
+
+def test_histogram_labels():
+    histogram = Histogram('latency_seconds', 'Latency', labelnames=['upstream', 'endpoint'], buckets=(1,))
+    histogram.observe(2, upstream='tillerino', endpoint='beatmapinfo')
+    histogram.observe(.5, upstream='osu', endpoint='get_"beatmap"\\\n')
+    assert histogram.render()[2:] == [
+        'latency_seconds_bucket{upstream="osu",endpoint="get_\\"beatmap\\"\\\\\\n",le="1.0"} 1',
+        'latency_seconds_bucket{upstream="osu",endpoint="get_\\"beatmap\\"\\\\\\n",le="+Inf"} 1',
+        'latency_seconds_sum{upstream="osu",endpoint="get_\\"beatmap\\"\\\\\\n"} 0.5',
+        'latency_seconds_count{upstream="osu",endpoint="get_\\"beatmap\\"\\\\\\n"} 1',
+        'latency_seconds_bucket{upstream="tillerino",endpoint="beatmapinfo",le="1.0"} 0',
+        'latency_seconds_bucket{upstream="tillerino",endpoint="beatmapinfo",le="+Inf"} 1',
+        'latency_seconds_sum{upstream="tillerino",endpoint="beatmapinfo"} 2.0',
+        'latency_seconds_count{upstream="tillerino",endpoint="beatmapinfo"} 1',
+    ]
+
+
+def test_registry_render(caplog):
+    registry = Registry()
+    histogram = registry.histogram('request_seconds', 'Request latency', buckets=(1,))
+    assert registry.histogram('request_seconds', 'Request latency') is histogram
+    histogram.observe(.5)
+
+    def broken():
+        raise ValueError('broken')
+
+    registry.add_collector(lambda: [
+        ('queue_depth', metrics.GAUGE, 'Queued messages', [({}, 3)]),
+        ('stalls_total', metrics.COUNTER, 'Stalls', [({'service': 'twitch'}, 1)]),
+    ])
+    registry.add_collector(broken)
+    # samples of a metric from several collectors are rendered as one family
+    registry.add_collector(lambda: [('stalls_total', metrics.COUNTER, 'Stalls', [({'service': 'bancho'}, .5)])])
+    with caplog.at_level(logging.ERROR, logger='gumiyabot.metrics'):
+        text = registry.render()
+    assert text == '\n'.join([
+        '# HELP gumiyabot_request_seconds Request latency',
+        '# TYPE gumiyabot_request_seconds histogram',
+        'gumiyabot_request_seconds_bucket{le="1.0"} 1',
+        'gumiyabot_request_seconds_bucket{le="+Inf"} 1',
+        'gumiyabot_request_seconds_sum 0.5',
+        'gumiyabot_request_seconds_count 1',
+        '# HELP gumiyabot_queue_depth Queued messages',
+        '# TYPE gumiyabot_queue_depth gauge',
+        'gumiyabot_queue_depth 3',
+        '# HELP gumiyabot_stalls_total Stalls',
+        '# TYPE gumiyabot_stalls_total counter',
+        'gumiyabot_stalls_total{service="twitch"} 1',
+        'gumiyabot_stalls_total{service="bancho"} 0.5',
+    ]) + '\n'
+    assert any('collector failed' in r.getMessage() for r in caplog.records)
+
+
+def test_cache_metrics():
+    stats = {'size': 2, 'maxsize': 10, 'hits': 3, 'misses': 1, 'evictions': 0}
+    collected = {name: samples for (name, type_, help, samples) in metrics.cache_metrics('pp', stats)}
+    assert collected['cache_hit_ratio'] == [({'cache': 'pp'}, .75)]
+    assert collected['cache_size'] == [({'cache': 'pp'}, 2)]
+    empty = dict(stats, hits=0, misses=0)
+    assert metrics.cache_metrics('pp', empty)[-1][3] == [({'cache': 'pp'}, 0.0)]
+
+
+def test_metrics_endpoint(run):
+
+    async def main():
+        registry = Registry()
+        registry.add_collector(lambda: [('up', metrics.GAUGE, 'Up', [({}, 1)])])
+        response = await MetricsServer(registry).handle_metrics(None)
+        return (response.content_type, response.text)
+
+    assert run(main()) == ('text/plain', '# HELP gumiyabot_up Up\n# TYPE gumiyabot_up gauge\ngumiyabot_up 1\n')
+
+
+def test_plugin_metrics(run):
+
+    async def main():
+        registry = Registry()
+        plugin = BaseTwitchPlugin(FakeBot(metrics=registry, prefetch='on'))
+        try:
+            plugin.request_histogram.observe(.2)
+            return registry.render()
+        finally:
+            await plugin.http.close()
+
+    lines = run(main()).splitlines()
+    for line in [
+        'gumiyabot_request_seconds_count 1',
+        'gumiyabot_twitch_chat_messages_total 0',
+        'gumiyabot_prefetch_jobs_total{result="fetched"} 0',
+        'gumiyabot_upstream_circuit_open{upstream="tillerino"} 0',
+        'gumiyabot_cache_hit_ratio{cache="message"} 0.0',
+    ]:
+        assert line in lines
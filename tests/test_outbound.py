@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import time
+
+from irc3.utils import IrcString
+
+from gumiyabot.outbound import PRIORITY_HIGH, PRIORITY_LOW, PRIORITY_NORMAL, OutboundScheduler, TwitchSender
+from gumiyabot.twitch import BaseTwitchPlugin
+
+from .conftest import FakeBot, FakeClock
+
+
+def _drain(run, queue):
+
+    async def main():
+        sent = []
+        while not queue.empty():
+            sent.append(await queue.get())
+            queue.ack()
+        return sent
+
+    return run(main())
+
+
+def _scheduler(**kwargs):
+    kwargs.setdefault('rate', 1000000)
+    kwargs.setdefault('burst', 1000000)
+    return OutboundScheduler(**kwargs)
+
+
+def test_priority_order(run):
+    queue = _scheduler()
+    queue.put_nowait(('a', 'low'), priority=PRIORITY_LOW)
+    queue.put_nowait(('a', 'normal'))
+    queue.put_nowait(('a', 'high'), priority=PRIORITY_HIGH)
+    assert [msg for (_, msg) in _drain(run, queue)] == ['high', 'normal', 'low']
+
+
+def test_round_robin_targets(run):
+    queue = _scheduler()
+    for i in range(3):
+        queue.put_nowait(('a', 'a{}'.format(i)))
+    queue.put_nowait(('b', 'b0'))
+    queue.put_nowait(('c', 'c0'))
+    assert [msg for (_, msg) in _drain(run, queue)] == ['a0', 'b0', 'c0', 'a1', 'a2']
+
+
+def test_duplicates_are_dropped(run):
+    queue = _scheduler()
+    assert queue.put_nowait(('a', 'msg'))
+    assert not queue.put_nowait(('a', 'msg'))
+    assert queue.put_nowait(('b', 'msg'))
+    assert queue.qsize() == 2
+    assert queue.deduplicated == 1
+
+
+def test_full_queue_evicts_busiest_target():
+    queue = _scheduler(maxsize=3)
+    queue.put_nowait(('a', 'a0'), priority=PRIORITY_LOW)
+    queue.put_nowait(('a', 'a1'), priority=PRIORITY_LOW)
+    queue.put_nowait(('b', 'b0'), priority=PRIORITY_LOW)
+    assert queue.put_nowait(('c', 'c0'))
+    assert queue.qsize() == 3
+    assert queue.dropped == 1
+    assert ('a', 'a0') not in queue._pending
+
+
+def test_full_queue_drops_lower_priority_message():
+    queue = _scheduler(maxsize=2)
+    queue.put_nowait(('a', 'a0'), priority=PRIORITY_HIGH)
+    queue.put_nowait(('b', 'b0'), priority=PRIORITY_HIGH)
+    assert not queue.put_nowait(('c', 'c0'), priority=PRIORITY_NORMAL)
+    assert queue.qsize() == 2
+    assert queue.dropped == 1
+
+
+def test_expired_messages_are_skipped(run):
+    clock = FakeClock()
+    queue = _scheduler(message_ttl=10, clock=clock)
+    queue.put_nowait(('a', 'old'))
+    clock.now += 5
+    queue.put_nowait(('a', 'new'))
+    clock.now += 6
+    assert _drain(run, queue) == [('a', 'new')]
+    assert queue.expired == 1
+
+
+def test_requeue_puts_message_back_in_front(run):
+    queue = _scheduler()
+    queue.put_nowait(('a', 'first'))
+    queue.put_nowait(('b', 'second'))
+
+    async def main():
+        assert await queue.get() == ('a', 'first')
+        queue.requeue()
+
+    run(main())
+    assert queue.requeued == 1
+    assert _drain(run, queue) == [('a', 'first'), ('b', 'second')]
+    assert queue.sent == 2
+
+
+def test_rate_limit(run):
+    queue = OutboundScheduler(rate=50, burst=2)
+    for i in range(4):
+        queue.put_nowait(('a', str(i)), priority=PRIORITY_NORMAL)
+    start = time.monotonic()
+    assert len(_drain(run, queue)) == 4
+    # two messages are sent right away, the other two wait for a token each
+    assert time.monotonic() - start >= .035
+    assert queue.bucket.stalls == 2
+
+
+def _sender_lines(run, sender):
+    """Run sender until it has sent everything it may send right now, return the sent lines"""
+    sent = []
+    sender._send = lambda target, msg: sent.append((target, msg))
+
+    async def main():
+        task = asyncio.ensure_future(sender.run())
+        for _ in range(20):
+            await asyncio.sleep(0)
+        task.cancel()
+
+    run(main())
+    return sent
+
+
+def test_sender_merges_replies_under_pressure(run):
+    sender = TwitchSender(None, limit=4, batch_threshold=.5)
+    for i in range(6):
+        sender.send('#a', str(i), batchable=True)
+    sender.send('#a', 'not batchable')
+    # merging starts once sending the next line fills half of the window
+    assert _sender_lines(run, sender) == [('#a', '0'), ('#a', '1 || 2 || 3 || 4 || 5'), ('#a', 'not batchable')]
+    assert (sender.sent, sender.merged) == (3, 4)
+
+
+def test_sender_does_not_merge_past_max_length(run):
+    sender = TwitchSender(None, limit=4, batch_threshold=0)
+    for i in range(3):
+        sender.send('#a', str(i) * 240, batchable=True)
+    assert [len(msg) for (_, msg) in _sender_lines(run, sender)] == [240 + 4 + 240, 240]
+
+
+def test_sender_limits_share_one_window(run):
+    sender = TwitchSender(None, limit=2, mod_limit=4)
+    sender.set_moderator('#Mod', True)
+    for i in range(4):
+        sender.send('#a', 'a{}'.format(i))
+        sender.send('#mod', 'mod{}'.format(i))
+    sent = _sender_lines(run, sender)
+    # #a may only send while fewer than 2 messages were sent to any channel, #mod while fewer than 4
+    assert sent == [('#a', 'a0'), ('#mod', 'mod0'), ('#mod', 'mod1'), ('#mod', 'mod2')]
+    assert sender.qsize() == 4
+    assert sender.stats()['rate_limit_stalls'] == 1
+
+
+def test_sender_drops_oldest_pending_messages(run):
+    sender = TwitchSender(None, limit=1, max_pending=2)
+    for i in range(4):
+        sender.send('#a', str(i))
+    assert _sender_lines(run, sender) == [('#a', '2')]
+    assert sender.dropped == 2
+
+
+def test_userstate_switches_to_mod_rate_limit(run):
+
+    async def main():
+        plugin = BaseTwitchPlugin(FakeBot(twitch_rate_limit=20, twitch_mod_rate_limit=100))
+        await plugin.http.close()
+        return plugin
+
+    plugin = run(main())
+    channel = IrcString('#gumiyabot')
+    assert plugin.sender.limit_for(channel) == 20
+    plugin.userstate(tags={'badges': 'moderator/1', 'mod': '1'}, channel=channel)
+    assert plugin.sender.limit_for(channel) == 100
+    assert plugin.sender.limit_for('#other') == 20
+    plugin.userstate(tags={'badges': 'broadcaster/1', 'mod': '0'}, channel='#Other')
+    assert plugin.sender.limit_for('#other') == 100
+    plugin.userstate(tags={'badges': '', 'mod': '0'}, channel=channel)
+    assert plugin.sender.limit_for(channel) == 20
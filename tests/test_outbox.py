@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+from gumiyabot.outbound import PRIORITY_HIGH, OutboundScheduler
+from gumiyabot.outbox import OutboxJournal
+
+from .conftest import wait_until
+
+
+def _queue(path, **kwargs):
+    journal = OutboxJournal(path, **kwargs)
+    queue = OutboundScheduler(rate=1000000, burst=1000000, journal=journal)
+    queue.restore(journal.load())
+    return queue
+
+
+def test_restore_unsent_messages(run, tmp_path):
+    path = str(tmp_path / 'outbox.jsonl')
+
+    async def send_one():
+        queue = _queue(path)
+        queue.put_nowait(('a', 'first'), priority=PRIORITY_HIGH)
+        queue.put_nowait(('a', 'second'))
+        queue.put_nowait(('b', 'third'))
+        assert await queue.get() == ('a', 'first')
+        queue.ack()
+        await queue.close()
+
+    run(send_one())
+
+    async def restart():
+        queue = _queue(path)
+        sent = []
+        while not queue.empty():
+            sent.append(await queue.get())
+            queue.ack()
+        await queue.close()
+        return (queue.restored, sent)
+
+    assert run(restart()) == (2, [('a', 'second'), ('b', 'third')])
+    assert OutboxJournal(path).load() == []
+
+
+def test_partial_record_is_ignored(run, tmp_path):
+    path = str(tmp_path / 'outbox.jsonl')
+
+    async def main():
+        journal = OutboxJournal(path)
+        journal.put('a', 'msg', PRIORITY_HIGH, ttl=60)
+        await journal.close()
+
+    run(main())
+    with open(path, 'a') as f:
+        f.write('{"id": 2, "tar')
+    (record,) = OutboxJournal(path).load()
+    assert (record['target'], record['msg'], record['priority']) == ('a', 'msg', PRIORITY_HIGH)
+
+
+def test_expired_messages_are_not_restored(run, tmp_path):
+    path = str(tmp_path / 'outbox.jsonl')
+
+    async def main():
+        journal = OutboxJournal(path)
+        journal.put('a', 'expired', PRIORITY_HIGH, ttl=-1)
+        journal.put('a', 'pending', PRIORITY_HIGH, ttl=60)
+        await journal.close()
+
+    run(main())
+    queue = _queue(path)
+    assert queue.restored == 1
+    assert queue.expired == 1
+
+
+def test_compaction_keeps_unacked_messages(run, tmp_path):
+    path = str(tmp_path / 'outbox.jsonl')
+
+    async def main():
+        journal = OutboxJournal(path, compact_threshold=10)
+        for i in range(20):
+            record_id = journal.put('a', str(i), PRIORITY_HIGH)
+            if i != 7:
+                journal.ack(record_id)
+        await journal.flush()
+        await journal.close()
+        return journal.compactions
+
+    assert run(main()) == 1
+    with open(path) as f:
+        assert len(f.readlines()) == 1
+    assert [record['msg'] for record in OutboxJournal(path).load()] == ['7']
+
+
+def test_journal_is_rewritten_after_write_errors(run, tmp_path):
+    path = tmp_path / 'missing' / 'outbox.jsonl'
+
+    async def main():
+        journal = OutboxJournal(str(path), sync_interval=.01)
+        journal.start()
+        sent = journal.put('a', 'sent', PRIORITY_HIGH)
+        journal.put('a', 'pending', PRIORITY_HIGH)
+        await wait_until(lambda: journal.errors)
+        # the flusher keeps running, and records are not kept while the journal cannot be written
+        assert journal.errors and not journal._flusher.done()
+        assert not journal._pending
+        journal.ack(sent)
+        path.parent.mkdir()
+        await wait_until(lambda: journal.compactions)
+        await journal.close()
+        return journal.stats()
+
+    stats = run(main())
+    assert stats['compactions'] == 1
+    assert [record['msg'] for record in OutboxJournal(str(path)).load()] == ['pending']
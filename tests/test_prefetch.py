@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+import asyncio
+
+from gumiyabot.prefetch import Prefetcher
+
+from .conftest import FakeClock, wait_until
+
+
+class _Jobs(object):
+    """Records the order jobs ran in"""
+
+    def __init__(self):
+        self.ran = []
+
+    def job(self, name, fetched=True):
+        async def func():
+            self.ran.append(name)
+            if isinstance(fetched, Exception):
+                raise fetched
+            return fetched
+        return func
+
+
+async def _run(prefetcher, condition):
+    task = asyncio.ensure_future(prefetcher.run())
+    try:
+        await wait_until(condition)
+    finally:
+        task.cancel()
+
+
+def test_newest_job_runs_first(run):
+    jobs = _Jobs()
+
+    async def main():
+        prefetcher = Prefetcher(lambda: True, clock=FakeClock())
+        for name in 'abc':
+            prefetcher.schedule(name, jobs.job(name))
+        # scheduling a queued key again only moves it to the front
+        prefetcher.schedule('a', jobs.job('a again'))
+        await _run(prefetcher, lambda: not prefetcher.jobs)
+        return prefetcher.stats()
+
+    stats = run(main())
+    assert jobs.ran == ['a', 'c', 'b']
+    assert stats == {'queued': 0, 'scheduled': 3, 'fetched': 3, 'skipped': 0, 'dropped': 0, 'failed': 0}
+
+
+def test_oldest_job_is_dropped(run):
+    jobs = _Jobs()
+
+    async def main():
+        prefetcher = Prefetcher(lambda: True, max_jobs=2, clock=FakeClock())
+        for name in 'abc':
+            prefetcher.schedule(name, jobs.job(name))
+        await _run(prefetcher, lambda: not prefetcher.jobs)
+        return prefetcher.stats()
+
+    stats = run(main())
+    assert jobs.ran == ['c', 'b']
+    assert stats['dropped'] == 1
+
+
+def test_skipped_jobs_refund_their_token(run):
+    jobs = _Jobs()
+
+    async def main():
+        # one token and a frozen clock, so only a single fetching job can run
+        prefetcher = Prefetcher(lambda: True, burst=1, clock=FakeClock())
+        prefetcher.schedule('never', jobs.job('never'))
+        prefetcher.schedule('fetched', jobs.job('fetched'))
+        prefetcher.schedule('cached 2', jobs.job('cached 2', fetched=False))
+        prefetcher.schedule('cached 1', jobs.job('cached 1', fetched=False))
+        await _run(prefetcher, lambda: len(jobs.ran) == 4 or prefetcher.bucket.stalls)
+        return prefetcher
+
+    prefetcher = run(main())
+    assert jobs.ran == ['cached 1', 'cached 2', 'fetched']
+    assert list(prefetcher.jobs) == ['never']
+    assert (prefetcher.fetched, prefetcher.skipped) == (1, 2)
+
+
+def test_failed_job_does_not_stop_prefetching(run):
+    jobs = _Jobs()
+
+    async def main():
+        prefetcher = Prefetcher(lambda: True, clock=FakeClock())
+        prefetcher.schedule('a', jobs.job('a'))
+        prefetcher.schedule('b', jobs.job('b', fetched=ValueError('broken')))
+        await _run(prefetcher, lambda: not prefetcher.jobs)
+        return prefetcher.stats()
+
+    stats = run(main())
+    assert jobs.ran == ['b', 'a']
+    assert (stats['fetched'], stats['failed']) == (1, 1)
+
+
+def test_jobs_wait_until_idle(run):
+    jobs = _Jobs()
+    idle = []
+
+    async def main():
+        prefetcher = Prefetcher(lambda: bool(idle), idle_poll=.01, clock=FakeClock())
+        task = asyncio.ensure_future(prefetcher.run())
+        try:
+            prefetcher.schedule('a', jobs.job('a'))
+            await asyncio.sleep(.05)
+            assert jobs.ran == []
+            idle.append(True)
+            await wait_until(lambda: jobs.ran)
+        finally:
+            task.cancel()
+
+    run(main())
+    assert jobs.ran == ['a']
@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+import asyncio
+
+import pytest
+
+from gumiyabot.ratelimit import AdmissionController
+
+
+async def _settle():
+    """Let tasks woken up by a resolved future run"""
+    for _ in range(3):
+        await asyncio.sleep(0)
+
+
+async def _queue(admission, users):
+    """Start a waiting admit() for each user and let them reach the queue"""
+    tasks = []
+    for user in users:
+        tasks.append(asyncio.ensure_future(admission.admit(user)))
+        await _settle()
+    return tasks
+
+
+async def _drain(admission, tasks):
+    """Release slots until every task finished, returning the results in completion order"""
+    done = []
+    pending = list(tasks)
+    while pending:
+        admission.release()
+        await _settle()
+        for task in [task for task in pending if task.done()]:
+            pending.remove(task)
+            done.append((tasks.index(task), task.result()))
+    return done
+
+
+def test_admits_up_to_max_in_flight(run):
+
+    async def main():
+        admission = AdmissionController(max_in_flight=2, max_queue=2)
+        assert await admission.admit()
+        assert await admission.admit()
+        tasks = await _queue(admission, ['a', 'b'])
+        assert admission.stats() == {'in_flight': 2, 'queued': 2, 'admitted': 2, 'shed': 0}
+        assert not any(task.done() for task in tasks)
+        # waiting requests are admitted in arrival order
+        assert await _drain(admission, tasks) == [(0, True), (1, True)]
+        admission.release()
+        admission.release()
+        return admission.stats()
+
+    assert run(main()) == {'in_flight': 0, 'queued': 0, 'admitted': 4, 'shed': 0}
+
+
+def test_unknown_policy():
+    with pytest.raises(ValueError):
+        AdmissionController(policy='random')
+
+
+def test_oldest_policy_sheds_longest_waiting(run):
+
+    async def main():
+        admission = AdmissionController(max_in_flight=1, max_queue=2, policy='oldest')
+        assert await admission.admit()
+        tasks = await _queue(admission, ['a', 'b', 'c'])
+        assert tasks[0].done() and tasks[0].result() is False
+        return (await _drain(admission, tasks[1:]), admission.shed)
+
+    assert run(main()) == ([(0, True), (1, True)], 1)
+
+
+def test_newest_policy_sheds_incoming(run):
+
+    async def main():
+        admission = AdmissionController(max_in_flight=1, max_queue=2, policy='newest')
+        assert await admission.admit()
+        tasks = await _queue(admission, ['a', 'b', 'c'])
+        assert tasks[2].done() and tasks[2].result() is False
+        return (await _drain(admission, tasks[:2]), admission.shed)
+
+    assert run(main()) == ([(0, True), (1, True)], 1)
+
+
+def test_per_user_policy_keeps_newest_request_per_user(run):
+
+    async def main():
+        admission = AdmissionController(max_in_flight=1, max_queue=2, policy='per-user')
+        assert await admission.admit()
+        tasks = await _queue(admission, ['a', 'b', 'a'])
+        # a's first request is replaced by its newer one, so b still fits
+        assert tasks[0].result() is False
+        assert not tasks[1].done() and not tasks[2].done()
+        # a full queue drops the oldest request
+        tasks += await _queue(admission, ['c'])
+        assert tasks[1].result() is False
+        return (await _drain(admission, tasks[2:]), admission.shed)
+
+    assert run(main()) == ([(0, True), (1, True)], 2)
+
+
+def test_no_queue(run):
+
+    async def main():
+        admission = AdmissionController(max_in_flight=1, max_queue=0)
+        assert await admission.admit()
+        assert not await admission.admit()
+        admission.release()
+        assert await admission.admit()
+        return admission.stats()
+
+    assert run(main()) == {'in_flight': 1, 'queued': 0, 'admitted': 2, 'shed': 1}
+
+
+def test_cancelled_waiter_leaves_queue(run):
+
+    async def main():
+        admission = AdmissionController(max_in_flight=1, max_queue=2)
+        assert await admission.admit()
+        tasks = await _queue(admission, ['a', 'b'])
+        tasks[0].cancel()
+        await _settle()
+        assert tasks[0].cancelled()
+        assert admission.stats()['queued'] == 1
+        assert await _drain(admission, tasks[1:]) == [(0, True)]
+        admission.release()
+        return admission.stats()
+
+    assert run(main()) == {'in_flight': 0, 'queued': 0, 'admitted': 2, 'shed': 0}
+
+
+def test_waiter_cancelled_after_handover_releases_slot(run):
+
+    async def main():
+        admission = AdmissionController(max_in_flight=1, max_queue=2)
+        assert await admission.admit()
+        tasks = await _queue(admission, ['a', 'b'])
+        # the slot is handed to a, which is cancelled before it resumes
+        admission.release()
+        tasks[0].cancel()
+        await _settle()
+        assert tasks[0].cancelled()
+        # a passed its slot on to b
+        assert tasks[1].done() and tasks[1].result() is True
+        admission.release()
+        return admission.stats()
+
+    assert run(main()) == {'in_flight': 0, 'queued': 0, 'admitted': 3, 'shed': 0}
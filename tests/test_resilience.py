@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+import asyncio
+
+import pytest
+
+from gumiyabot.resilience import CircuitBreaker, Upstream, UpstreamUnavailable
+from gumiyabot.utils import percentile
+
+from .conftest import FakeClock
+
+
+def test_percentile():
+    assert percentile([], .5) == 0.0
+    assert percentile([3, 1, 2], .5) == 2
+    assert percentile(range(100), .99) == 99
+    assert percentile(range(100), 1) == 99
+
+
+def open_breaker(clock):
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=30, clock=clock)
+    breaker.record_failure()
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN
+    return breaker
+
+
+def test_breaker_opens_after_failures():
+    clock = FakeClock()
+    breaker = open_breaker(clock)
+    assert not breaker.allow()
+    clock.now += 29
+    assert not breaker.allow()
+    assert breaker.open_count == 1
+
+
+def test_half_open_allows_one_trial_call():
+    clock = FakeClock()
+    breaker = open_breaker(clock)
+    clock.now += 30
+    assert breaker.allow()
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    assert not breaker.allow()
+    assert not breaker.allow()
+    breaker.record_success()
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert breaker.allow()
+    assert breaker.allow()
+
+
+def test_failed_trial_call_opens_breaker():
+    clock = FakeClock()
+    breaker = open_breaker(clock)
+    clock.now += 30
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN
+    assert not breaker.allow()
+    clock.now += 30
+    assert breaker.allow()
+
+
+def test_upstream_half_open_concurrent_calls(run):
+    clock = FakeClock()
+    upstream = Upstream('test', failure_threshold=1, reset_timeout=30, hedge=False, clock=clock)
+    calls = []
+
+    async def fail():
+        raise ValueError()
+
+    async def slow():
+        calls.append(1)
+        await asyncio.sleep(.05)
+        return 'ok'
+
+    async def main():
+        with pytest.raises(ValueError):
+            await upstream.call('get', fail)
+        clock.now += 30
+        return await asyncio.gather(*(upstream.call('get', slow) for _ in range(5)), return_exceptions=True)
+
+    results = run(main())
+    assert len(calls) == 1
+    assert results[0] == 'ok'
+    assert all(isinstance(result, UpstreamUnavailable) for result in results[1:])
+    assert upstream.rejected == 4
+    assert upstream.breaker.state == CircuitBreaker.CLOSED
+
+
+def test_upstream_cancelled_trial_call_is_released(run):
+    clock = FakeClock()
+    upstream = Upstream('test', failure_threshold=1, reset_timeout=30, hedge=False, clock=clock)
+
+    async def fail():
+        raise ValueError()
+
+    async def hang():
+        await asyncio.sleep(10)
+
+    async def ok():
+        return 'ok'
+
+    async def main():
+        with pytest.raises(ValueError):
+            await upstream.call('get', fail)
+        clock.now += 30
+        trial = asyncio.ensure_future(upstream.call('get', hang))
+        await asyncio.sleep(0)
+        trial.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await trial
+        return await upstream.call('get', ok)
+
+    assert run(main()) == 'ok'
+    assert upstream.breaker.state == CircuitBreaker.CLOSED
@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+from irc3.utils import IrcString
+
+from gumiyabot.beatmap import BeatmapRecord
+from gumiyabot.search import SearchIndex, tokenize
+from gumiyabot.twitch import BaseTwitchPlugin
+
+from .conftest import FakeBot, fake_beatmap
+
+
+def _beatmap(beatmap_id, title, artist='Artist', version='Insane', creator='Mapper', beatmapset_id=None):
+    data = fake_beatmap(beatmap_id)
+    data.update(title=title, artist=artist, version=version, creator=creator,
+                beatmapset_id=beatmapset_id or beatmap_id)
+    return BeatmapRecord.from_dict(data)
+
+
+def _ids(beatmaps):
+    return [beatmap.beatmap_id for beatmap in beatmaps]
+
+
+def test_tokenize():
+    assert tokenize('Hello, World! (TV Size)') == ['hello', 'world', 'tv', 'size']
+    assert tokenize('ÜBER') == ['über']
+    assert tokenize(None) == []
+
+
+def test_ranking():
+    index = SearchIndex()
+    index.add_beatmaps([
+        _beatmap(1, 'Something', creator='Freedom'),
+        _beatmap(2, 'Freedom Dive'),
+        _beatmap(3, 'Freedom', artist='xi'),
+        _beatmap(4, 'Unrelated'),
+    ])
+    # exact title matches first, then prefix title matches, then other fields
+    assert _ids(index.search('freedom', limit=5)) == [3, 2, 1]
+    assert _ids(index.search('freedom xi')) == [3]
+    assert index.search('') == []
+    assert index.search('nothing') == []
+
+
+def test_prefix_matching():
+    index = SearchIndex(min_prefix=2)
+    index.add_beatmaps([_beatmap(1, 'Freedom Dive'), _beatmap(2, 'Fresh')])
+    assert _ids(index.search('fre')) == [2, 1]
+    assert _ids(index.search('free di')) == [1]
+    # too short for a prefix match
+    assert index.search('f') == []
+
+
+def test_one_result_per_mapset():
+    index = SearchIndex()
+    index.add_beatmaps([
+        _beatmap(1, 'Song', version='Easy', beatmapset_id=10),
+        _beatmap(2, 'Song', version='Insane', beatmapset_id=10),
+        _beatmap(3, 'Song', version='Hard', beatmapset_id=11),
+    ])
+    assert _ids(index.search('song insane')) == [2]
+    assert _ids(index.search('song', limit=5)) == [3, 2]
+    assert _ids(index.search('song', limit=1)) == [3]
+
+
+def test_update_reindexes_beatmap():
+    index = SearchIndex()
+    index.add(_beatmap(1, 'Old Title'))
+    index.add(_beatmap(1, 'New Title'))
+    assert len(index) == 1
+    assert index.search('old') == []
+    assert _ids(index.search('new')) == [1]
+    assert 'old' not in index.postings
+    assert 'ol' not in index.tokens
+
+
+def test_eviction_removes_postings_and_tokens():
+    index = SearchIndex(maxsize=2)
+    index.add(_beatmap(1, 'Alpha'))
+    index.add(_beatmap(2, 'Beta'))
+    # re-adding a beatmap makes it the most recently added one
+    index.add(index.entries[1][0])
+    index.add(_beatmap(3, 'Gamma'))
+    assert list(index.entries) == [1, 3]
+    assert 'beta' not in index.postings
+    assert 'be' not in index.tokens
+    assert index.search('beta') == []
+    assert _ids(index.search('alpha')) == [1]
+    for i in range(4, 10):
+        index.add(_beatmap(i, 'Delta'))
+    assert set(index.postings) == {'delta', 'artist', 'insane', 'mapper'}
+    assert sorted(index.tokens) == ['ar', 'de', 'in', 'ma']
+    assert index.stats() == {'beatmaps': 2, 'tokens': 4, 'searches': 2}
+
+
+def test_max_prefix_tokens():
+    index = SearchIndex(max_prefix_tokens=3)
+    index.add_beatmaps([_beatmap(i, 'song{}'.format(i)) for i in range(1, 6)])
+    # only the first max_prefix_tokens (in sorted order) tokens starting with the prefix are used
+    assert sorted(_ids(index.search('song', limit=10))) == [1, 2, 3]
+    assert _ids(index.search('song5')) == [5]
+
+
+def test_max_candidates():
+    index = SearchIndex(max_candidates=2)
+    index.add_beatmaps([_beatmap(i, 'Song') for i in range(1, 6)])
+    # only the newest beatmaps are ranked
+    assert _ids(index.search('song', limit=10)) == [5, 4]
+
+
+class _Sender(object):
+
+    def __init__(self):
+        self.sent = []
+
+    def send(self, target, msg, **kwargs):
+        self.sent.append((target, msg))
+
+
+def test_search_command(run):
+
+    async def main():
+        plugin = BaseTwitchPlugin(FakeBot(search_results=2))
+        await plugin.http.close()
+        return plugin
+
+    plugin = run(main())
+    plugin.sender = _Sender()
+    plugin.search_index.add_beatmaps([_beatmap(1, 'Freedom Dive', artist='xi'), _beatmap(2, 'Blue Zenith')])
+    mask = IrcString('someone!someone@someone.tmi.twitch.tv')
+    channel = IrcString('#gumiyabot')
+    plugin.search(mask, channel, {'<query>': ['freedom', 'dive']})
+    plugin.search(mask, IrcString('gumiyabot'), {'<query>': ['nothing']})
+    assert plugin.sender.sent == [
+        (channel, 'xi - Freedom Dive [Insane] (by Mapper) https://osu.ppy.sh/b/1'),
+        (mask, 'No beatmaps found for nothing'),
+    ]
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+import multiprocessing
+import signal
+import time
+
+from gumiyabot.shard import ShardSupervisor
+
+from .conftest import FakeClock
+
+
+def crash():
+    raise SystemExit(3)
+
+
+def sleep_forever():
+    while True:
+        time.sleep(.1)
+
+
+def ignore_sigterm():
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    sleep_forever()
+
+
+def wait_for_exit(process, timeout=10):
+    process.join(timeout)
+    assert not process.is_alive()
+
+
+def test_crashed_shard_is_restarted():
+    clock = FakeClock()
+    supervisor = ShardSupervisor(multiprocessing.get_context('spawn'), crash, restart_delay=1, clock=clock)
+    supervisor.add(0, ())
+    first = supervisor.shards[0].process
+    wait_for_exit(first)
+
+    supervisor.check()
+    assert first.exitcode == 3
+    assert supervisor.restarts == 0
+    # exited right after starting, so the delay doubled
+    assert supervisor.shards[0].restart_delay == 2
+    clock.now += 1
+    supervisor.check()
+    assert supervisor.restarts == 0
+    clock.now += 1
+    supervisor.check()
+    assert supervisor.restarts == 1
+    assert supervisor.shards[0].process is not first
+    wait_for_exit(supervisor.shards[0].process)
+    supervisor.stop()
+
+
+def test_restart_delay_resets_after_running_for_a_while():
+    clock = FakeClock()
+    supervisor = ShardSupervisor(multiprocessing.get_context('spawn'), crash, restart_delay=1,
+                                 max_restart_delay=60, clock=clock)
+    supervisor.add(0, ())
+    supervisor.shards[0].restart_delay = 32
+    wait_for_exit(supervisor.shards[0].process)
+    clock.now += 120
+    supervisor.check()
+    assert supervisor.shards[0].restart_delay == 1
+
+
+def test_stop_terminates_every_shard_with_one_deadline():
+    supervisor = ShardSupervisor(multiprocessing.get_context('spawn'), ignore_sigterm)
+    for i in range(3):
+        supervisor.add(i, ())
+    time.sleep(1)
+    started = time.monotonic()
+    supervisor.stop(timeout=1)
+    assert time.monotonic() - started < 2.5
+    assert all(not shard.process.is_alive() for shard in supervisor.shards)
+
+
+def test_stop_lets_shards_exit_on_sigterm():
+    supervisor = ShardSupervisor(multiprocessing.get_context('spawn'), sleep_forever)
+    for i in range(2):
+        supervisor.add(i, ())
+    started = time.monotonic()
+    supervisor.stop(timeout=10)
+    assert time.monotonic() - started < 5
+    assert [shard.process.exitcode for shard in supervisor.shards] == [-signal.SIGTERM] * 2
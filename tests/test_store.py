@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+import sqlite3
+
+from osuapi.model import User
+
+from gumiyabot.beatmap import BeatmapRecord
+from gumiyabot.cache import BeatmapCache, TTLCache
+from gumiyabot.store import PersistentStore
+
+from .conftest import fake_beatmap, fake_user, wait_until
+
+
+def _caches(pp_ttl=60 * 60):
+    return dict(
+        beatmap_cache=BeatmapCache(),
+        pp_cache=TTLCache(ttl=pp_ttl),
+        user_cache=TTLCache(ttl=60),
+    )
+
+
+def _write(run, path):
+    mapset = [BeatmapRecord.from_dict(fake_beatmap(beatmap_id)) for beatmap_id in (100, 101, 102)]
+
+    async def main():
+        store = PersistentStore(path)
+        store.put_beatmaps(mapset, complete_mapset=True)
+        store.record_hit(101)
+        store.put_pp((101, 0), {'starDiff': 5.0, 'ppForAcc': {'1.0': 300.0}})
+        store.put_user('Cookiezi', [User(fake_user('Cookiezi'))])
+        await store.close()
+
+    run(main())
+    return mapset
+
+
+async def _warm(path, caches):
+    store = PersistentStore(path)
+    try:
+        return await store.warm(**caches)
+    finally:
+        await store.close()
+
+
+def test_restore(run, tmp_path):
+    path = str(tmp_path / 'store.db')
+    mapset = _write(run, path)
+    caches = _caches()
+    assert run(_warm(path, caches)) == 5
+    beatmap_cache = caches['beatmap_cache']
+    restored = beatmap_cache.get_mapset(mapset[0].beatmapset_id)
+    assert [b.to_dict() for b in restored] == [b.to_dict() for b in mapset]
+    assert caches['pp_cache'].get((101, 0)) == {'starDiff': 5.0, 'ppForAcc': {'1.0': 300.0}}
+    (user,) = caches['user_cache'].get('cookiezi')
+    assert user.username == 'Cookiezi'
+
+
+def test_restore_skips_expired_and_cached_entries(run, tmp_path):
+    path = str(tmp_path / 'store.db')
+    mapset = _write(run, path)
+    caches = _caches(pp_ttl=0)
+    fresh = mapset[0].with_mods()
+    caches['beatmap_cache'].put_beatmaps([fresh])
+    caches['user_cache'].set('cookiezi', [])
+
+    async def main():
+        store = PersistentStore(path)
+        try:
+            return await store.start_warm(**caches)
+        finally:
+            await store.close()
+
+    assert run(main()) == 2
+    assert caches['beatmap_cache'].get_beatmap(100) is fresh
+    assert (101, 0) not in caches['pp_cache']
+    assert caches['user_cache'].get('cookiezi') == []
+
+
+def test_failed_flush_keeps_batch(run, tmp_path):
+    path = tmp_path / 'missing' / 'store.db'
+
+    async def main():
+        store = PersistentStore(str(path), flush_interval=.01)
+        store.start()
+        store.put_pp((101, 0), {'starDiff': 5.0})
+        store.record_hit(101)
+        await wait_until(lambda: store.errors)
+        # the flusher keeps running and retries once the database can be opened
+        assert store.errors and not store._flusher.done()
+        assert len(store._pending) == 1
+        path.parent.mkdir()
+        await wait_until(lambda: store.writes)
+        assert not store._pending and store.writes == 1
+        await store.close()
+
+    run(main())
+    with sqlite3.connect(str(path)) as conn:
+        assert conn.execute('SELECT data FROM pp').fetchall() == [('{"starDiff": 5.0}',)]
+
+
+def test_pending_writes_are_bounded():
+    store = PersistentStore(':memory:', max_pending=3)
+    for beatmap_id in range(5):
+        store.put_pp((beatmap_id, 0), {})
+    assert [args[0] for (_, args) in store._pending] == [(2, 0), (3, 0), (4, 0)]
+    assert store.dropped == 2
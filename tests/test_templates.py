@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+import pytest
+
+from osuapi.enums import OsuMod
+
+from gumiyabot.beatmap import BeatmapRecord
+from gumiyabot.templates import DEFAULT_BANCHO_TEMPLATE, DEFAULT_TWITCH_TEMPLATE, MessageTemplate, beatmap_fields, fill
+
+from .conftest import fake_beatmap
+
+
+PP = {.95: 150.4, .98: 180.6, 1.0: 200.2}
+
+
+def _fields(pp=PP, mods=OsuMod.NoMod):
+    beatmap = BeatmapRecord.from_dict(fake_beatmap(1000)).with_mods(mods)
+    if pp is not None:
+        beatmap = beatmap.with_pp(pp)
+    return beatmap_fields(beatmap, mods)
+
+
+def test_render_fills_in_nick():
+    template = MessageTemplate('{nick} > {artist} - {title} {pp98}pp, thanks {nick}!')
+    parts = template.render(_fields())
+    assert len(parts) == 3
+    assert fill(parts, 'someone') == 'someone > {} - {} 181pp, thanks someone!'.format(
+        _fields()['artist'], _fields()['title'])
+
+
+def test_default_templates():
+    fields = _fields(mods=OsuMod.HardRock)
+    msg = fill(MessageTemplate(DEFAULT_TWITCH_TEMPLATE).render(fields), 'someone')
+    assert msg.endswith(' +HR, ♫ {:g}, ★ {:.2f} | 95%: 150pp | 98%: 181pp | 100%: 200pp'.format(
+        fields['bpm'], fields['stars']))
+    msg = fill(MessageTemplate(DEFAULT_BANCHO_TEMPLATE).render(fields), 'someone')
+    assert msg.startswith('someone > [http://osu.ppy.sh/b/1000 ')
+
+
+@pytest.mark.parametrize('source,expected', [
+    ('{pp98}pp', '?pp'),
+    ('{pp98:.0f}pp', '?pp'),
+    ('{pp98:>4}pp', '   ?pp'),
+    ('{pp98!r}pp', '?pp'),
+    ('{pp}', ''),
+])
+def test_missing_pp(source, expected):
+    assert fill(MessageTemplate(source).render(_fields(pp=None)), '') == expected
+
+
+@pytest.mark.parametrize('source', [
+    '{unknown}',
+    '{artist',
+    '{nick:>10}',
+    '{nick!r}',
+    '{stars:{od}}',
+    '{artist:.2f}',
+    '{bpm:d}',
+])
+def test_invalid_templates(source):
+    with pytest.raises(ValueError):
+        MessageTemplate(source)
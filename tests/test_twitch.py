@@ -0,0 +1,610 @@
+# -*- coding: utf-8 -*-
+import asyncio
+
+import aiohttp
+import pytest
+
+from irc3.utils import IrcString
+from osuapi.enums import OsuMod
+from osuapi.model import User
+
+from gumiyabot import calc
+from gumiyabot.beatmap import BeatmapRecord
+from gumiyabot.cache import TTLCache
+from gumiyabot.twitch import BaseTwitchPlugin, find_link, parse_mods
+
+from .conftest import FakeBot, FakeClock, fake_beatmap, fake_user, wait_until
+
+
+needs_numpy = pytest.mark.skipif(not calc.available(), reason='requires NumPy')
+
+
+@pytest.mark.parametrize('data,expected', [
+    ('https://osu.ppy.sh/b/1000', ('b', None, '1000', None)),
+    ('http://osu.ppy.sh/b/1000', ('b', None, '1000', None)),
+    ('https://osu.ppy.sh/s/500', ('s', '500', None, None)),
+    # /s/ links always request the mapset
+    ('https://osu.ppy.sh/s/500/1000', ('s', '500', None, None)),
+    ('https://osu.ppy.sh/beatmapsets/500', ('beatmapsets', '500', None, None)),
+    ('https://osu.ppy.sh/beatmapsets/500#osu/1000', ('beatmapsets', '500', '1000', None)),
+    ('https://osu.ppy.sh/beatmapsets/500/1000', ('beatmapsets', '500', '1000', None)),
+    ('https://osu.ppy.sh/b/1000 +HDDT', ('b', None, '1000', 'HDDT')),
+    ('https://osu.ppy.sh/b/1000+hr', ('b', None, '1000', 'hr')),
+    ('https://osu.ppy.sh/beatmapsets/500#osu/1000 HD', ('beatmapsets', '500', '1000', 'HD')),
+    ('https://osu.ppy.sh/s/500 +DT', ('s', '500', None, 'DT')),
+    # like before, a word after the link is taken as mods
+    ('check this https://osu.ppy.sh/b/1000 out', ('b', None, '1000', 'out')),
+    # /b/ links are preferred over /s/ links, and /s/ links over /beatmapsets/ links
+    ('https://osu.ppy.sh/s/500 https://osu.ppy.sh/b/1000', ('b', None, '1000', None)),
+    ('https://osu.ppy.sh/beatmapsets/501#osu/1001 https://osu.ppy.sh/s/500', ('s', '500', None, None)),
+    # of several links of the same kind the first one is used
+    ('https://osu.ppy.sh/b/1000 +HR https://osu.ppy.sh/b/1001', ('b', None, '1000', 'HR')),
+    ('https://osu.ppy.sh/b/ https://osu.ppy.sh/b/1001', ('b', None, '1001', None)),
+])
+def test_find_link(data, expected):
+    m = find_link(data)
+    kind = 'b' if m.group('short') else 's' if m.group('set') else 'beatmapsets'
+    assert (kind, m.group('mapset_id'), m.group('beatmap_id'), m.group('mods')) == expected
+
+
+@pytest.mark.parametrize('data', [
+    '',
+    'hello chat',
+    'osu.ppy.sh/b/1000',
+    'https://osu.ppy.sh/b/',
+    'https://osu.ppy.sh/u/2',
+    'https://example.com/b/1000',
+])
+def test_find_link_plain_text(data):
+    assert find_link(data) is None
+
+
+@pytest.mark.parametrize('mods,expected', [
+    ('', OsuMod.NoMod),
+    ('HD', OsuMod.Hidden),
+    ('hddt', OsuMod.Hidden | OsuMod.DoubleTime),
+    ('HDHRX', OsuMod.Hidden | OsuMod.HardRock),
+    ('XX', OsuMod.NoMod),
+])
+def test_parse_mods(mods, expected):
+    assert parse_mods(mods) == expected
+
+
+async def _local_pp_plugin(tmp_path, local_pp='fallback'):
+    bot = FakeBot(local_pp=local_pp, osu_file_cache_dir=str(tmp_path))
+    return BaseTwitchPlugin(bot)
+
+
+@needs_numpy
+def test_local_pp(run, tmp_path, osu_file):
+
+    async def main():
+        plugin = await _local_pp_plugin(tmp_path)
+        data = fake_beatmap(1000)
+        data['file_md5'] = plugin.calculator.files.put(osu_file)
+        beatmap = BeatmapRecord.from_dict(data)
+        try:
+            return await plugin._with_pp(beatmap.with_mods(OsuMod.HardRock), mods=OsuMod.HardRock)
+        finally:
+            await plugin.http.close()
+
+    beatmap = run(main())
+    assert beatmap.pp[1.0] == pytest.approx(401.48, rel=.01)
+    assert beatmap.difficultyrating == pytest.approx(6.5192, rel=.005)
+
+
+@needs_numpy
+def test_local_pp_timeout(run, tmp_path, monkeypatch):
+
+    async def main():
+        plugin = await _local_pp_plugin(tmp_path, local_pp='primary')
+
+        async def beatmapinfo(beatmap, mods=0):
+            await asyncio.sleep(60)
+
+        monkeypatch.setattr(plugin.calculator, 'beatmapinfo', beatmapinfo)
+        real_wait_for = asyncio.wait_for
+        monkeypatch.setattr(asyncio, 'wait_for', lambda fut, timeout: real_wait_for(fut, .01))
+        try:
+            return await plugin._with_pp(BeatmapRecord.from_dict(fake_beatmap(1000)))
+        finally:
+            await plugin.http.close()
+
+    beatmap = run(main())
+    assert beatmap.pp is None
+
+
+def test_shed_request_does_not_start_cooldown(run):
+    async def main():
+        plugin = BaseTwitchPlugin(FakeBot(user_cooldown=60, map_cooldown=60, cooldown_exempt_subs='off'))
+        handled = []
+
+        async def request(match, mask, target, **kwargs):
+            handled.append(match.group('beatmap_id'))
+            return (None, None)
+
+        async def shed(user=None):
+            return False
+
+        plugin._request_beatmap = request
+        admit = plugin.admission.admit
+        target = IrcString('#gumiyabot')
+        mask = IrcString('someone!someone@someone.tmi.twitch.tv')
+        try:
+            plugin.admission.admit = shed
+            await plugin.request_beatmap(mask=mask, target=target, data='https://osu.ppy.sh/b/1000')
+            plugin.admission.admit = admit
+            await plugin.request_beatmap(mask=mask, target=target, data='https://osu.ppy.sh/b/1000')
+            # now on cooldown
+            await plugin.request_beatmap(mask=mask, target=target, data='https://osu.ppy.sh/b/1001')
+        finally:
+            await plugin.http.close()
+        return (plugin, handled)
+
+    (plugin, handled) = run(main())
+    assert handled == ['1000']
+    assert plugin.cooldown_suppressed == 1
+
+
+def _evaluated(beatmap_id=1000, **changes):
+    data = fake_beatmap(beatmap_id)
+    data.update(changes)
+    return BeatmapRecord.from_dict(data).with_pp({.95: 150, .98: 180, 1.0: 200})
+
+
+def test_per_channel_templates(run):
+
+    async def main():
+        plugin = BaseTwitchPlugin(FakeBot(
+            twitch_message_template='global {title}',
+            twitch_channels={'a': {'twitch_message_template': 'a {title} {pp98}pp'}, 'b': {}}))
+        beatmap = _evaluated(title='Song')
+        try:
+            return [await plugin._beatmap_msg(beatmap, channel=channel) for channel in ('#a', '#b', '#gumiyabot')]
+        finally:
+            await plugin.http.close()
+
+    assert run(main()) == ['a Song 180pp', 'global Song', 'global Song']
+
+
+def test_invalid_channel_template(run):
+
+    async def main():
+        BaseTwitchPlugin(FakeBot(twitch_channels={'a': {'bancho_message_template': '{nick} {stars:d}'}}))
+
+    with pytest.raises(ValueError):
+        run(main())
+
+
+def test_rendered_messages_are_cached_per_beatmap_id(run):
+
+    async def main():
+        plugin = BaseTwitchPlugin(FakeBot(twitch_message_template='{title} by {creator}'))
+        try:
+            msgs = [await plugin._beatmap_msg(_evaluated(title='Song'), channel='#gumiyabot') for _ in range(3)]
+            # a refetched map which changed renders a new message
+            msgs.append(await plugin._beatmap_msg(
+                _evaluated(title='Song (updated)', last_update='2020-01-02 00:00:00'), channel='#gumiyabot'))
+        finally:
+            await plugin.http.close()
+        return (msgs, plugin.message_cache)
+
+    (msgs, message_cache) = run(main())
+    assert msgs[:3] == ['Song by {}'.format(fake_beatmap(1000)['creator'])] * 3
+    assert msgs[3].startswith('Song (updated) by ')
+    assert len(message_cache) == 2
+    assert (message_cache.hits, message_cache.misses) == (2, 2)
+
+
+@pytest.mark.parametrize('policy', ['oldest', 'newest', 'per-user'])
+def test_request_shed_by_admission_policy_refunds_cooldown(run, policy):
+
+    async def main():
+        plugin = BaseTwitchPlugin(FakeBot(
+            user_cooldown=60, map_cooldown=60, cooldown_exempt_subs='off',
+            request_concurrency=1, request_queue_size=0, request_drop_policy=policy))
+        handled = []
+
+        async def request(match, mask, target, **kwargs):
+            handled.append(match.group('beatmap_id'))
+            return (None, None)
+
+        plugin._request_beatmap = request
+        target = IrcString('#gumiyabot')
+        mask = IrcString('someone!someone@someone.tmi.twitch.tv')
+        try:
+            # another request holds the only slot
+            assert await plugin.admission.admit()
+            await plugin.request_beatmap(mask=mask, target=target, data='https://osu.ppy.sh/b/1000')
+            assert plugin.admission.shed == 1
+            assert len(plugin.cooldowns) == 0
+            plugin.admission.release()
+            await plugin.request_beatmap(mask=mask, target=target, data='https://osu.ppy.sh/b/1000')
+        finally:
+            await plugin.http.close()
+        return (plugin, handled)
+
+    (plugin, handled) = run(main())
+    assert handled == ['1000']
+    assert plugin.cooldown_suppressed == 0
+    assert len(plugin.cooldowns) == 2
+
+
+class _Tillerino(object):
+    """Fake Tillerino API which answers once release is set"""
+
+    def __init__(self, data=None, error=None):
+        self.data = data
+        self.error = error
+        self.calls = []
+        self.release = asyncio.Event()
+        self.release.set()
+
+    async def beatmapinfo(self, beatmap_id, mods=0):
+        self.calls.append((beatmap_id, mods))
+        await self.release.wait()
+        if self.error is not None:
+            raise self.error
+        return self.data
+
+
+PP_DATA = {'starDiff': 5.5, 'ppForAcc': {'0.95': 150.0, '0.98': 180.0, '1.0': 200.0}}
+
+
+async def _tillerino_plugin(tillerino, clock=None):
+    plugin = BaseTwitchPlugin(FakeBot(
+        tillerino_api_key='key', upstream_hedge='off', pp_cache=TTLCache(ttl=60 * 60, clock=clock or FakeClock())))
+    plugin.tillerino = tillerino
+    return plugin
+
+
+def test_concurrent_pp_lookups_share_one_request(run):
+    tillerino = _Tillerino(PP_DATA)
+
+    async def main():
+        plugin = await _tillerino_plugin(tillerino)
+        beatmap = BeatmapRecord.from_dict(fake_beatmap(1000))
+        tillerino.release.clear()
+        try:
+            lookups = [asyncio.ensure_future(plugin._with_pp(beatmap)) for _ in range(5)]
+            await wait_until(lambda: tillerino.calls)
+            tillerino.release.set()
+            beatmaps = await asyncio.gather(*lookups)
+            # later lookups are answered from the pp cache
+            beatmaps.append(await plugin._with_pp(beatmap))
+        finally:
+            await plugin.http.close()
+        return beatmaps
+
+    beatmaps = run(main())
+    assert tillerino.calls == [(1000, 0)]
+    assert [b.pp[.98] for b in beatmaps] == [180.0] * 6
+    assert beatmaps[0].difficultyrating == 5.5
+
+
+def test_pp_lookups_without_data_are_cached(run):
+    tillerino = _Tillerino(None)
+    clock = FakeClock()
+
+    async def main():
+        plugin = await _tillerino_plugin(tillerino, clock=clock)
+        beatmap = BeatmapRecord.from_dict(fake_beatmap(1000))
+        try:
+            beatmaps = [await plugin._with_pp(beatmap) for _ in range(3)]
+            clock.now += plugin.pp_cache_negative_ttl
+            tillerino.data = PP_DATA
+            beatmaps.append(await plugin._with_pp(beatmap))
+        finally:
+            await plugin.http.close()
+        return beatmaps
+
+    beatmaps = run(main())
+    # Tillerino is asked again once the negative entry expired
+    assert tillerino.calls == [(1000, 0)] * 2
+    assert [b.pp for b in beatmaps[:3]] == [None] * 3
+    assert beatmaps[3].pp[1.0] == 200.0
+
+
+def test_failed_pp_lookups_are_not_cached(run):
+    tillerino = _Tillerino(error=aiohttp.ClientError('unavailable'))
+
+    async def main():
+        plugin = await _tillerino_plugin(tillerino)
+        beatmap = BeatmapRecord.from_dict(fake_beatmap(1000))
+        try:
+            beatmaps = [await plugin._with_pp(beatmap) for _ in range(2)]
+            tillerino.error = None
+            tillerino.data = PP_DATA
+            beatmaps.append(await plugin._with_pp(beatmap))
+        finally:
+            await plugin.http.close()
+        return beatmaps
+
+    beatmaps = run(main())
+    assert tillerino.calls == [(1000, 0)] * 3
+    assert [b.pp for b in beatmaps[:2]] == [None] * 2
+    assert beatmaps[2].pp[1.0] == 200.0
+
+
+def test_failed_pp_lookup_serves_stale_data(run):
+    tillerino = _Tillerino(PP_DATA)
+    clock = FakeClock()
+
+    async def main():
+        plugin = await _tillerino_plugin(tillerino, clock=clock)
+        plugin.pp_cache.stale_ttl = 60 * 60
+        beatmap = BeatmapRecord.from_dict(fake_beatmap(1000))
+        try:
+            await plugin._with_pp(beatmap)
+            clock.now += plugin.pp_cache.ttl
+            tillerino.error = asyncio.TimeoutError()
+            return await plugin._with_pp(beatmap)
+        finally:
+            await plugin.http.close()
+
+    beatmap = run(main())
+    assert tillerino.calls == [(1000, 0)] * 2
+    assert beatmap.pp[1.0] == 200.0
+
+
+class _OsuApi(object):
+    """Fake osu! API which answers get_user once release is set"""
+
+    def __init__(self):
+        self.pp_raw = 5000
+        self.calls = []
+        self.release = asyncio.Event()
+        self.release.set()
+
+    async def get_user(self, username):
+        self.calls.append(username)
+        await self.release.wait()
+        data = fake_user(username)
+        data['pp_raw'] = str(self.pp_raw)
+        return [User(data)]
+
+
+class _Sender(object):
+
+    def __init__(self):
+        self.sent = []
+
+    def send(self, target, msg, **kwargs):
+        self.sent.append((target, msg))
+
+
+async def _stats_plugin(osu, clock, **config):
+    plugin = BaseTwitchPlugin(FakeBot(
+        upstream_hedge='off', user_cache=TTLCache(ttl=60, stale_ttl=60 * 60, clock=clock), **config))
+    plugin.osu = osu
+    plugin.sender = _Sender()
+    return plugin
+
+
+STATS_MASK = IrcString('someone!someone@someone.tmi.twitch.tv')
+STATS_CHANNEL = IrcString('#gumiyabot')
+
+
+def test_concurrent_stats_share_one_request(run):
+    osu = _OsuApi()
+
+    async def main():
+        plugin = await _stats_plugin(osu, FakeClock())
+        osu.release.clear()
+        try:
+            commands = [
+                asyncio.ensure_future(plugin.stats(STATS_MASK, STATS_CHANNEL, {'<username>': [name]}))
+                for name in ('Player', 'player', 'PLAYER')
+            ]
+            await wait_until(lambda: osu.calls)
+            osu.release.set()
+            await asyncio.gather(*commands)
+        finally:
+            await plugin.http.close()
+        return plugin.sender.sent
+
+    sent = run(main())
+    assert osu.calls == ['Player']
+    assert len(sent) == 3
+    assert all(msg.startswith('Player | PP: 5,000') for (target, msg) in sent)
+
+
+def test_stats_serves_stale_user_while_refreshing(run):
+    osu = _OsuApi()
+    clock = FakeClock()
+
+    async def main():
+        plugin = await _stats_plugin(osu, clock)
+        args = {'<username>': ['Player']}
+        try:
+            await plugin.stats(STATS_MASK, STATS_CHANNEL, args)
+            clock.now += 60
+            osu.pp_raw = 6000
+            osu.release.clear()
+            # both are answered from the stale entry, and only one refresh is started
+            await plugin.stats(STATS_MASK, STATS_CHANNEL, args)
+            await plugin.stats(STATS_MASK, STATS_CHANNEL, args)
+            assert len(plugin.user_flight) == 1
+            osu.release.set()
+            await wait_until(lambda: not plugin.user_flight)
+            await plugin.stats(STATS_MASK, STATS_CHANNEL, args)
+        finally:
+            await plugin.http.close()
+        return plugin.sender.sent
+
+    sent = run(main())
+    assert osu.calls == ['Player'] * 2
+    assert [msg.split(' | ')[1].split()[1] for (target, msg) in sent] == ['5,000.0'] * 3 + ['6,000.0']
+
+
+def test_refresh_followed_users(run):
+    osu = _OsuApi()
+    clock = FakeClock()
+
+    async def main():
+        plugin = await _stats_plugin(
+            osu, clock, bancho_nick='GumiyaBot',
+            twitch_channels={'a': {'osu_username': 'Streamer'}, 'b': {'osu_username': 'streamer'}})
+        refresh = asyncio.ensure_future(plugin.refresh_followed_users(60))
+        try:
+            await wait_until(lambda: len(plugin.user_cache) == 2)
+            # !stats in a channel defaults to the channel's osu! user and never waits on the osu! API
+            osu.release.clear()
+            clock.now += 60
+            await plugin.stats(STATS_MASK, IrcString('#a'), {'<username>': []})
+        finally:
+            refresh.cancel()
+            await plugin.http.close()
+        return plugin.sender.sent
+
+    sent = run(main())
+    assert sorted(osu.calls) == ['GumiyaBot', 'Streamer']
+    assert sent[0][1].startswith('Streamer | ')
+
+
+def test_prefetch_pp_skips_cached_lookups(run):
+    tillerino = _Tillerino(PP_DATA)
+
+    async def main():
+        plugin = await _tillerino_plugin(tillerino)
+        beatmap = BeatmapRecord.from_dict(fake_beatmap(1000))
+        try:
+            return [await plugin._prefetch_pp(beatmap, mods=OsuMod.HardRock) for _ in range(2)]
+        finally:
+            await plugin.http.close()
+
+    # the second prefetch did not need a Tillerino request, so its token is refunded
+    assert run(main()) == [True, False]
+    assert tillerino.calls == [(1000, OsuMod.HardRock.value)]
+
+
+def test_channel_config(run):
+
+    async def main():
+        plugin = BaseTwitchPlugin(FakeBot(
+            user_cooldown=30, twitch_channels={'A': {'user_cooldown': 0, 'osu_username': 'Streamer'}}))
+        await plugin.http.close()
+        return plugin
+
+    plugin = run(main())
+    assert sorted(plugin.channels) == ['#a', '#gumiyabot']
+    for channel in ('a', '#a', '#A'):
+        assert plugin.channel_config(channel, 'user_cooldown') == 0
+    assert plugin.channel_config('#gumiyabot', 'user_cooldown') == 30
+    assert plugin.channel_config('#a', 'map_cooldown', 10) == 10
+    assert plugin.channel_config('#unknown', 'user_cooldown') == 30
+
+
+@pytest.mark.parametrize('channel,expected', [
+    ('#a', 'Target'),
+    ('#b', 'Streamer'),
+    ('#c', 'GumiyaBot'),
+    ('#gumiyabot', 'GumiyaBot'),
+    ('#unknown', 'GumiyaBot'),
+])
+def test_bancho_target(run, channel, expected):
+
+    async def main():
+        plugin = BaseTwitchPlugin(FakeBot(twitch_channels={
+            'a': {'osu_username': 'Streamer', 'bancho_target': 'Target'},
+            'b': {'osu_username': 'Streamer'},
+            'c': {},
+        }))
+        await plugin.http.close()
+        return plugin
+
+    assert run(main())._bancho_target(channel) == expected
+
+
+def test_requests_are_routed_per_channel(run):
+
+    async def main():
+        plugin = BaseTwitchPlugin(FakeBot(twitch_channels={'a': {'osu_username': 'Streamer'}}))
+        plugin.sender = _Sender()
+
+        async def request(match, mask, target, **kwargs):
+            return (_evaluated(), 'reply in {}'.format(target))
+
+        plugin._request_beatmap = request
+        mask = IrcString('someone!someone@someone.tmi.twitch.tv')
+        try:
+            for channel in ('#a', '#gumiyabot', '#other'):
+                await plugin.request_beatmap(mask=mask, target=IrcString(channel), data='https://osu.ppy.sh/b/1000')
+        finally:
+            await plugin.http.close()
+        queued = []
+        while not plugin.bancho_queue.empty():
+            queued.append(plugin.bancho_queue.get_nowait()[0])
+        return (queued, plugin.sender.sent)
+
+    (queued, sent) = run(main())
+    # channels the bot was not configured for are ignored
+    assert queued == ['Streamer', 'GumiyaBot']
+    assert sent == [('#a', 'reply in #a'), ('#gumiyabot', 'reply in #gumiyabot')]
+
+
+class _SlowTillerino(_Tillerino):
+    """Fake Tillerino API which tracks how many requests run at once"""
+
+    def __init__(self, data):
+        super().__init__(data)
+        self.running = 0
+        self.max_running = 0
+
+    async def beatmapinfo(self, beatmap_id, mods=0):
+        self.running += 1
+        self.max_running = max(self.max_running, self.running)
+        try:
+            await asyncio.sleep(.01 * (beatmap_id % 3))
+            return await super().beatmapinfo(beatmap_id, mods=mods)
+        finally:
+            self.running -= 1
+
+
+def test_get_beatmaps_pp(run):
+    tillerino = _SlowTillerino(PP_DATA)
+
+    async def main():
+        plugin = BaseTwitchPlugin(FakeBot(tillerino_api_key='key', upstream_hedge='off', pp_concurrency=2))
+        plugin.tillerino = tillerino
+        beatmaps = [BeatmapRecord.from_dict(fake_beatmap(beatmap_id)) for beatmap_id in range(1000, 1006)]
+        try:
+            return await plugin.get_beatmaps_pp(beatmaps, mods=OsuMod.DoubleTime)
+        finally:
+            await plugin.http.close()
+
+    beatmaps = run(main())
+    # results keep the order of the mapset, with at most pp_concurrency lookups at once
+    assert [b.beatmap_id for b in beatmaps] == list(range(1000, 1006))
+    assert sorted(tillerino.calls) == [(beatmap_id, OsuMod.DoubleTime.value) for beatmap_id in range(1000, 1006)]
+    assert tillerino.max_running == 2
+    for beatmap in beatmaps:
+        assert beatmap.pp[.95] == 150.0
+        assert beatmap.difficultyrating == 5.5
+        # mods are applied before validation
+        assert beatmap.bpm == pytest.approx(BeatmapRecord.from_dict(fake_beatmap(beatmap.beatmap_id)).bpm * 1.5)
+
+
+def test_validate_evaluates_beatmaps(run):
+    tillerino = _Tillerino(PP_DATA)
+    validated = []
+
+    class Plugin(BaseTwitchPlugin):
+
+        evaluate_beatmaps = True
+
+        def validate_beatmaps(self, beatmaps, **kwargs):
+            validated.extend(beatmaps)
+            return [beatmap for beatmap in beatmaps if beatmap.beatmap_id != 1001]
+
+    async def main():
+        plugin = Plugin(FakeBot(tillerino_api_key='key', upstream_hedge='off'))
+        plugin.tillerino = tillerino
+        beatmaps = [BeatmapRecord.from_dict(fake_beatmap(beatmap_id)) for beatmap_id in (1000, 1001)]
+        try:
+            return await plugin._validate(beatmaps, mods=OsuMod.HardRock, channel='#gumiyabot')
+        finally:
+            await plugin.http.close()
+
+    assert [b.beatmap_id for b in run(main())] == [1000]
+    assert [b.pp[1.0] for b in validated] == [200.0, 200.0]